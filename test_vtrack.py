@@ -0,0 +1,1011 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# MIT License
+#
+# Copyright 2023 KrzDvt
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the “Software”), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+#
+# Unit tests of the pieces that need neither the Renault cloud nor a broker
+#
+# python -m pytest -q test_vtrack.py
+#
+
+
+import io
+import gzip
+import csv
+import json
+import datetime
+import time
+import threading
+
+import asyncio
+import pytest
+
+import vtrack
+
+
+class FakeClock:
+  def __init__(self, tick:float=1000):
+    self.tick:float = tick
+
+  def __call__(self) -> float:
+    return self.tick
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+  clock:FakeClock = FakeClock()
+  monkeypatch.setattr(vtrack.time, 'monotonic', clock)
+  return clock
+
+def buildVehicle(vin:str, **settingsDict) -> vtrack.Vehicle:
+  return vtrack.Vehicle('fake', dict(settingsDict, vin=vin))
+
+def buildValues(vehicle:vtrack.Vehicle=None, updateTick:int=None, **valuesDict) -> vtrack.VehicleValues:
+  values:vtrack.VehicleValues = vtrack.VehicleValues.fromDict(valuesDict)
+  values._updateTick = updateTick
+  values._device = vehicle
+  return values
+
+
+#
+# Publishing
+#
+
+def test_isPublishNeededDeadbands():
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  deadbands:dict = vtrack.VehicleValues.DEADBANDS
+  published:vtrack.VehicleValues = buildValues(batteryLevelPct=50, cockpitTempC=20.0, charging=False)
+
+  assert vehicle.isPublishNeeded('broker', published, deadbands, 0, 1000)
+  vehicle.setPublishedValues('broker', published, 1000)
+
+  # within the deadbands : nothing worth sending, with or without keep alive
+  assert not vehicle.isPublishNeeded('broker', buildValues(batteryLevelPct=50.5, cockpitTempC=20.4, charging=False), deadbands, 0, 100000)
+  assert not vehicle.isPublishNeeded('broker', buildValues(batteryLevelPct=50.5, cockpitTempC=20.4, charging=False), deadbands, 600, 1300)
+  # past a deadband, or any change of a value without one
+  assert vehicle.isPublishNeeded('broker', buildValues(batteryLevelPct=51, cockpitTempC=20.0, charging=False), deadbands, 0, 1300)
+  assert vehicle.isPublishNeeded('broker', buildValues(batteryLevelPct=50, cockpitTempC=20.0, charging=True), deadbands, 0, 1300)
+  # keep alive due
+  assert vehicle.isPublishNeeded('broker', buildValues(batteryLevelPct=50, cockpitTempC=20.0, charging=False), deadbands, 600, 1600)
+  # per broker
+  assert vehicle.isPublishNeeded('other', published, deadbands, 0, 1300)
+
+def test_deadbandsCompareToLastPublished():
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  deadbands:dict = vtrack.VehicleValues.DEADBANDS
+  vehicle.setPublishedValues('broker', buildValues(batteryLevelPct=50), 1000)
+  # a slow drift adds up against what was published, not the previous sample
+  for levelPct in ( 50.4, 50.8 ):
+    assert not vehicle.isPublishNeeded('broker', buildValues(batteryLevelPct=levelPct), deadbands, 0, 1300)
+  assert vehicle.isPublishNeeded('broker', buildValues(batteryLevelPct=51.2), deadbands, 0, 1300)
+
+
+#
+# Change feed
+#
+
+def appendChange(changeFeed:vtrack.ChangeFeed, vehicle:vtrack.Vehicle, **valuesDict):
+  values:vtrack.VehicleValues = buildValues(vehicle, **valuesDict)
+  vehicle.setLastValues(values)
+  changeFeed.onValues(vehicle, values)
+
+def test_changeFeedMergesPerVehicle():
+  changeFeed:vtrack.ChangeFeed = vtrack.ChangeFeed()
+  vehicle1:vtrack.Vehicle = buildVehicle('VIN1')
+  vehicle2:vtrack.Vehicle = buildVehicle('VIN2')
+  appendChange(changeFeed, vehicle1, batteryLevelPct=50)
+  appendChange(changeFeed, vehicle2, batteryLevelPct=70)
+  appendChange(changeFeed, vehicle1, batteryLevelPct=55)
+
+  assert changeFeed.getChanges(0) == ( 3, { 'VIN1': { 'batteryLevelPct': 55 }, 'VIN2': { 'batteryLevelPct': 70 } } )
+  assert changeFeed.getChanges(2) == ( 3, { 'VIN1': { 'batteryLevelPct': 55 } } )
+  assert changeFeed.getChanges(3) == ( 3, {} )
+
+def test_changeFeedStaleCursor():
+  changeFeed:vtrack.ChangeFeed = vtrack.ChangeFeed(maxLength=2)
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  for levelPct in ( 10, 20, 30 ):
+    appendChange(changeFeed, vehicle, batteryLevelPct=levelPct)
+
+  # the first change is gone : cannot be replayed from before it
+  assert changeFeed.getChanges(0) == ( 3, None )
+  assert changeFeed.getChanges(1) == ( 3, { 'VIN1': { 'batteryLevelPct': 30 } } )
+
+def test_changeFeedFutureCursor():
+  changeFeed:vtrack.ChangeFeed = vtrack.ChangeFeed()
+  appendChange(changeFeed, buildVehicle('VIN1'), batteryLevelPct=10)
+  # from before a restart : a reset, and no waiting for it
+  assert changeFeed.getChanges(5) == ( 1, None )
+  startTick:float = time.monotonic()
+  assert changeFeed.wait(5, 10) == 1
+  assert time.monotonic() - startTick < 1
+
+def test_changeFeedWaiterCap():
+  changeFeed:vtrack.ChangeFeed = vtrack.ChangeFeed(maxWaiters=1)
+  assert changeFeed.enter()
+  assert not changeFeed.enter()
+  changeFeed.leave()
+  assert changeFeed.enter()
+
+def test_changeFeedThousandsOfWaiters():
+  changeFeed:vtrack.ChangeFeed = vtrack.ChangeFeed()
+  woken:list[int] = []
+
+  def waiter():
+    try:
+      woken.append(changeFeed.wait(0, 30))
+    finally:
+      changeFeed.leave()
+
+  # the default cap, on threads as small as the http server ones
+  threads:list[threading.Thread] = []
+  stackSize:int = threading.stack_size(vtrack.HTTP_THREAD_STACK_SIZE)
+  try:
+    while changeFeed.enter():
+      threads.append(threading.Thread(target=waiter, daemon=True))
+      threads[-1].start()
+  finally:
+    threading.stack_size(stackSize)
+  assert len(threads) == 2000
+  appendChange(changeFeed, buildVehicle('VIN1'), batteryLevelPct=10)
+  for thread in threads:
+    thread.join(10)
+  assert woken == [ 1 ] * 2000
+  assert changeFeed.waiterCount == 0
+
+
+#
+# Values query
+#
+
+@pytest.fixture
+def fleetSettings() -> vtrack.Settings:
+  vehicleDicts:list[dict] = []
+  for index in range(5):
+    vehicleDicts.append({
+      'type': 'renault',
+      'vin': 'VF1TEST{0:08d}'.format(index),
+      'username': 'test@example.com',
+      'password': 'test',
+      'accountId': 'test-account',
+      'group': 'even' if index % 2 == 0 else 'odd',
+      'energy': 'ELECTRIQUE' if index < 4 else 'ESSENCE',
+      'registration': 'TE-{0:03d}'.format(index)
+    })
+  settings:vtrack.Settings = vtrack.Settings({ 'vehicles': vehicleDicts })
+  for index, vehicle in enumerate(settings.vehicles):
+    vehicle.setLastValues(buildValues(vehicle, 1000 + index, batteryLevelPct=10 * index, plugged=index < 2, charging=index == 0))
+  return settings
+
+def test_queryValuesPages(fleetSettings):
+  vins:list[str] = []
+  cursor:str = None
+  pageCount:int = 0
+  while True:
+    args:dict = { 'limit': '2' }
+    if cursor is not None:
+      args['cursor'] = cursor
+    page:dict = vtrack.queryValues(fleetSettings, args)
+    vins += [item['vin'] for item in page['vehicles']]
+    pageCount += 1
+    cursor = page['next']
+    if cursor is None:
+      break
+  assert pageCount == 3
+  assert vins == sorted(vehicle.vin for vehicle in fleetSettings.vehicles)
+
+def test_queryValuesFilters(fleetSettings):
+  page:dict = vtrack.queryValues(fleetSettings, { 'group': 'even' })
+  assert [item['vin'] for item in page['vehicles']] == [ 'VF1TEST00000000', 'VF1TEST00000002', 'VF1TEST00000004' ]
+  page = vtrack.queryValues(fleetSettings, { 'group': 'even', 'energy': 'ELECTRIQUE' })
+  assert [item['vin'] for item in page['vehicles']] == [ 'VF1TEST00000000', 'VF1TEST00000002' ]
+  page = vtrack.queryValues(fleetSettings, { 'state': 'charging' })
+  assert [item['vin'] for item in page['vehicles']] == [ 'VF1TEST00000000' ]
+  page = vtrack.queryValues(fleetSettings, { 'state': 'unplugged' })
+  assert len(page['vehicles']) == 3
+  page = vtrack.queryValues(fleetSettings, { 'vin': 'VF1TEST00000003,VF1TEST00000001,VF1TESTUNKNOWN' })
+  assert [item['vin'] for item in page['vehicles']] == [ 'VF1TEST00000001', 'VF1TEST00000003' ]
+  page = vtrack.queryValues(fleetSettings, { 'registration': 'TE-002', 'fields': 'batteryLevelPct' })
+  assert page['vehicles'][0]['vin'] == 'VF1TEST00000002'
+  assert page['vehicles'][0]['values'] == { 'batteryLevelPct': 20 }
+
+def test_queryValuesFilteredPages(fleetSettings):
+  page:dict = vtrack.queryValues(fleetSettings, { 'group': 'even', 'limit': '2' })
+  assert page['next'] == 'VF1TEST00000002'
+  page = vtrack.queryValues(fleetSettings, { 'group': 'even', 'limit': '2', 'cursor': page['next'] })
+  assert [item['vin'] for item in page['vehicles']] == [ 'VF1TEST00000004' ]
+  assert page['next'] is None
+
+def test_queryValuesRejects(fleetSettings):
+  assert vtrack.queryValues(fleetSettings, { 'state': 'flying' }) is None
+  assert vtrack.queryValues(fleetSettings, { 'fields': 'batteryLevelPct,unknown' }) is None
+  assert vtrack.queryValues(fleetSettings, { 'limit': 'many' }) is None
+
+
+#
+# Limiters
+#
+
+def test_tokenBucketBurstThenRate(clock):
+  bucket:vtrack.TokenBucket = vtrack.TokenBucket(10, 2)
+  assert bucket.reserve() == 0
+  assert bucket.reserve() == 0
+  # burst spent : each next one a tenth of a second after the previous
+  assert bucket.reserve() == pytest.approx(0.1)
+  assert bucket.reserve() == pytest.approx(0.2)
+  clock.tick += 1
+  assert bucket.reserve() == 0
+
+def test_tokenBucketDrain(clock):
+  bucket:vtrack.TokenBucket = vtrack.TokenBucket(10, 5)
+  bucket.drain()
+  assert bucket.reserve() == pytest.approx(0.6)
+
+def test_tokenBucketUnlimited(clock):
+  bucket:vtrack.TokenBucket = vtrack.TokenBucket(0, 1)
+  for _ in range(10):
+    asyncio.run(bucket.acquire('test'))
+  assert bucket.tokens == 1
+
+def test_circuitBreakerOpensAndProbes(clock):
+  breaker:vtrack.CircuitBreaker = vtrack.CircuitBreaker(2, 60)
+  breaker.setFailed()
+  assert breaker.allow()
+  breaker.setFailed()
+  assert breaker.state == vtrack.CircuitBreaker.STATE_OPEN
+  assert not breaker.allow()
+
+  # one probe once cooled down, the others still fail fast
+  clock.tick += 60
+  assert breaker.allow()
+  assert breaker.state == vtrack.CircuitBreaker.STATE_HALF_OPEN
+  assert not breaker.allow()
+
+  # a failed probe opens it again right away
+  breaker.setFailed()
+  assert breaker.state == vtrack.CircuitBreaker.STATE_OPEN
+  clock.tick += 60
+  assert breaker.allow()
+  breaker.setSucceeded()
+  assert breaker.state == vtrack.CircuitBreaker.STATE_CLOSED
+  assert breaker.errorCount == 0
+  assert breaker.allow()
+
+def test_circuitBreakerDisabled(clock):
+  breaker:vtrack.CircuitBreaker = vtrack.CircuitBreaker(0, 60)
+  for _ in range(10):
+    breaker.setFailed()
+  assert breaker.state == vtrack.CircuitBreaker.STATE_CLOSED
+  assert breaker.allow()
+
+
+#
+# Sessions
+#
+
+def test_sessionsTrip():
+  sessions:vtrack.VehicleSessions = vtrack.VehicleSessions(10)
+  home:dict = { 'latitude': 48.8566, 'longitude': 2.3522 }
+  work:dict = { 'latitude': 48.8566, 'longitude': 2.4522 }
+  sessions.append(buildValues(updateTick=0, cockpitOdoKm=100.0, location=home))
+  sessions.append(buildValues(updateTick=600, cockpitOdoKm=105.0))
+  sessions.append(buildValues(updateTick=1200, cockpitOdoKm=110.0))
+  assert sessions.trip is not None
+  assert len(sessions.trips) == 0
+  sessions.append(buildValues(updateTick=1800, cockpitOdoKm=110.0, location=work))
+
+  assert sessions.trip is None
+  trip:dict = sessions.trips[0]
+  assert trip['startTick'] == 0
+  assert trip['endTick'] == 1200
+  assert trip['distanceKm'] == pytest.approx(10)
+  assert trip['avgSpeedKmh'] == pytest.approx(30)
+  assert trip['displacementKm'] == pytest.approx(7.3, abs=0.1)
+
+def test_sessionsIgnoresOutOfOrder():
+  sessions:vtrack.VehicleSessions = vtrack.VehicleSessions(10)
+  sessions.append(buildValues(updateTick=600, cockpitOdoKm=100.0))
+  sessions.append(buildValues(updateTick=0, cockpitOdoKm=90.0))
+  sessions.append(buildValues(updateTick=600, cockpitOdoKm=120.0))
+  assert sessions.trip is None
+  assert sessions.lastOdoKm == 100.0
+
+def test_sessionsChargeIntegratesPower():
+  sessions:vtrack.VehicleSessions = vtrack.VehicleSessions(10)
+  sessions.append(buildValues(updateTick=0, charging=True, chargingPowerW=7000, batteryLevelPct=20))
+  sessions.append(buildValues(updateTick=3600, charging=True, chargingPowerW=7000, batteryLevelPct=40))
+  sessions.append(buildValues(updateTick=7200, charging=False, chargingPowerW=0, batteryLevelPct=50))
+
+  assert sessions.charge is None
+  charge:dict = sessions.charges[0]
+  assert charge['duration_s'] == 7200
+  assert charge['addedPct'] == 30
+  # 7 kWh at full power, then half of it while fading out
+  assert charge['addedKwh'] == pytest.approx(10.5)
+  assert charge['maxPowerW'] == 7000
+
+def test_sessionsChargePrefersBatteryEnergy():
+  sessions:vtrack.VehicleSessions = vtrack.VehicleSessions(10)
+  sessions.append(buildValues(updateTick=0, charging=True, chargingPowerW=7000, batteryAvailNrgKwh=10.0))
+  sessions.append(buildValues(updateTick=3600, charging=False, batteryAvailNrgKwh=16.0))
+  assert sessions.charges[0]['addedKwh'] == pytest.approx(6)
+
+def test_sessionsKept():
+  sessions:vtrack.VehicleSessions = vtrack.VehicleSessions(2)
+  for index in range(3):
+    sessions.append(buildValues(updateTick=index * 1000, charging=True, batteryLevelPct=10))
+    sessions.append(buildValues(updateTick=index * 1000 + 500, charging=False, batteryLevelPct=20))
+  assert [charge['startTick'] for charge in sessions.charges] == [ 1000, 2000 ]
+
+
+#
+# Export
+#
+
+@pytest.fixture
+def exportVehicle() -> vtrack.Vehicle:
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1', registration='AB-123-CD', model='ZOE')
+  vehicle.setLastValues(buildValues(vehicle, 1000, batteryLevelPct=80, plugged=True,
+                                    location={ 'latitude': 48.85, 'longitude': 2.35 }, locationTstamp=990))
+  return vehicle
+
+def test_exportNdjson(exportVehicle):
+  file:io.StringIO = io.StringIO()
+  export:vtrack.ValuesExport = vtrack.ValuesExport(file, 'ndjson')
+  export.write(exportVehicle, exportVehicle.lastValues)
+  export.write(exportVehicle, None)
+
+  lines:list[dict] = [json.loads(line) for line in file.getvalue().splitlines()]
+  assert export.count == 2
+  assert lines[0]['vin'] == 'VIN1'
+  assert lines[0]['registration'] == 'AB-123-CD'
+  assert lines[0]['updateTick'] == 1000
+  assert lines[0]['values'] == { 'batteryLevelPct': 80, 'plugged': True, 'location': { 'latitude': 48.85, 'longitude': 2.35 }, 'locationTstamp': 990 }
+  assert lines[1]['values'] == {}
+
+def test_exportNdjsonFields(exportVehicle):
+  file:io.StringIO = io.StringIO()
+  vtrack.ValuesExport(file, 'ndjson', [ 'batteryLevelPct', 'charging' ]).write(exportVehicle, exportVehicle.lastValues)
+  assert json.loads(file.getvalue())['values'] == { 'batteryLevelPct': 80 }
+
+def test_exportCsv(exportVehicle):
+  file:io.StringIO = io.StringIO()
+  export:vtrack.ValuesExport = vtrack.ValuesExport(file, 'csv', [ 'batteryLevelPct', 'plugged', 'location' ])
+  export.write(exportVehicle, exportVehicle.lastValues)
+
+  rows:list[dict] = list(csv.DictReader(io.StringIO(file.getvalue())))
+  assert len(rows) == 1
+  assert list(rows[0].keys()) == vtrack.ValuesExport.COLUMNS + [ 'batteryLevelPct', 'plugged', 'latitude', 'longitude', 'locationTstamp' ]
+  assert rows[0]['vin'] == 'VIN1'
+  assert rows[0]['batteryLevelPct'] == '80'
+  assert rows[0]['plugged'] == 'True'
+  assert rows[0]['latitude'] == '48.85'
+  assert rows[0]['locationTstamp'] == '990'
+
+def test_exportCsvHeaderAlone():
+  # nothing answered : still a header for whatever reads it
+  file:io.StringIO = io.StringIO()
+  vtrack.ValuesExport(file, 'csv', [ 'batteryLevelPct' ])
+  assert file.getvalue() == ','.join(vtrack.ValuesExport.COLUMNS + [ 'batteryLevelPct' ]) + '\n'
+
+
+#
+# Scheduler
+#
+
+class FakeVehicle(vtrack.Vehicle):
+  def __init__(self, settingsDict:dict=None):
+    super().__init__('fake', settingsDict)
+    self.pollCount:int = 0
+
+  async def retrieveValues(self) -> vtrack.VehicleValues:
+    self.pollCount += 1
+    self.setLastValues(buildValues(self, int(time.time()), batteryLevelPct=50, plugged=False))
+    self.setPollSucceeded()
+    return self.lastValues
+
+
+class FakeBroker:
+  def __init__(self):
+    self.up:bool = True
+    self.publishCount:int = 0
+    self.messages:list = []
+
+  async def publish(self, publisher:vtrack.MqttPublisher, messages:list) -> bool:
+    self.publishCount += 1
+    if not self.up:
+      return False
+    self.messages += messages
+    return True
+
+
+@pytest.fixture
+def fakeVehicles(monkeypatch):
+  monkeypatch.setitem(vtrack.VEHICLE_TYPES, 'fake', lambda: FakeVehicle)
+
+@pytest.fixture
+def fakeBroker(monkeypatch) -> FakeBroker:
+  broker:FakeBroker = FakeBroker()
+  monkeypatch.setattr(vtrack.MqttPublisher, '_publish', lambda publisher, messages: broker.publish(publisher, messages))
+  return broker
+
+def waitFor(condition, timeout_s:float=5) -> bool:
+  deadline:float = time.monotonic() + timeout_s
+  while not condition():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.01)
+  return True
+
+def test_serviceBacksOffDownBroker(fakeVehicles, fakeBroker):
+  settings:vtrack.Settings = vtrack.Settings({
+    'vehicles': [ { 'type': 'fake', 'vin': 'VIN1' } ],
+    'mqtts': [ { 'hostname': 'broker', 'port': 1883 } ],
+    'keepAlive': 1,
+    'publishRetryDelay': 1,
+    'declareDelay': 0,
+    'pollIdleDelay': 3600
+  })
+  service:vtrack.Service = vtrack.Service(settings)
+  service.start()
+  try:
+    assert waitFor(lambda: len(settings.vehicles[0].publishedTicks) > 0)
+    fakeBroker.up = False
+    cycleCount:int = service.cycleCount
+    time.sleep(3)
+    # overdue keep alives wait for the broker backoff : a few cycles, not a busy loop
+    assert service.cycleCount - cycleCount <= 4
+    assert fakeBroker.publishCount <= 6
+    assert settings.vehicles[0].pollCount == 1
+  finally:
+    service.stop()
+
+
+#
+# MQTT
+#
+
+class FakeMqttInfo:
+  def __init__(self, acknowledged:bool):
+    self.acknowledged:bool = acknowledged
+
+  def wait_for_publish(self, timeout_s:float=None):
+    pass
+
+  def is_published(self) -> bool:
+    return self.acknowledged
+
+
+class FakeMqttClient:
+  def __init__(self):
+    self.acknowledged:bool = True
+    self.published:list[tuple] = []
+    self.stopped:bool = False
+
+  def publish(self, topic:str, payload, qos:int=0, retain:bool=False) -> FakeMqttInfo:
+    self.published.append(( topic, payload, qos, retain ))
+    return FakeMqttInfo(self.acknowledged)
+
+  def disconnect(self):
+    pass
+
+  def loop_stop(self):
+    self.stopped = True
+
+
+@pytest.fixture
+def mqtt():
+  vtrack.importLazily('mqtt')
+  return vtrack.MqttSettings({ 'hostname': 'broker', 'port': 1883, 'isHA': True })
+
+def publishOnce(publisher:vtrack.MqttPublisher, messagesFunc, *args) -> bool:
+  async def run() -> bool:
+    try:
+      return await publisher.publish(messagesFunc, *args)
+    finally:
+      await publisher.close()
+  return asyncio.run(run())
+
+def test_connectionWaitsForAcknowledgements(mqtt):
+  connection:vtrack.MqttConnection = vtrack.MqttConnection(mqtt, 1)
+  client:FakeMqttClient = FakeMqttClient()
+  connection.client = client
+  connection.connected.set()
+
+  assert connection.publish([ ( 'vtrack/VIN1/state', '{}', True ), ( 'vtrack/VIN2/state', '{}', True ) ])
+  assert client.published == [ ( 'vtrack/VIN1/state', '{}', 1, True ), ( 'vtrack/VIN2/state', '{}', 1, True ) ]
+
+  # not acknowledged in time : failed, and a fresh connection next time
+  client.acknowledged = False
+  assert not connection.publish([ ( 'vtrack/VIN1/state', '{}', True ) ])
+  assert client.stopped
+  assert connection.client is None
+
+def test_connectionNotConnected(mqtt, monkeypatch):
+  connection:vtrack.MqttConnection = vtrack.MqttConnection(mqtt, 0.1)
+  monkeypatch.setattr(connection, '_connect', lambda deadline: False)
+  assert not connection.publish([ ( 'vtrack/VIN1/state', '{}', True ) ])
+  assert connection.publish([])
+
+def test_helpersFormatByDefault(mqtt, monkeypatch):
+  calls:list[tuple] = []
+  monkeypatch.setattr(vtrack, 'sendValues2Mqtt', lambda values, deviceSettings, mqtt: calls.append(( 'state', values, deviceSettings )) or True, raising=False)
+  monkeypatch.setattr(vtrack, 'declareValues2Mqtt', lambda deviceSettings, mqtt, declareValues: calls.append(( 'declare', deviceSettings, declareValues )) or True, raising=False)
+  publisher:vtrack.MqttPublisher = vtrack.MqttPublisher(mqtt)
+  assert isinstance(publisher.connection, vtrack.MqttHelperConnection)
+
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  values:vtrack.VehicleValues = buildValues(vehicle, 1000, batteryLevelPct=50)
+  vehicle.setLastValues(values)
+  deviceSettings = vtrack.vehicle2DeviceSettings(vehicle)
+  declareValues:list = vtrack.vehicle2DeclareValues(vehicle)
+
+  # what the helpers always got, only waited on now
+  assert publishOnce(publisher, publisher.connection.getDeclareMessages, vehicle, deviceSettings, declareValues)
+  assert publishOnce(publisher, publisher.connection.getStateMessages, values, deviceSettings)
+  assert calls == [ ( 'declare', deviceSettings, declareValues ), ( 'state', values, deviceSettings ) ]
+
+def test_helpersNotAcknowledged(mqtt, monkeypatch):
+  monkeypatch.setattr(vtrack, 'sendValues2Mqtt', lambda values, deviceSettings, mqtt: False, raising=False)
+  publisher:vtrack.MqttPublisher = vtrack.MqttPublisher(mqtt, minRetryDelay_s=60)
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  assert not publishOnce(publisher, publisher.connection.getStateMessages, buildValues(vehicle, 1000), vtrack.vehicle2DeviceSettings(vehicle))
+  assert publisher.failedCount == 1
+  assert not publisher.isAvailable()
+
+def test_vtrackFormatLayout(mqtt):
+  publisher:vtrack.MqttPublisher = vtrack.MqttPublisher(mqtt, format=vtrack.MqttPublisher.FORMAT_VTRACK)
+  assert isinstance(publisher.connection, vtrack.MqttConnection)
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1', group='fleet')
+  values:vtrack.VehicleValues = buildValues(vehicle, 1000, batteryLevelPct=50, charging=True)
+  vehicle.setLastValues(values)
+  deviceSettings = vtrack.vehicle2DeviceSettings(vehicle)
+
+  messages:list[tuple] = publisher.connection.getStateMessages(values, deviceSettings)
+  assert [( topic, json.loads(payload), retain ) for topic, payload, retain in messages] == \
+         [ ( 'fleet/VIN1/state', { 'batteryLevelPct': 50, 'charging': True, 'updateTick': 1000 }, True ) ]
+  messages = publisher.connection.getDeclareMessages(vehicle, deviceSettings, vtrack.vehicle2DeclareValues(vehicle))
+  assert [topic for topic, payload, retain in messages] == [ 'homeassistant/sensor/VIN1/batteryLevelPct/config', 'homeassistant/binary_sensor/VIN1/charging/config' ]
+  assert json.loads(messages[0][1])['unique_id'] == 'VIN1_batteryLevelPct'
+
+def test_publisherDefersWhileBackingOff(mqtt):
+  publisher:vtrack.MqttPublisher = vtrack.MqttPublisher(mqtt, minRetryDelay_s=60)
+  calls:list = []
+  publisher.connection.publish = lambda messages: calls.append(messages) or False
+
+  async def run() -> list[bool]:
+    try:
+      return [await publisher.publish(lambda: [ 'first' ]), await publisher.publish(lambda: [ 'second' ])]
+    finally:
+      await publisher.close()
+  # the second one is not even tried before the retry time
+  assert asyncio.run(run()) == [ False, False ]
+  assert calls == [ [ 'first' ] ]
+  assert publisher.failedCount == 1
+  assert publisher.deferredCount == 1
+  assert publisher.retryDelay_s == 60
+
+def test_publisherBoundsHungBroker(mqtt):
+  publisher:vtrack.MqttPublisher = vtrack.MqttPublisher(mqtt, timeout_s=0.1)
+  publisher.connection.publish = lambda messages: time.sleep(1.5) or True
+  startTime:float = time.monotonic()
+  assert not publishOnce(publisher, lambda: [ 'state' ])
+  assert time.monotonic() - startTime < 3
+  assert publisher.failedCount == 1
+
+def test_declarePerBroker(fakeVehicles):
+  settings:vtrack.Settings = vtrack.Settings({
+    'vehicles': [ { 'type': 'fake', 'vin': 'VIN1' } ],
+    'mqtts': [ { 'hostname': 'up', 'port': 1883 }, { 'hostname': 'down', 'port': 1883 } ],
+    'declareDelay': 0
+  })
+  vehicle:vtrack.Vehicle = settings.vehicles[0]
+  vehicle.setLastValues(buildValues(vehicle, 1000, batteryLevelPct=50))
+  up:dict[str, bool] = { 'up:1883': True, 'down:1883': False }
+  calls:dict[str, int] = { 'up:1883': 0, 'down:1883': 0 }
+  for publisher in settings.mqttPublishers:
+    publisher.connection.publish = lambda messages, key=publisher.key: calls.__setitem__(key, calls[key] + 1) or up[key]
+
+  async def declare(count:int):
+    for _ in range(count):
+      for publisher in settings.mqttPublishers:
+        # retried right away rather than after the backoff
+        publisher.retryTick = None
+      await vtrack.declareValues(settings)
+
+  async def run():
+    try:
+      # the healthy broker is not declared to again while the other one keeps failing
+      await declare(3)
+      assert calls == { 'up:1883': 1, 'down:1883': 3 }
+      assert vehicle.declaredMasks == { 'up:1883': vehicle.knownMask }
+
+      up['down:1883'] = True
+      await declare(2)
+      assert calls == { 'up:1883': 1, 'down:1883': 4 }
+      assert vehicle.declaredMasks == { 'up:1883': vehicle.knownMask, 'down:1883': vehicle.knownMask }
+
+      # a newly known value : declared everywhere again
+      vehicle.setLastValues(buildValues(vehicle, 1100, batteryLevelPct=50, plugged=True))
+      await declare(1)
+      assert calls == { 'up:1883': 2, 'down:1883': 5 }
+    finally:
+      for publisher in settings.mqttPublishers:
+        await publisher.close()
+  asyncio.run(run())
+
+def test_declaredMasksKept():
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  vehicle.setLastValues(buildValues(vehicle, 1000, batteryLevelPct=50))
+  vehicle.declaredMasks = { 'up:1883': vehicle.knownMask }
+
+  restored:vtrack.Vehicle = buildVehicle('VIN1')
+  restored.fromStateDict(json.loads(json.dumps(vehicle.toStateDict())))
+  assert restored.declaredMasks == { 'up:1883': vehicle.knownMask }
+
+def test_vtrackFormatRenderedOnce(mqtt):
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  values:vtrack.VehicleValues = buildValues(vehicle, 1000, batteryLevelPct=50)
+  vehicle.setLastValues(values)
+  deviceSettings = vtrack.vehicle2DeviceSettings(vehicle)
+  declareValues:list = vtrack.vehicle2DeclareValues(vehicle)
+  connections:list = [vtrack.MqttConnection(mqtt), vtrack.MqttConnection(vtrack.MqttSettings({ 'hostname': 'other', 'port': 1883, 'isHA': True }))]
+
+  # one payload and one set of configs, shared by every broker
+  states:list = [connection.getStateMessages(values, deviceSettings)[0][1] for connection in connections]
+  assert states[0] is states[1]
+  declares:list = [connection.getDeclareMessages(vehicle, deviceSettings, declareValues) for connection in connections]
+  assert declares[0] is declares[1]
+
+  # rendered again once something else is known
+  vehicle.setLastValues(buildValues(vehicle, 1100, batteryLevelPct=50, plugged=True))
+  assert json.loads(connections[0].getStateMessages(vehicle.lastValues, deviceSettings)[0][1])['plugged'] is True
+  rendered:list = connections[0].getDeclareMessages(vehicle, deviceSettings, vtrack.vehicle2DeclareValues(vehicle))
+  assert rendered is not declares[0]
+  assert len(rendered) == len(declares[0]) + 1
+
+  # not declared at all where discovery is off
+  mqtt.isHA = False
+  assert connections[0].getDeclareMessages(vehicle, deviceSettings, vehicle.declareValues) == []
+
+
+#
+# State
+#
+
+def test_stateSavesSerialized(tmp_path, monkeypatch):
+  settings:vtrack.Settings = vtrack.Settings({ 'vehicles': [], 'state': { 'path': str(tmp_path / 'state.json') } })
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  settings.vehicles = [ vehicle ]
+  write = settings.state.write
+  writing:list[int] = [ 0, 0 ]
+
+  def slowWrite(stateDict:dict):
+    writing[0] += 1
+    writing[1] = max(writing[1], writing[0])
+    time.sleep(0.05)
+    write(stateDict)
+    writing[0] -= 1
+  monkeypatch.setattr(settings.state, 'write', slowWrite)
+
+  async def run():
+    saves:list = []
+    for updateTick in range(1000, 1005):
+      vehicle.setLastValues(buildValues(vehicle, updateTick, batteryLevelPct=50))
+      saves.append(asyncio.ensure_future(settings.state.saveAsync(settings)))
+      await asyncio.sleep(0)
+    await asyncio.gather(*saves)
+  asyncio.run(run())
+
+  # one at a time, the latest values last
+  assert writing[1] == 1
+  with open(tmp_path / 'state.json') as file:
+    assert json.load(file)['vehicles']['VIN1']['updateTick'] == 1004
+  assert not (tmp_path / 'state.json.tmp').exists()
+
+
+#
+# History
+#
+
+def test_historyDownsamplesAndRetains(tmp_path):
+  store:vtrack.HistoryStore = vtrack.HistoryStore({ 'path': str(tmp_path / 'history.db'), 'rawRetention': 86400 })
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  hourTick:int = ( int(time.time()) // 3600 - 2 ) * 3600
+  oldTick:int = hourTick - 3 * 86400
+
+  store.append(buildValues(vehicle, oldTick, batteryLevelPct=5))
+  for offset_s, levelPct, charging, odoKm in ( ( 0, 10, True, 100.0 ), ( 60, 20, True, 101.0 ), ( 120, 30, False, 102.0 ), ( 600, 40, False, 103.0 ) ):
+    store.append(buildValues(vehicle, hourTick + offset_s, batteryLevelPct=levelPct, charging=charging, cockpitOdoKm=odoKm))
+  # older than what is stored already : dropped
+  store.append(buildValues(vehicle, hourTick, batteryLevelPct=99))
+  store.flush()
+
+  samples:list[dict] = store.query('VIN1', hourTick, hourTick + 3600, vtrack.HistoryStore.RESOLUTION_RAW)
+  assert [sample['batteryLevelPct'] for sample in samples] == [ 10, 20, 30, 40 ]
+  assert samples[0]['charging'] is True
+
+  samples = store.query('VIN1', hourTick, hourTick + 3600, vtrack.HistoryStore.RESOLUTION_5MIN)
+  assert [( sample['tick'], sample['count'] ) for sample in samples] == [ ( hourTick, 3 ), ( hourTick + 600, 1 ) ]
+  assert samples[0]['batteryLevelPct'] == pytest.approx(20)
+  assert samples[0]['charging'] == pytest.approx(2 / 3)
+  assert samples[0]['cockpitOdoKm'] == 102.0
+
+  samples = store.query('VIN1', hourTick, hourTick + 3600, vtrack.HistoryStore.RESOLUTION_HOUR)
+  assert len(samples) == 1
+  assert samples[0]['count'] == 4
+  assert samples[0]['batteryLevelPct'] == pytest.approx(25)
+
+  # past the raw retention : only its downsampled buckets are left
+  assert store.query('VIN1', oldTick, oldTick + 1, vtrack.HistoryStore.RESOLUTION_RAW) == []
+  samples = store.query('VIN1', oldTick - 3600, oldTick + 3600, vtrack.HistoryStore.RESOLUTION_5MIN)
+  assert [sample['batteryLevelPct'] for sample in samples] == [ 5 ]
+
+def test_historyDownsamplesOnce(tmp_path):
+  store:vtrack.HistoryStore = vtrack.HistoryStore({ 'path': str(tmp_path / 'history.db') })
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  hourTick:int = ( int(time.time()) // 3600 - 2 ) * 3600
+  store.append(buildValues(vehicle, hourTick, batteryLevelPct=10))
+  store.flush()
+  samples:list[dict] = store.query('VIN1', hourTick, hourTick + 300, vtrack.HistoryStore.RESOLUTION_5MIN)
+  assert [( sample['count'], sample['batteryLevelPct'] ) for sample in samples] == [ ( 1, 10 ) ]
+
+  # a late raw sample into an already downsampled bucket : that bucket and its hour are downsampled again
+  store.storedTicks = {}
+  store.append(buildValues(vehicle, hourTick + 60, batteryLevelPct=30))
+  store.maintenanceTick = None
+  store.flush()
+  samples = store.query('VIN1', hourTick, hourTick + 300, vtrack.HistoryStore.RESOLUTION_5MIN)
+  assert [( sample['count'], sample['batteryLevelPct'] ) for sample in samples] == [ ( 2, 20 ) ]
+  samples = store.query('VIN1', hourTick, hourTick + 3600, vtrack.HistoryStore.RESOLUTION_HOUR)
+  assert [( sample['count'], sample['batteryLevelPct'] ) for sample in samples] == [ ( 2, 20 ) ]
+
+  # nothing late since : left as it is
+  store.maintenanceTick = None
+  store.flush()
+  samples = store.query('VIN1', hourTick, hourTick + 3600, vtrack.HistoryStore.RESOLUTION_5MIN)
+  assert [( sample['count'], sample['batteryLevelPct'] ) for sample in samples] == [ ( 2, 20 ) ]
+
+def test_historyLateBeyondRetention(tmp_path):
+  store:vtrack.HistoryStore = vtrack.HistoryStore({ 'path': str(tmp_path / 'history.db'), 'rawRetention': 86400 })
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  oldTick:int = ( int(time.time()) // 3600 - 72 ) * 3600
+  store.append(buildValues(vehicle, oldTick, batteryLevelPct=10))
+  store.flush()
+  # its raw neighbours are gone already : the bucket is not rebuilt out of the late sample alone
+  store.storedTicks = {}
+  store.append(buildValues(vehicle, oldTick + 60, batteryLevelPct=30))
+  store.maintenanceTick = None
+  store.flush()
+  samples:list[dict] = store.query('VIN1', oldTick, oldTick + 300, vtrack.HistoryStore.RESOLUTION_5MIN)
+  assert [( sample['count'], sample['batteryLevelPct'] ) for sample in samples] == [ ( 1, 10 ) ]
+
+def test_historyReadersPooled(tmp_path):
+  store:vtrack.HistoryStore = vtrack.HistoryStore({ 'path': str(tmp_path / 'history.db') })
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  store.append(buildValues(vehicle, 1000, batteryLevelPct=10))
+  store.flush()
+
+  results:list = []
+  threads:list[threading.Thread] = [threading.Thread(target=lambda: results.append(store.query('VIN1', 0, 2000, vtrack.HistoryStore.RESOLUTION_RAW))) for _ in range(5)]
+  for thread in threads:
+    thread.start()
+    thread.join()
+  # one request thread after the other : one connection between them
+  assert len(results) == 5 and all(samples == results[0] for samples in results)
+  assert len(store.readers) == 1
+
+def test_historyResolution():
+  store:vtrack.HistoryStore = vtrack.HistoryStore()
+  assert store.getResolution(0, 86400) == vtrack.HistoryStore.RESOLUTION_RAW
+  assert store.getResolution(0, 30 * 86400) == vtrack.HistoryStore.RESOLUTION_5MIN
+  assert store.getResolution(0, 365 * 86400) == vtrack.HistoryStore.RESOLUTION_HOUR
+
+
+#
+# Shards
+#
+
+def test_shardWorkerRespawned():
+  settings:vtrack.Settings = vtrack.Settings({ 'vehicles': [], 'shards': 2, 'shardBy': 'vin' })
+  pool:vtrack.ShardPool = settings.shards
+  vehicle:vtrack.Vehicle = next(buildVehicle('VIN{0}'.format(index)) for index in range(100) if pool.getShardIndex(buildVehicle('VIN{0}'.format(index))) == 0)
+  pool.start(settings)
+  try:
+    process = pool.processes[0]
+    process.kill()
+    process.join(10)
+
+    async def run() -> float:
+      startTime:float = time.monotonic()
+      await pool.poll([ vehicle ])
+      return time.monotonic() - startTime
+    # started again off the fork server on the next poll, and answering it : unknown there, so failed
+    assert asyncio.run(run()) < vtrack.ShardPool.REPLY_MARGIN_s
+    assert pool.processes[0] is not process and pool.processes[0].is_alive()
+    assert pool.alive == [ True, True ]
+    assert pool.pending == {}
+    assert vehicle.pollErrorCount == 1
+  finally:
+    pool.stop()
+
+
+#
+# Reload
+#
+
+def test_reloadMetricsAndVehicles(fakeVehicles, monkeypatch):
+  monkeypatch.setattr(vtrack.metrics, 'enabled', False)
+  settingsDict:dict = { 'vehicles': [ { 'type': 'fake', 'vin': 'VIN1' }, { 'type': 'fake', 'vin': 'VIN2' } ], 'pollIdleDelay': 3600 }
+  settings:vtrack.Settings = vtrack.Settings(settingsDict)
+  service:vtrack.Service = vtrack.Service(settings)
+  vehicle:vtrack.Vehicle = settings.vehicles[0]
+  vehicle.setLastValues(buildValues(vehicle, 1000, batteryLevelPct=50))
+
+  async def reload(**changes) -> bool:
+    return await service.reload(vtrack.Settings(dict(settingsDict, **changes)))
+
+  # metrics turned on and off in place, served or not by the same route
+  assert asyncio.run(reload(metrics=True))
+  assert settings.metrics and vtrack.metrics.enabled
+  assert asyncio.run(reload(metrics=False))
+  assert not settings.metrics and not vtrack.metrics.enabled
+
+  # the vehicle kept is the one polled before, with its values ; the removed one is gone
+  assert asyncio.run(reload(vehicles=[ { 'type': 'fake', 'vin': 'VIN1' }, { 'type': 'fake', 'vin': 'VIN3' } ]))
+  assert sorted(settings.vehiclesByVin) == [ 'VIN1', 'VIN3' ]
+  assert settings.vehiclesByVin['VIN1'].lastValues.batteryLevelPct == 50
+
+
+#
+# Refresh
+#
+
+def test_refreshMerged(fakeVehicles):
+  settings:vtrack.Settings = vtrack.Settings({
+    'vehicles': [ { 'type': 'fake', 'vin': 'VIN1' }, { 'type': 'fake', 'vin': 'VIN2' } ],
+    'pollIdleDelay': 3600,
+    'refreshMinDelay': 0
+  })
+  service:vtrack.Service = vtrack.Service(settings)
+  service.start()
+  try:
+    assert waitFor(lambda: all(vehicle.pollCount == 1 for vehicle in settings.vehicles))
+
+    async def refreshTwice() -> tuple:
+      return await service.refresh(settings.vehicles[:1]), await service.refresh(settings.vehicles)
+    # asked again before the first poll started : one poll answers both
+    jobs:tuple = service.submit(refreshTwice()).result(5)
+    assert all(job.doneEvent.wait(5) for job in jobs)
+    assert [vehicle.pollCount for vehicle in settings.vehicles] == [ 2, 2 ]
+    assert jobs[0].coalescedCount == 0 and jobs[1].coalescedCount == 1
+    assert jobs[1].results['VIN1'] == jobs[0].results['VIN1']
+    assert { vin: result['status'] for vin, result in jobs[1].results.items() } == { 'VIN1': 'updated', 'VIN2': 'updated' }
+
+    # polled less than refreshMinDelay ago : answered right away, no poll
+    settings.refreshMinDelay_s = 60
+    job:vtrack.RefreshJob = service.submit(service.refresh(settings.vehicles)).result(5)
+    assert job.isDone()
+    assert { vin: result['status'] for vin, result in job.results.items() } == { 'VIN1': 'recent', 'VIN2': 'recent' }
+    assert [vehicle.pollCount for vehicle in settings.vehicles] == [ 2, 2 ]
+  finally:
+    service.stop()
+
+
+#
+# Outbox
+#
+
+def test_outboxReplayedInOrder(mqtt, tmp_path):
+  outbox:vtrack.MqttOutbox = vtrack.MqttOutbox({ 'path': str(tmp_path / 'outbox.db'), 'batchSize': 2 })
+  publisher:vtrack.MqttPublisher = vtrack.MqttPublisher(mqtt, outbox=outbox)
+  vehicle:vtrack.Vehicle = buildVehicle('VIN1')
+  sentTicks:list[int] = []
+  failedTicks:set = { 1002 }
+
+  def publish(messages:list[tuple]) -> bool:
+    values:vtrack.VehicleValues = messages[0][1][0]
+    sentTicks.append(values._updateTick)
+    return not values._updateTick in failedTicks
+  publisher.connection.publish = publish
+
+  async def run():
+    try:
+      await outbox.append(publisher.key, [buildValues(vehicle, 1000, batteryLevelPct=10), buildValues(buildVehicle('VIN9'), 1001, batteryLevelPct=20),
+                                          buildValues(vehicle, 1002, batteryLevelPct=30), buildValues(vehicle, 1003, batteryLevelPct=40)])
+      assert publisher.getBacklog() == 4
+
+      # a batch at a time : a vehicle gone since is dropped, not sent
+      assert not await publisher.replay({ 'VIN1': vehicle }.get)
+      assert sentTicks == [ 1000 ]
+      assert publisher.getBacklog() == 2
+      assert vehicle.publishedValues[publisher.key].batteryLevelPct == 10
+
+      # stopped by the failure, kept for later
+      assert not await publisher.replay({ 'VIN1': vehicle }.get)
+      assert sentTicks == [ 1000, 1002 ]
+      assert publisher.getBacklog() == 2
+
+      # back up : replayed from where it failed, and done
+      failedTicks.clear()
+      publisher.retryTick = None
+      assert await publisher.replay({ 'VIN1': vehicle }.get)
+      assert sentTicks == [ 1000, 1002, 1002, 1003 ]
+      assert publisher.getBacklog() == 0
+      assert vehicle.publishedValues[publisher.key].batteryLevelPct == 40
+    finally:
+      await publisher.close()
+      await outbox.close()
+  asyncio.run(run())
+
+def test_outboxEvictsOldestKeepsLatest(tmp_path):
+  outbox:vtrack.MqttOutbox = vtrack.MqttOutbox({ 'path': str(tmp_path / 'outbox.db'), 'maxSamples': 2 })
+  vehicles:list[vtrack.Vehicle] = [buildVehicle('VIN1'), buildVehicle('VIN2')]
+
+  async def run() -> list[tuple]:
+    try:
+      await outbox.append('broker:1883', [buildValues(vehicles[1], 999), buildValues(vehicles[0], 1000), buildValues(vehicles[0], 1001), buildValues(vehicles[0], 1002)])
+      return await outbox.peek('broker:1883')
+    finally:
+      await outbox.close()
+  assert [( vin, tick ) for seq, vin, tick, valuesJson in asyncio.run(run())] == [ ( 'VIN2', 999 ), ( 'VIN1', 1002 ) ]
+  assert outbox.counts == { 'broker:1883': 2 }
+  assert outbox.evictedCount == 2
+
+
+#
+# Values cache
+#
+
+class FakeETags:
+  def __init__(self, *etags:str):
+    self.etags:tuple = etags
+
+  def __bool__(self) -> bool:
+    return len(self.etags) > 0
+
+  def contains(self, etag:str) -> bool:
+    return etag in self.etags
+
+
+def test_valuesCacheETags():
+  settings:vtrack.Settings = vtrack.Settings({ 'vehicles': [] })
+  settings.vehicles = [buildVehicle('VIN{0}'.format(index), registration='AB-{0:03d}-CD'.format(index)) for index in range(10)]
+  for index, vehicle in enumerate(settings.vehicles):
+    vehicle.setLastValues(buildValues(vehicle, 1000, batteryLevelPct=index, plugged=True, cockpitOdoKm=1000.5 + index))
+  cache:vtrack.ValuesCache = vtrack.ValuesCache(settings)
+
+  body, encoding, etag, lastModified = cache.get([])
+  assert encoding is None
+  assert json.loads(body)['AB-003-CD']['batteryLevelPct'] == 3
+  assert cache.get([]) == ( body, None, etag, lastModified )
+  assert ( cache.missCount, cache.hitCount ) == ( 1, 1 )
+
+  # each encoding its own validator, for the identity body
+  gzipBody, encoding, gzipEtag, _ = cache.get([ 'gzip' ])
+  assert encoding == 'gzip' and gzipEtag == etag + '-gzip'
+  assert gzip.decompress(gzipBody) == body
+
+  # polled again to the same values : same validators
+  vehicle:vtrack.Vehicle = settings.vehicles[0]
+  vehicle.setLastValues(buildValues(vehicle, 1000, batteryLevelPct=0, plugged=True, cockpitOdoKm=1000.5))
+  assert cache.get([ 'gzip' ])[2] == gzipEtag
+  vehicle.setLastValues(buildValues(vehicle, 1100, batteryLevelPct=1, plugged=True, cockpitOdoKm=1000.5))
+  assert cache.get([])[2] != etag
+
+def test_valuesNotModified():
+  lastModified:datetime.datetime = datetime.datetime(2024, 1, 1, 12, tzinfo=datetime.timezone.utc)
+  assert vtrack.ValuesCache.isNotModified(FakeETags('abc'), None, 'abc', lastModified)
+  assert not vtrack.ValuesCache.isNotModified(FakeETags('abc'), None, 'abc-gzip', lastModified)
+  # the etag decides when there is one, whatever the date says
+  assert not vtrack.ValuesCache.isNotModified(FakeETags('old'), lastModified, 'abc', lastModified)
+  assert vtrack.ValuesCache.isNotModified(FakeETags(), lastModified.replace(tzinfo=None), 'abc', lastModified)
+  assert not vtrack.ValuesCache.isNotModified(FakeETags(), lastModified - datetime.timedelta(seconds=1), 'abc', lastModified)
+  assert not vtrack.ValuesCache.isNotModified(None, None, 'abc', lastModified)
@@ -13,47 +13,233 @@
 # Dependencies
 #
 # pip install flask flask-httpauth
-# pip install APScheduler
 # pip install asyncio
 # pip install renault-api
+# pip install paho-mqtt (mqtt brokers set to the vtrack format only)
 # + pyhelp's dependencies
 
 
+from __future__ import annotations
+
 import sys
 sys.path.insert(1, '../pyhelp/')
 
 
+import os
+import gzip
 import json
+import csv
+import hashlib
+import zlib
+import struct
+import pickle
+import sqlite3
 import time
+import math
 import argparse
 import datetime
-
-from apscheduler.schedulers.background import BackgroundScheduler
-from flask import Flask
+import uuid
+import heapq
+import signal
+import bisect
+import collections
+import importlib
+import threading
+import contextlib
+import multiprocessing
+import concurrent.futures
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
 
 import asyncio
 
-import aiohttp
-from renault_api.renault_client import RenaultClient
-from renault_api.renault_account import RenaultAccount
-from renault_api.renault_vehicle import RenaultVehicle
-
+# vehicle sdks (renault_api, aiohttp), flask and the mqtt and http api helpers : imported once the settings use them
 from misc import *
-from mqtt import *
-from httpapi import *
 from devnval import *
 
+def importLazily(moduleName:str):
+  # star import on first use, without replacing anything defined here
+  module = importlib.import_module(moduleName)
+  names:[str] = getattr(module, '__all__', [name for name in vars(module) if not name.startswith('_')])
+  moduleGlobals:dict = globals()
+  for name in names:
+    if not name in moduleGlobals:
+      moduleGlobals[name] = getattr(module, name)
+
 
 #
 # Classes
 #
 
+class Metrics:
+  BUCKETS_s:tuple = ( 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 )
+
+  # name -> ( type, help )
+  DEFINITIONS:dict[str, tuple] = {
+    'vtrack_renault_login_seconds': ( 'histogram', 'Renault login duration' ),
+    'vtrack_renault_request_seconds': ( 'histogram', 'Renault endpoint request duration' ),
+    'vtrack_renault_errors_total': ( 'counter', 'Renault login and endpoint errors' ),
+    'vtrack_renault_throttle_seconds': ( 'histogram', 'Renault requests delayed by a rate limiter' ),
+    'vtrack_renault_open_circuits': ( 'gauge', 'Renault endpoints failing fast after repeated errors' ),
+    'vtrack_mqtt_publish_seconds': ( 'histogram', 'MQTT publish duration until acknowledged' ),
+    'vtrack_mqtt_errors_total': ( 'counter', 'MQTT publishes failed or timed out' ),
+    'vtrack_mqtt_dropped_total': ( 'counter', 'MQTT publishes dropped on a full queue' ),
+    'vtrack_mqtt_queue_length': ( 'gauge', 'MQTT publishes waiting in the broker queue' ),
+    'vtrack_mqtt_sent_ratio': ( 'gauge', 'MQTT publishes acknowledged over attempted' ),
+    'vtrack_mqtt_backlog': ( 'gauge', 'Samples waiting in the outbox of a broker' ),
+    'vtrack_outbox_replayed_total': ( 'counter', 'Outbox samples published once the broker came back' ),
+    'vtrack_outbox_evicted_total': ( 'counter', 'Outbox samples dropped over the size cap' ),
+    'vtrack_cycle_seconds': ( 'histogram', 'Poll, declare and publish cycle duration' ),
+    'vtrack_cycle_errors_total': ( 'counter', 'Cycles aborted by an error' ),
+    'vtrack_cycles_coalesced_total': ( 'counter', 'Cycles merged into the next one while one was running' ),
+    'vtrack_values_cache_total': ( 'counter', 'Values cache lookups' ),
+    'vtrack_vehicle_data_age_seconds': ( 'gauge', 'Age of the last values of a vehicle' ),
+    'vtrack_vehicle_poll_errors': ( 'gauge', 'Consecutive failed polls of a vehicle' )
+  }
+
+  def __init__(self):
+    self.enabled:bool = False
+    self.lock:threading.Lock = threading.Lock()
+    # ( name, labels ) -> value, or [ bucket counts..., sum, count ] for histograms
+    self.values:dict[tuple, object] = {}
+
+  def inc(self, name:str, labels:dict=None, value:float=1):
+    if not self.enabled:
+      return
+    key:tuple = ( name, tuple(sorted(labels.items())) if labels is not None else () )
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + value
+
+  def set(self, name:str, value:float, labels:dict=None):
+    if not self.enabled:
+      return
+    key:tuple = ( name, tuple(sorted(labels.items())) if labels is not None else () )
+    with self.lock:
+      self.values[key] = value
+
+  def observe(self, name:str, value:float, labels:dict=None):
+    if not self.enabled:
+      return
+    key:tuple = ( name, tuple(sorted(labels.items())) if labels is not None else () )
+    with self.lock:
+      histogram:list = self.values.get(key)
+      if histogram is None:
+        histogram = [0] * ( len(Metrics.BUCKETS_s) + 2 )
+        self.values[key] = histogram
+      index:int = bisect.bisect_left(Metrics.BUCKETS_s, value)
+      if index < len(Metrics.BUCKETS_s):
+        histogram[index] += 1
+      histogram[-2] += value
+      histogram[-1] += 1
+
+  def removeLabels(self, labels:dict):
+    # every series carrying these labels, e.g. those of a vehicle gone
+    labelItems:set = set(labels.items())
+    with self.lock:
+      for key in [key for key in self.values if labelItems.issubset(key[1])]:
+        del self.values[key]
+
+  @staticmethod
+  def _formatLabels(labels:tuple, extra:tuple=()) -> str:
+    if len(labels) <= 0 and len(extra) <= 0:
+      return ''
+    return '{' + ','.join('{0}="{1}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in labels + extra) + '}'
+
+  def render(self) -> str:
+    with self.lock:
+      items:list = sorted(self.values.items(), key=lambda item: item[0])
+    lines:[str] = []
+    lastName:str = None
+    for ( name, labels ), value in items:
+      if name != lastName:
+        metricType, metricHelp = Metrics.DEFINITIONS.get(name, ( 'untyped', '' ))
+        lines.append('# HELP {0} {1}'.format(name, metricHelp))
+        lines.append('# TYPE {0} {1}'.format(name, metricType))
+        lastName = name
+      if isinstance(value, list):
+        cumulated:int = 0
+        for bucket, count in zip(Metrics.BUCKETS_s, value):
+          cumulated += count
+          lines.append('{0}_bucket{1} {2}'.format(name, Metrics._formatLabels(labels, ( ( 'le', bucket ), )), cumulated))
+        lines.append('{0}_bucket{1} {2}'.format(name, Metrics._formatLabels(labels, ( ( 'le', '+Inf' ), )), value[-1]))
+        lines.append('{0}_sum{1} {2}'.format(name, Metrics._formatLabels(labels), value[-2]))
+        lines.append('{0}_count{1} {2}'.format(name, Metrics._formatLabels(labels), value[-1]))
+      else:
+        lines.append('{0}{1} {2}'.format(name, Metrics._formatLabels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+# no-op until enabled by the settings
+metrics:Metrics = Metrics()
+
+
+class EndpointStatus:
+  def __init__(self, name:str):
+    self.name:str = name
+    self.ok:bool = None
+    self.duration_s:float = None
+    self.error:Exception = None
+    # error kind only, for statuses coming from another process
+    self.errorName:str = None
+
+  def setSucceeded(self, duration_s:float):
+    self.ok = True
+    self.duration_s = duration_s
+    self.error = None
+
+  def setFailed(self, duration_s:float, error:Exception):
+    self.ok = False
+    self.duration_s = duration_s
+    self.error = error
+
+  def toDict(self) -> dict:
+    res:dict = { 'ok': self.ok, 'duration_s': self.duration_s }
+    if self.error is not None:
+      res['error'] = 'timeout' if isinstance(self.error, asyncio.TimeoutError) else type(self.error).__name__
+    elif self.errorName is not None:
+      res['error'] = self.errorName
+    return res
+
+  @staticmethod
+  def fromDict(name:str, statusDict:dict) -> 'EndpointStatus':
+    status:EndpointStatus = EndpointStatus(name)
+    status.ok = statusDict.get('ok')
+    status.duration_s = statusDict.get('duration_s')
+    status.errorName = statusDict.get('error')
+    return status
+
+
+class ValueField:
+  __slots__ = ( 'tag', 'valueType', 'bit', 'deadband', 'aggregate', 'declare' )
+
+  def __init__(self, tag:str, valueType:type, deadband:float=None, aggregate:str='AVG', **declare):
+    self.tag:str = tag
+    self.valueType:type = valueType
+    self.bit:int = 0
+    # smallest change worth publishing, None for any change
+    self.deadband:float = deadband
+    # how history buckets combine it, count weighted average otherwise
+    self.aggregate:str = aggregate
+    # discovery metadata, nothing is declared without it
+    self.declare:dict = declare if len(declare) > 0 else None
+
+
 class Values:
+  __slots__ = ( '_updateTick', '_sentTick', '_sentTicks', '_changedTags', '_endpointStatuses', '_device', '_statePayload' )
+
   def __init__(self):
     self._updateTick:int = None
     self._sentTick:int = None
+    self._sentTicks:dict[str, int] = {}
+    self._changedTags:[str] = None
+    self._endpointStatuses:dict[str, EndpointStatus] = None
 
     self._device:object = None
+    # json state as published, rendered once whichever brokers it goes to
+    self._statePayload:str = None
 
 
 class VehicleValues(Values):
@@ -71,58 +257,98 @@ class VehicleValues(Values):
   TAG_CHARGING:str = 'charging'
   TAG_CHARGING_POWER_W:str = 'chargingPowerW'
 
-  def __init__(self):
-    self.cockpitOdoKm:float = None
-    self.cockpitTempC:float = None
+  # the one place a value is described : storage, serialization, known values, deadbands, history and discovery
+  FIELDS:[ValueField] = [
+    ValueField(TAG_COCKPIT_ODO_KM, float, aggregate='MAX', name='cockpit odometer', unit='km', icon='mdi:counter', withAttrs=True),
+    ValueField(TAG_COCKPIT_TEMP_C, float, deadband=0.5, name='cockpit temperature', unit='°C'),
+    #ValueField(TAG_LOCATION, dict, name='location', unit='', type='device_tracker'),
+    ValueField(TAG_BATTERY_TEMP_C, float, deadband=0.5, name='battery temperature', unit='°C'),
+    ValueField(TAG_BATTERY_AVAIL_NRG_KWH, float, deadband=0.1),
+    ValueField(TAG_BATTERY_LEVEL_PCT, float, deadband=1, name='battery level', unit='%', icon='mdi:battery'),
+    ValueField(TAG_PLUGGED, bool, name='plugged', unit='', type='binary_sensor', icon='mdi:ev-plug-type2'),
+    ValueField(TAG_CHARGING, bool, name='charging', unit='', type='binary_sensor', icon='mdi:battery-charging'),
+    ValueField(TAG_CHARGING_POWER_W, int, deadband=100, name='charging power', unit='W')
+  ]
+  for bit, field in enumerate(FIELDS):
+    field.bit = 1 << bit
+  del bit, field
+
+  TAGS:[str] = [field.tag for field in FIELDS]
+  FIELDS_BY_TAG:dict[str, ValueField] = {field.tag: field for field in FIELDS}
+  DEADBANDS:dict[str, float] = {field.tag: field.deadband for field in FIELDS if field.deadband is not None}
+
+  # location is a dict : served and kept along, but neither published as a state nor stored in history
+  __slots__ = tuple(TAGS) + ( 'locationTstamp', 'location' )
 
-    self.locationTstamp:int = None
-    self.location:object = None
+  def __init__(self):
+    super().__init__()
 
-    self.batteryTempC:float = None
-    self.batteryAvailNrgKwh = None
-    self.batteryLevelPct:float = None
+    for tag in VehicleValues.TAGS:
+      setattr(self, tag, None)
 
-    self.plugged:bool = None
-    self.charging:bool = None
-    self.chargingPowerW:int = None
+    self.locationTstamp:int = None
+    self.location:dict = None
 
-  def toDict(self):
+  def toDict(self) -> dict:
     res:dict = {}
-
-    if self.cockpitOdoKm is not None:
-      res[VehicleValues.TAG_COCKPIT_ODO_KM] = self.cockpitOdoKm
-    if self.cockpitTempC is not None:
-      res[VehicleValues.TAG_COCKPIT_TEMP_C] = self.cockpitTempC
-
-    '''
+    value = None
+    for tag in VehicleValues.TAGS:
+      value = getattr(self, tag)
+      if value is not None:
+        res[tag] = value
     if self.location is not None:
-      if self.locationTstamp is not None:
-        res[VehicleValues.TAG_LOCATION_TSTAMP] = self.locationTstamp
       res[VehicleValues.TAG_LOCATION] = self.location
-    elif self._evLocation is not None:
-      if self._evLocationTstamp is not None:
-        res[VehicleValues.TAG_LOCATION_TSTAMP] = self._evLocationTstamp
-      res[VehicleValues.TAG_LOCATION] = self._evLocation
-    '''
-
-    if self.batteryTempC is not None:
-      res[VehicleValues.TAG_BATTERY_TEMP_C] = self.batteryTempC
-    if self.batteryAvailNrgKwh is not None:
-      res[VehicleValues.TAG_BATTERY_AVAIL_NRG_KWH] = self.batteryAvailNrgKwh
-    if self.batteryLevelPct is not None:
-      res[VehicleValues.TAG_BATTERY_LEVEL_PCT] = self.batteryLevelPct
-
-    if self.plugged is not None:
-      res[VehicleValues.TAG_PLUGGED] = self.plugged
-    if self.charging is not None:
-      res[VehicleValues.TAG_CHARGING] = self.charging
-    if self.chargingPowerW is not None:
-      res[VehicleValues.TAG_CHARGING_POWER_W] = self.chargingPowerW
-
+      res[VehicleValues.TAG_LOCATION_TSTAMP] = self.locationTstamp
     return res
 
+  @staticmethod
+  def fromDict(valuesDict:dict) -> 'VehicleValues':
+    values:VehicleValues = VehicleValues()
+    for tag in VehicleValues.TAGS:
+      if tag in valuesDict:
+        setattr(values, tag, valuesDict[tag])
+    values.location = valuesDict.get(VehicleValues.TAG_LOCATION)
+    values.locationTstamp = valuesDict.get(VehicleValues.TAG_LOCATION_TSTAMP)
+    return values
+
+  def getKnownMask(self) -> int:
+    knownMask:int = 0
+    for field in VehicleValues.FIELDS:
+      if getattr(self, field.tag) is not None:
+        knownMask |= field.bit
+    return knownMask
+
+  def getChangedTags(self, previous:'VehicleValues', deadbands:dict[str, float]=None) -> [str]:
+    if previous is None:
+      return [tag for tag in VehicleValues.TAGS if getattr(self, tag) is not None]
+
+    changedTags:[str] = []
+    value = None
+    previousValue = None
+    deadband:float = None
+    for tag in VehicleValues.TAGS:
+      value = getattr(self, tag)
+      previousValue = getattr(previous, tag)
+      if value == previousValue:
+        continue
+      deadband = deadbands.get(tag) if deadbands is not None else None
+      if deadband is not None and \
+         value is not None and previousValue is not None and \
+         not isinstance(value, bool) and \
+         abs(value - previousValue) < deadband:
+        continue
+      changedTags.append(tag)
+    return changedTags
+
 
 class Vehicle:
+  # bumped whenever any vehicle's last values change, for caches to check against
+  valuesVersion:int = 0
+  # called with ( vehicle, values ) on every new values
+  valuesListeners:list = []
+  # called with ( vehicle ) once a reload removed it
+  removedListeners:list = []
+
   def __init__(self, type:str, settingsDict:dict=None):
     self.type:str = type
 
@@ -133,11 +359,37 @@ class Vehicle:
     self.energy:str = None
     self.registration:str = None
 
-    self.knownValues:[str] = []
-    self.newKnownValues:bool = False
+    # bits of VehicleValues.FIELDS ever seen with a value
+    self.knownMask:int = 0
 
     self.lastValues:VehicleValues = None
 
+    # discovery descriptors, rebuilt only when the metadata or the known values change
+    self.deviceKey:tuple = None
+    self.deviceSettings:DeviceSettings = None
+    self.declareMask:int = None
+    self.declareValues:[DeclareValue] = None
+    # rendered discovery of the vtrack layout, for the descriptors above and the isHA it was rendered for
+    self.declareMessagesKey:tuple = None
+    self.declareMessages:list[tuple] = None
+
+    # per broker : known values it acknowledged the discovery of
+    self.declaredMasks:dict[str, int] = {}
+    # per broker : values and time of the last full publish
+    self.publishedValues:dict[str, VehicleValues] = {}
+    self.publishedTicks:dict[str, int] = {}
+
+    self.nextPollTick:float = None
+    self.lastPollTick:float = None
+    self.pollErrorCount:int = 0
+    self.pollRateLimited:bool = False
+
+    self.endpointTimeout_s:float = 20
+    self.endpointStatuses:dict[str, EndpointStatus] = {}
+
+    # as configured, for a reload to tell whether it changed
+    self.settingsDict:dict = dict(settingsDict) if settingsDict is not None else {}
+
     if settingsDict is not None:
       if 'group' in settingsDict:
         self.group = settingsDict['group']
@@ -151,6 +403,8 @@ class Vehicle:
         self.energy = settingsDict['energy']
       if 'registration' in settingsDict:
         self.registration = settingsDict['registration']
+      if 'endpointTimeout' in settingsDict:
+        self.endpointTimeout_s = float(settingsDict['endpointTimeout'])
   
     if isStringEmpty(self.manufacturer):
       self.manufacturer = self.type
@@ -169,60 +423,463 @@ class Vehicle:
     print('{0}energy={1}'.format(tab, self.energy))
     print('{0}registration={1}'.format(tab, self.registration))
 
+  def getSettingsKey(self) -> tuple:
+    return ( self.type, self.vin )
+
+  def takeOver(self, vehicle:'Vehicle'):
+    # same vehicle under new settings : keeps what was discovered, polled and published
+    if isStringEmpty(self.model):
+      self.model = vehicle.model
+    if isStringEmpty(self.manufacturer) or self.manufacturer == self.type:
+      self.manufacturer = vehicle.manufacturer
+    if isStringEmpty(self.energy):
+      self.energy = vehicle.energy
+    if isStringEmpty(self.registration):
+      self.registration = vehicle.registration
+
+    self.knownMask = vehicle.knownMask
+    self.declaredMasks = vehicle.declaredMasks
+    # metadata changes get declared again as usual
+    self.deviceKey = vehicle.deviceKey
+    self.deviceSettings = vehicle.deviceSettings
+    self.declareMask = vehicle.declareMask
+    self.declareValues = vehicle.declareValues
+    self.declareMessagesKey = vehicle.declareMessagesKey
+    self.declareMessages = vehicle.declareMessages
+
+    self.publishedValues = vehicle.publishedValues
+    self.publishedTicks = vehicle.publishedTicks
+    self.nextPollTick = vehicle.nextPollTick
+    self.lastPollTick = vehicle.lastPollTick
+    self.pollErrorCount = vehicle.pollErrorCount
+    self.pollRateLimited = vehicle.pollRateLimited
+    self.endpointStatuses = vehicle.endpointStatuses
+
+    self.lastValues = vehicle.lastValues
+    if self.lastValues is not None:
+      self.lastValues._device = self
+
   def getKnownValues(self) -> [str]:
-    return self.knownValues if self.knownValues is not None else []
+    return [field.tag for field in VehicleValues.FIELDS if self.knownMask & field.bit]
 
-  def areNewKnownValues(self) -> bool:
-    return self.newKnownValues
+  def setKnownValues(self, knownValues:[str]):
+    self.knownMask = 0
+    for tag in knownValues:
+      if tag in VehicleValues.FIELDS_BY_TAG:
+        self.knownMask |= VehicleValues.FIELDS_BY_TAG[tag].bit
 
-  def resetNewKnownValues(self):
-    self.newKnownValues = False
+  def getDeviceKey(self) -> tuple:
+    return ( self.group, self.vin, self.manufacturer, self.model, self.registration, self.energy )
 
-  def _updateKnownValues(self, knownValues:[str], tag:str, value) -> [str]:
-    if value is not None and not tag in knownValues:
-      knownValues.append(tag)
-    return knownValues
+  def isDeclareNeeded(self, publisher:'MqttPublisher') -> bool:
+    return self.knownMask != 0 and self.declaredMasks.get(publisher.key) != self.knownMask
 
   def setLastValues(self, values:VehicleValues):
     if values is None:
       return
 
-    knownValues:[str] = self.knownValues if self.knownValues is not None else []
-    knownValuesCount:int = len(knownValues)
+    knownMask:int = self.knownMask | values.getKnownMask()
+    if knownMask != self.knownMask:
+      self.knownMask = knownMask
 
-    self._updateKnownValues(knownValues, VehicleValues.TAG_COCKPIT_ODO_KM, values.cockpitOdoKm)
-    self._updateKnownValues(knownValues, VehicleValues.TAG_COCKPIT_TEMP_C, values.cockpitTempC)
+    values._changedTags = values.getChangedTags(self.lastValues)
+    self.lastValues = values
+    Vehicle.valuesVersion += 1
 
-    '''
-    self._updateKnownValues(knownValues, VehicleValues.TAG_LOCATION_TSTAMP, values.locationTstamp)
-    self._updateKnownValues(knownValues, VehicleValues.TAG_LOCATION, values.location)
-    self._updateKnownValues(knownValues, VehicleValues.TAG_LOCATION_TSTAMP, values._evLocationTstamp)
-    self._updateKnownValues(knownValues, VehicleValues.TAG_LOCATION, values._evLocation)
-    '''
+    for listener in Vehicle.valuesListeners:
+      listener(self, values)
 
-    self._updateKnownValues(knownValues, VehicleValues.TAG_BATTERY_TEMP_C, values.batteryTempC)
-    self._updateKnownValues(knownValues, VehicleValues.TAG_BATTERY_AVAIL_NRG_KWH, values.batteryAvailNrgKwh)
-    self._updateKnownValues(knownValues, VehicleValues.TAG_BATTERY_LEVEL_PCT, values.batteryLevelPct)
+  def isKeepAliveDue(self, publisherKey:str, keepAlive_s:int, curTick:int) -> bool:
+    publishedTick:int = self.publishedTicks.get(publisherKey)
+    return keepAlive_s > 0 and publishedTick is not None and ( publishedTick + keepAlive_s ) <= curTick
 
-    self._updateKnownValues(knownValues, VehicleValues.TAG_PLUGGED, values.plugged)
-    self._updateKnownValues(knownValues, VehicleValues.TAG_CHARGING, values.charging)
-    self._updateKnownValues(knownValues, VehicleValues.TAG_CHARGING_POWER_W, values.chargingPowerW)
+  def isPublishNeeded(self, publisherKey:str, values:VehicleValues, deadbands:dict[str, float], keepAlive_s:int, curTick:int) -> bool:
+    publishedTick:int = self.publishedTicks.get(publisherKey)
+    if publishedTick is None:
+      return True
+    # keep alive due, when there is one : deadbands apply either way
+    if keepAlive_s > 0 and ( publishedTick + keepAlive_s ) <= curTick:
+      return True
+    return len(values.getChangedTags(self.publishedValues.get(publisherKey), deadbands)) > 0
 
-    if knownValuesCount != len(knownValues):
-      self.knownValues = knownValues
-      self.newKnownValues = True
-
-    self.lastValues = values
+  def setPublishedValues(self, publisherKey:str, values:VehicleValues, curTick:int):
+    self.publishedValues[publisherKey] = values
+    self.publishedTicks[publisherKey] = curTick
 
   def resetLastValues(self):
     self.lastValues = None
+    Vehicle.valuesVersion += 1
+
+  def toStateDict(self) -> dict:
+    stateDict:dict = {
+      'manufacturer': self.manufacturer,
+      'model': self.model,
+      'energy': self.energy,
+      'registration': self.registration,
+      'knownValues': self.getKnownValues(),
+      'declaredMasks': dict(self.declaredMasks),
+      'nextPollTick': self.nextPollTick
+    }
+    if self.lastValues is not None:
+      stateDict['lastValues'] = self.lastValues.toDict()
+      stateDict['updateTick'] = self.lastValues._updateTick
+      stateDict['sentTicks'] = dict(self.lastValues._sentTicks)
+    stateDict['publishedTicks'] = {key: tick for key, tick in self.publishedTicks.items() if self.publishedValues.get(key) is self.lastValues}
+    return stateDict
+
+  def fromStateDict(self, stateDict:dict):
+    # settings win over what was discovered before
+    if isStringEmpty(self.model) and not isStringEmpty(stateDict.get('model')):
+      self.model = stateDict['model']
+    if ( isStringEmpty(self.manufacturer) or self.manufacturer == self.type ) and not isStringEmpty(stateDict.get('manufacturer')):
+      self.manufacturer = stateDict['manufacturer']
+    if isStringEmpty(self.energy) and not isStringEmpty(stateDict.get('energy')):
+      self.energy = stateDict['energy']
+    if isStringEmpty(self.registration) and not isStringEmpty(stateDict.get('registration')):
+      self.registration = stateDict['registration']
+
+    self.setKnownValues(stateDict.get('knownValues', []))
+    self.declaredMasks = dict(stateDict.get('declaredMasks', {}))
+    self.nextPollTick = stateDict.get('nextPollTick')
+
+    if 'lastValues' in stateDict:
+      values:VehicleValues = VehicleValues.fromDict(stateDict['lastValues'])
+      values._updateTick = stateDict.get('updateTick')
+      values._sentTicks = dict(stateDict.get('sentTicks', {}))
+      values._device = self
+      self.lastValues = values
+      for key, tick in stateDict.get('publishedTicks', {}).items():
+        self.publishedValues[key] = values
+        self.publishedTicks[key] = tick
+
+  def toPollDict(self) -> dict:
+    # what a poll in a shard worker learnt, for the coordinator to apply
+    pollDict:dict = {
+      'manufacturer': self.manufacturer,
+      'model': self.model,
+      'energy': self.energy,
+      'registration': self.registration,
+      'pollErrorCount': self.pollErrorCount,
+      'pollRateLimited': self.pollRateLimited,
+      'endpointStatuses': {name: status.toDict() for name, status in self.endpointStatuses.items()}
+    }
+    if self.lastValues is not None:
+      pollDict['lastValues'] = self.lastValues.toDict()
+      pollDict['updateTick'] = self.lastValues._updateTick
+    return pollDict
+
+  def fromPollDict(self, pollDict:dict):
+    for key in ( 'manufacturer', 'model', 'energy', 'registration' ):
+      if not isStringEmpty(pollDict.get(key)):
+        setattr(self, key, pollDict[key])
+    self.pollErrorCount = pollDict.get('pollErrorCount', 0)
+    self.pollRateLimited = pollDict.get('pollRateLimited', False)
+    self.endpointStatuses = {name: EndpointStatus.fromDict(name, statusDict) for name, statusDict in pollDict.get('endpointStatuses', {}).items()}
+
+    updateTick:int = pollDict.get('updateTick')
+    if 'lastValues' in pollDict and updateTick is not None and \
+       ( self.lastValues is None or self.lastValues._updateTick is None or self.lastValues._updateTick < updateTick ):
+      values:VehicleValues = VehicleValues.fromDict(pollDict['lastValues'])
+      values._updateTick = updateTick
+      values._endpointStatuses = self.endpointStatuses
+      values._device = self
+      self.setLastValues(values)
+
+  def getAccountKey(self) -> str:
+    return None
+
+  def setPollSucceeded(self):
+    self.pollErrorCount = 0
+    self.pollRateLimited = False
+
+  def setPollFailed(self, rateLimited:bool=False):
+    self.pollErrorCount += 1
+    self.pollRateLimited = rateLimited
+
+  def getPollDelay(self, settings:'Settings') -> int:
+    if self.pollErrorCount > 0:
+      delay:int = min(settings.pollErrorDelay_s * ( 2 ** min(self.pollErrorCount - 1, 16) ), settings.pollMaxErrorDelay_s)
+      if self.pollRateLimited:
+        delay = max(delay, settings.pollIdleDelay_s)
+      return delay
+
+    lastValues:VehicleValues = self.lastValues
+    if lastValues is not None:
+      if lastValues.charging:
+        return settings.pollChargingDelay_s
+      if lastValues.plugged:
+        return settings.pollPluggedDelay_s
+    return settings.pollIdleDelay_s
 
   async def retrieveValues(self) -> VehicleValues:
     raise NotImplementedError("Subclasses should implement this !")
 
 
+class TokenBucket:
+  def __init__(self, rate:float, burst:int):
+    # requests per second, 0 for unlimited
+    self.rate:float = rate
+    self.burst:int = max(1, burst)
+    self.tokens:float = self.burst
+    self.tick:float = time.monotonic()
+
+  def reserve(self) -> float:
+    # tokens may go negative : each caller waits for its own turn, in order
+    curTick:float = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + ( curTick - self.tick ) * self.rate)
+    self.tick = curTick
+    self.tokens -= 1
+    return -self.tokens / self.rate if self.tokens < 0 else 0
+
+  async def acquire(self, name:str):
+    if self.rate <= 0:
+      return
+    delay_s:float = self.reserve()
+    if delay_s > 0:
+      metrics.observe('vtrack_renault_throttle_seconds', delay_s, { 'limiter': name })
+      await asyncio.sleep(delay_s)
+
+  def drain(self):
+    # upstream said too many : nothing more until a full burst worth of time went by
+    self.tokens = min(self.tokens, 0) - self.burst
+
+
+class CircuitError(Exception):
+  pass
+
+
+class CircuitBreaker:
+  STATE_CLOSED:str = 'closed'
+  STATE_OPEN:str = 'open'
+  STATE_HALF_OPEN:str = 'halfOpen'
+
+  def __init__(self, threshold:int, cooldown_s:float):
+    self.threshold:int = threshold
+    self.cooldown_s:float = cooldown_s
+    self.state:str = CircuitBreaker.STATE_CLOSED
+    self.errorCount:int = 0
+    self.openTick:float = None
+
+  def allow(self) -> bool:
+    if self.threshold <= 0 or self.state == CircuitBreaker.STATE_CLOSED:
+      return True
+    curTick:float = time.monotonic()
+    if ( self.openTick + self.cooldown_s ) <= curTick:
+      # a single probe per cooldown, the others keep failing fast until one answered
+      self.state = CircuitBreaker.STATE_HALF_OPEN
+      self.openTick = curTick
+      return True
+    return False
+
+  def setSucceeded(self):
+    self.state = CircuitBreaker.STATE_CLOSED
+    self.errorCount = 0
+
+  def setFailed(self):
+    self.errorCount += 1
+    if self.threshold > 0 and ( self.state == CircuitBreaker.STATE_HALF_OPEN or self.errorCount >= self.threshold ):
+      self.state = CircuitBreaker.STATE_OPEN
+      self.openTick = time.monotonic()
+
+
+class RenaultConnection:
+  MAX_LOGIN_AGE_s:int = 12 * 3600
+
+  def __init__(self, username:str, password:str, pool:'RenaultConnectionPool', locale:str='fr_FR'):
+    self.username:str = username
+    self.password:str = password
+    self.locale:str = locale
+
+    # shared by every vehicle of the account, and with the other accounts through the pool
+    self.pool:RenaultConnectionPool = pool
+    self.limiter:TokenBucket = TokenBucket(pool.accountRate, pool.accountBurst)
+    # 'login' or ( vin, endpoint ) -> breaker
+    self.breakers:dict[object, CircuitBreaker] = {}
+
+    # outlives event loops and web sessions : keeps gigya login token and jwt
+    self.credentialStore:CredentialStore = CredentialStore()
+    self.loginTick:int = None
+
+    self.loop:asyncio.AbstractEventLoop = None
+    self.lock:asyncio.Lock = None
+    self.websession:aiohttp.ClientSession = None
+    self.client:RenaultClient = None
+    self.accounts:dict[str, RenaultAccount] = {}
+    self.vehicles:dict[str, RenaultVehicle] = {}
+
+  @staticmethod
+  def isAuthError(excp:Exception) -> bool:
+    if isinstance(excp, (NotAuthenticatedException, AccessDeniedException)):
+      return True
+    if isinstance(excp, aiohttp.ClientResponseError) and excp.status in (401, 403):
+      return True
+    return False
+
+  @staticmethod
+  def getErrorKind(excp:Exception) -> str:
+    if isinstance(excp, asyncio.TimeoutError):
+      return 'timeout'
+    if RenaultConnection.isAuthError(excp):
+      return 'auth'
+    if RenaultConnection.isRateLimitError(excp):
+      return 'ratelimit'
+    if isinstance(excp, CircuitError):
+      return 'circuit'
+    return 'other'
+
+  @staticmethod
+  def isRateLimitError(excp:Exception) -> bool:
+    if isinstance(excp, QuotaLimitException):
+      return True
+    if isinstance(excp, aiohttp.ClientResponseError) and excp.status == 429:
+      return True
+    return False
+
+  def isLoggedIn(self) -> bool:
+    if self.loginTick is None or ( self.loginTick + RenaultConnection.MAX_LOGIN_AGE_s ) < int(time.time()):
+      return False
+    return GIGYA_LOGIN_TOKEN in self.credentialStore
+
+  def getBreaker(self, key:object) -> CircuitBreaker:
+    breaker:CircuitBreaker = self.breakers.get(key)
+    if breaker is None:
+      breaker = CircuitBreaker(self.pool.breakerThreshold, self.pool.breakerCooldown_s)
+      self.breakers[key] = breaker
+    return breaker
+
+  async def request(self, breakerKey:object, name:str, coro, timeout_s:float=None) -> object:
+    # every call upstream : breaker first, then account and global rates
+    breaker:CircuitBreaker = self.getBreaker(breakerKey)
+    if not breaker.allow():
+      coro.close()
+      raise CircuitError('{0} circuit open'.format(name))
+    await self.limiter.acquire('account')
+    await self.pool.limiter.acquire('global')
+    try:
+      result = await asyncio.wait_for(coro, timeout_s)
+    except Exception as excp:
+      # rejected logins are not worth retrying either : that is how accounts get locked
+      breaker.setFailed()
+      if RenaultConnection.isRateLimitError(excp):
+        self.limiter.drain()
+      raise
+    breaker.setSucceeded()
+    return result
+
+  def invalidate(self):
+    self.loginTick = None
+    self.accounts = {}
+    self.vehicles = {}
+
+  def _isBound(self) -> bool:
+    if self.websession is None or self.websession.closed:
+      return False
+    return self.loop is asyncio.get_running_loop()
+
+  def _bind(self):
+    # aiohttp sessions only live within the event loop they were created in
+    self.loop = asyncio.get_running_loop()
+    self.lock = asyncio.Lock()
+    self.websession = aiohttp.ClientSession()
+    self.client = RenaultClient(websession=self.websession, locale=self.locale, credential_store=self.credentialStore)
+    self.accounts = {}
+    self.vehicles = {}
+
+  async def getClient(self) -> RenaultClient:
+    if not self._isBound():
+      self._bind()
+    async with self.lock:
+      if not self.isLoggedIn():
+        startTime:float = time.monotonic()
+        try:
+          await self.request('login', 'login', self.client.session.login(self.username, self.password))
+        except Exception as excp:
+          metrics.inc('vtrack_renault_errors_total', { 'endpoint': 'login', 'kind': RenaultConnection.getErrorKind(excp) })
+          raise
+        finally:
+          metrics.observe('vtrack_renault_login_seconds', time.monotonic() - startTime)
+        self.loginTick = int(time.time())
+    return self.client
+
+  async def getAccount(self, accountId:str) -> RenaultAccount:
+    client:RenaultClient = await self.getClient()
+    account:RenaultAccount = self.accounts.get(accountId)
+    if account is None:
+      account = await client.get_api_account(accountId)
+      self.accounts[accountId] = account
+    return account
+
+  async def getVehicle(self, accountId:str, vin:str) -> RenaultVehicle:
+    await self.getClient()
+    vehicle:RenaultVehicle = self.vehicles.get(vin)
+    if vehicle is None:
+      account:RenaultAccount = await self.getAccount(accountId)
+      vehicle = await account.get_api_vehicle(vin)
+      self.vehicles[vin] = vehicle
+    return vehicle
+
+  async def close(self):
+    websession:aiohttp.ClientSession = self.websession
+    self.websession = None
+    self.client = None
+    self.accounts = {}
+    self.vehicles = {}
+    if websession is not None and not websession.closed and self.loop is asyncio.get_running_loop():
+      try:
+        await websession.close()
+      except Exception as excp:
+        pass
+
+
+class RenaultConnectionPool:
+  def __init__(self):
+    self.connections:dict[tuple, RenaultConnection] = {}
+
+    self.accountRate:float = 2
+    self.accountBurst:int = 10
+    self.limiter:TokenBucket = TokenBucket(10, 20)
+    self.breakerThreshold:int = 5
+    self.breakerCooldown_s:float = 300
+
+  def setLimits(self, accountRate:float, accountBurst:int, globalRate:float, globalBurst:int, breakerThreshold:int, breakerCooldown_s:float):
+    # only the buckets whose rate changed start over, breakers keep their state
+    if self.limiter.rate != globalRate or self.limiter.burst != max(1, globalBurst):
+      self.limiter = TokenBucket(globalRate, globalBurst)
+    accountChanged:bool = self.accountRate != accountRate or self.accountBurst != accountBurst
+    self.accountRate = accountRate
+    self.accountBurst = accountBurst
+    self.breakerThreshold = breakerThreshold
+    self.breakerCooldown_s = breakerCooldown_s
+    for connection in self.connections.values():
+      if accountChanged:
+        connection.limiter = TokenBucket(accountRate, accountBurst)
+      for breaker in connection.breakers.values():
+        breaker.threshold = breakerThreshold
+        breaker.cooldown_s = breakerCooldown_s
+
+  def get(self, username:str, password:str) -> RenaultConnection:
+    key:tuple = (username, password)
+    connection:RenaultConnection = self.connections.get(key)
+    if connection is None:
+      connection = RenaultConnection(username, password, self)
+      self.connections[key] = connection
+    return connection
+
+  async def release(self):
+    # closes web sessions, logins are kept for the next event loop
+    for connection in list(self.connections.values()):
+      await connection.close()
+
+
 class Renault(Vehicle):
-  MIN_DELAY_BETWEEN_QUERIES_s:int = 1800
+  ENDPOINT_COCKPIT:str = 'cockpit'
+  ENDPOINT_BATTERY:str = 'battery'
+  ENDPOINT_LOCATION:str = 'location'
+  ENDPOINT_DETAILS:str = 'details'
+  # a poll failed when none of these answered
+  VALUES_ENDPOINTS:[str] = [ ENDPOINT_COCKPIT, ENDPOINT_BATTERY, ENDPOINT_LOCATION ]
+
+  connections:RenaultConnectionPool = RenaultConnectionPool()
 
   def __init__(self, settingsDict:dict=None):
     super().__init__('renault', settingsDict)
@@ -254,126 +911,1633 @@ class Renault(Vehicle):
     print('{0}password={1}'.format(tab, '***' if not isStringEmpty(self.password) else ''))
     print('{0}accountId={1}'.format(tab, '***' if not isStringEmpty(self.accountId) else ''))
 
-  async def retrieveValues(self) -> VehicleValues:
-    curTick:int = int(time.time())
+  def getAccountKey(self) -> str:
+    return '{0}:{1}'.format(self.type, self.username)
 
-    lastValues:VehicleValues = self.lastValues
+  async def retrieveValues(self) -> VehicleValues:
+    connection:RenaultConnection = Renault.connections.get(self.username, self.password)
 
-    if lastValues is not None and \
-       lastValues._updateTick is not None and \
-       ( lastValues._updateTick + Renault.MIN_DELAY_BETWEEN_QUERIES_s ) > curTick:
-      return lastValues
+    try:
+      wasLoggedIn:bool = connection.isLoggedIn()
+      statuses:dict[str, EndpointStatus] = await self._retrieveValues(connection)
+      if any(RenaultConnection.isAuthError(status.error) for status in statuses.values()):
+        # login or handles reused from a previous cycle got rejected : start over once
+        connection.invalidate()
+        if wasLoggedIn:
+          statuses = await self._retrieveValues(connection)
+      failedStatuses:[EndpointStatus] = [statuses[endpoint] for endpoint in Renault.VALUES_ENDPOINTS if endpoint in statuses and not statuses[endpoint].ok]
+      if len(failedStatuses) > 0 and len(failedStatuses) == len([endpoint for endpoint in Renault.VALUES_ENDPOINTS if endpoint in statuses]):
+        self.setPollFailed(any(RenaultConnection.isRateLimitError(status.error) for status in failedStatuses))
+      else:
+        self.setPollSucceeded()
+    except Exception as excp:
+      if RenaultConnection.isAuthError(excp):
+        connection.invalidate()
+      self.setPollFailed(RenaultConnection.isRateLimitError(excp))
 
-    websession: aiohttp.ClientSession = None
+    return self.lastValues
 
+  async def _fetchEndpoint(self, connection:RenaultConnection, status:EndpointStatus, coro) -> object:
+    startTime:float = time.monotonic()
     try:
-      vehicle: RenaultVehicle = None
-
-      lastValues = VehicleValues()
-      lastValues._updateTick = int(time.time())
-      lastValues._sentTick = None
-      lastValues._device = self
-
-      websession = aiohttp.ClientSession()
-      client: RenaultClient = RenaultClient(websession=websession, locale="fr_FR")
-      await client.session.login(self.username, self.password)
-
-      if not isStringEmpty(self.accountId):
-        account: RenaultAccount = await client.get_api_account(self.accountId)
-
-        if not isStringEmpty(self.vin):
-          vehicle = await account.get_api_vehicle(self.vin)
-
-          if isStringEmpty(self.manufacturer) or \
-             isStringEmpty(self.model) or \
-             isStringEmpty(self.energy) or \
-             isStringEmpty(self.registration):
-            details = await vehicle.get_details()
-            if details.brand is not None and not isStringEmpty(details.brand.label):
-              self.manufacturer = details.brand.label
-            if details.model is not None and not isStringEmpty(details.model.label):
-              self.model = details.model.label
-            if details.energy is not None and not isStringEmpty(details.energy.label):
-              self.energy = details.energy.label
-            if details.registrationNumber is not None:
-              self.registration = details.registrationNumber
-
+      result = await connection.request(( self.vin, status.name ), status.name, coro, self.endpointTimeout_s if self.endpointTimeout_s > 0 else None)
+      status.setSucceeded(time.monotonic() - startTime)
+      return result
+    except Exception as excp:
+      status.setFailed(time.monotonic() - startTime, excp)
+      metrics.inc('vtrack_renault_errors_total', { 'endpoint': status.name, 'kind': RenaultConnection.getErrorKind(excp) })
+      raise
+    finally:
+      metrics.observe('vtrack_renault_request_seconds', time.monotonic() - startTime, { 'endpoint': status.name })
+
+  def _parseDetails(self, details):
+    if details.brand is not None and not isStringEmpty(details.brand.label):
+      self.manufacturer = details.brand.label
+    if details.model is not None and not isStringEmpty(details.model.label):
+      self.model = details.model.label
+    if details.energy is not None and not isStringEmpty(details.energy.label):
+      self.energy = details.energy.label
+    if details.registrationNumber is not None:
+      self.registration = details.registrationNumber
+
+  def _parseCockpit(self, lastValues:VehicleValues, cockpit):
+    if cockpit.totalMileage is not None:
+      lastValues.cockpitOdoKm = cockpit.totalMileage
+
+  def _parseBatteryStatus(self, lastValues:VehicleValues, batteryStatus):
+    if batteryStatus.batteryTemperature:
+      lastValues.batteryTempC = batteryStatus.batteryTemperature
+    #if batteryStatus.batteryAvailableEnergy is not None:
+    #  lastValues.batteryAvailNrgKwh = batteryStatus.batteryAvailableEnergy
+    if batteryStatus.batteryLevel is not None:
+      lastValues.batteryLevelPct = batteryStatus.batteryLevel
+    if batteryStatus.plugStatus != None:
+      lastValues.plugged = ( batteryStatus.plugStatus != 0 )
+    if batteryStatus.chargingStatus != None:
+      lastValues.charging = ( batteryStatus.chargingStatus != 0.0 )
+    if batteryStatus.chargingInstantaneousPower is not None:
+      lastValues.chargingPowerW = batteryStatus.chargingInstantaneousPower
+
+  def _parseLocation(self, lastValues:VehicleValues, location):
+    if location.gpsLatitude is not None and location.gpsLongitude is not None:
+      lastValues.locationTstamp = ( int ) (datetime.datetime.strptime(location.lastUpdateTime, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+      lastValues.location = { 'latitude':location.gpsLatitude, 'longitude':location.gpsLongitude, 'gps_accuracy': 1 }
+
+  async def _retrieveValues(self, connection:RenaultConnection) -> dict[str, EndpointStatus]:
+    statuses:dict[str, EndpointStatus] = {}
+    vehicle: RenaultVehicle = None
+
+    lastValues:VehicleValues = VehicleValues()
+    lastValues._updateTick = int(time.time())
+    lastValues._sentTick = None
+    lastValues._device = self
+
+    if not isStringEmpty(self.accountId):
+      if not isStringEmpty(self.vin):
+        vehicle = await connection.getVehicle(self.accountId, self.vin)
+
+        fetches:list = [
+          ( Renault.ENDPOINT_COCKPIT, vehicle.get_cockpit, lambda result: self._parseCockpit(lastValues, result) ),
+          ( Renault.ENDPOINT_BATTERY, vehicle.get_battery_status, lambda result: self._parseBatteryStatus(lastValues, result) ),
+          ( Renault.ENDPOINT_LOCATION, vehicle.get_location, lambda result: self._parseLocation(lastValues, result) )
+        ]
+        if isStringEmpty(self.manufacturer) or \
+           isStringEmpty(self.model) or \
+           isStringEmpty(self.energy) or \
+           isStringEmpty(self.registration):
+          fetches.append(( Renault.ENDPOINT_DETAILS, vehicle.get_details, self._parseDetails ))
+
+        for endpoint, getter, parser in fetches:
+          statuses[endpoint] = EndpointStatus(endpoint)
+        results:list = await asyncio.gather(*[self._fetchEndpoint(connection, statuses[endpoint], getter()) for endpoint, getter, parser in fetches], return_exceptions=True)
+
+        for ( endpoint, getter, parser ), result in zip(fetches, results):
+          if isinstance(result, BaseException):
+            continue
           try:
-            cockpit = await vehicle.get_cockpit()
-            if cockpit.totalMileage is not None:
-              lastValues.cockpitOdoKm = cockpit.totalMileage
+            parser(result)
           except Exception as excp:
-            pass
+            statuses[endpoint].setFailed(statuses[endpoint].duration_s, excp)
+      else:
+        account:RenaultAccount = await connection.getAccount(self.accountId)
+        print(f"Vehicles: {await account.get_vehicles()}") # List available vehicles, make a note of vehicle VIN
+    else:
+      client:RenaultClient = await connection.getClient()
+      print(f"RenaultPerson: {await client.get_person()}") # List available accounts, make a note of kamereon account id
+
+    self.endpointStatuses = statuses
+
+    if any(RenaultConnection.isAuthError(status.error) for status in statuses.values()):
+      return statuses
+
+    lastValues._endpointStatuses = statuses
+    self.setLastValues(lastValues)
+    return statuses
+
+
+def loadRenault() -> type:
+  global aiohttp, RenaultClient, RenaultAccount, RenaultVehicle, CredentialStore, NotAuthenticatedException, AccessDeniedException, QuotaLimitException, GIGYA_LOGIN_TOKEN
+  import aiohttp
+  from renault_api.renault_client import RenaultClient
+  from renault_api.renault_account import RenaultAccount
+  from renault_api.renault_vehicle import RenaultVehicle
+  from renault_api.credential_store import CredentialStore
+  from renault_api.exceptions import NotAuthenticatedException
+  from renault_api.kamereon.exceptions import AccessDeniedException, QuotaLimitException
+  from renault_api.gigya import GIGYA_LOGIN_TOKEN
+  return Renault
+
+# vehicle type -> loader importing its sdk and returning its Vehicle class
+VEHICLE_TYPES:dict[str, object] = {
+  'renault': loadRenault
+}
+
+# settings section -> helpers module, imported only when the section is there
+SINK_MODULES:dict[str, str] = {
+  'mqtts': 'mqtt',
+  'httpApi': 'httpapi',
+  'httpapi': 'httpapi'
+}
+
+def getVehicleClass(vehicleDict:dict) -> type:
+  loader = VEHICLE_TYPES.get(vehicleDict['type'])
+  if loader is not None:
+    return loader()
+  # other manufacturers : 'backend': 'module:Class', that module importing its own sdk
+  if 'backend' in vehicleDict:
+    moduleName, separator, className = vehicleDict['backend'].partition(':')
+    return getattr(importlib.import_module(moduleName), className)
+  return None
+
+
+class MqttOutbox:
+  def __init__(self, settingsDict:dict=None):
+    self.path:str = None
+    self.maxSamples:int = 100000
+    self.batchSize:int = 100
 
-          try:
-            batteryStatus = await vehicle.get_battery_status()
-            if batteryStatus.batteryTemperature:
-              lastValues.batteryTempC = batteryStatus.batteryTemperature
-            #if batteryStatus.batteryAvailableEnergy is not None:
-            #  lastValues.batteryAvailNrgKwh = batteryStatus.batteryAvailableEnergy
-            if batteryStatus.batteryLevel is not None:
-              lastValues.batteryLevelPct = batteryStatus.batteryLevel
-            if batteryStatus.plugStatus != None:
-              lastValues.plugged = ( batteryStatus.plugStatus != 0 )
-            if batteryStatus.chargingStatus != None:
-              lastValues.charging = ( batteryStatus.chargingStatus != 0.0 )
-            if batteryStatus.chargingInstantaneousPower is not None:
-              lastValues.chargingPowerW = batteryStatus.chargingInstantaneousPower
-          except Exception as excp:
-            pass
+    if settingsDict is not None:
+      if 'path' in settingsDict:
+        self.path = settingsDict['path']
+      if 'maxSamples' in settingsDict:
+        self.maxSamples = max(1, int(settingsDict['maxSamples']))
+      if 'batchSize' in settingsDict:
+        self.batchSize = max(1, int(settingsDict['batchSize']))
 
-          try:
-            location = await vehicle.get_location()
-            if location.gpsLatitude is not None and location.gpsLongitude is not None:
-              lastValues._evLocationTstamp = ( int ) (datetime.datetime.strptime(location.lastUpdateTime, '%Y-%m-%dT%H:%M:%SZ').timestamp() * 1000)
-              lastValues._evLocation = { 'latitude':location.gpsLatitude, 'longitude':location.gpsLongitude, 'gps_accuracy': 1 }
-          except Exception as excp:
-            pass
+    # broker -> samples waiting, kept here not to count them on every send
+    self.counts:dict[str, int] = None
+    self.evictedCount:int = 0
+
+    # every access runs on this thread, with its single connection
+    self.executor:concurrent.futures.ThreadPoolExecutor = None
+    self.connection:sqlite3.Connection = None
+
+  def isSet(self) -> bool:
+    return not isStringEmpty(self.path)
+
+  def _open(self):
+    if self.connection is not None:
+      return
+    self.connection = sqlite3.connect(self.path, timeout=30)
+    self.connection.execute('PRAGMA journal_mode=WAL')
+    self.connection.execute('PRAGMA synchronous=NORMAL')
+    self.connection.execute('CREATE TABLE IF NOT EXISTS outbox (seq INTEGER PRIMARY KEY AUTOINCREMENT, broker TEXT NOT NULL, vin TEXT NOT NULL, tick INTEGER NOT NULL, valuesJson TEXT NOT NULL)')
+    self.connection.execute('CREATE INDEX IF NOT EXISTS outboxBroker ON outbox (broker, seq)')
+    self.connection.commit()
+    self.counts = dict(self.connection.execute('SELECT broker, COUNT(*) FROM outbox GROUP BY broker').fetchall())
+
+  async def _run(self, func, *args):
+    if self.executor is None:
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+    return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+  def _append(self, broker:str, samples:list[VehicleValues]):
+    self._open()
+    with self.connection:
+      self.connection.executemany('INSERT INTO outbox (broker, vin, tick, valuesJson) VALUES (?, ?, ?, ?)',
+                                  [( broker, values._device.vin, values._updateTick, json.dumps(values.toDict(), separators=(',', ':')) ) for values in samples])
+      count:int = self.counts.get(broker, 0) + len(samples)
+      if count > self.maxSamples:
+        # oldest first, but never the latest sample of a vehicle
+        evictedCount:int = self.connection.execute('DELETE FROM outbox WHERE seq IN ( SELECT seq FROM outbox WHERE broker = ? AND seq NOT IN ( SELECT MAX(seq) FROM outbox WHERE broker = ? GROUP BY vin ) ORDER BY seq LIMIT ? )',
+                                                   (broker, broker, count - self.maxSamples)).rowcount
+        count -= evictedCount
+        self.evictedCount += evictedCount
+        metrics.inc('vtrack_outbox_evicted_total', { 'broker': broker }, evictedCount)
+      self.counts[broker] = count
+
+  def _peek(self, broker:str) -> list[tuple]:
+    self._open()
+    return self.connection.execute('SELECT seq, vin, tick, valuesJson FROM outbox WHERE broker = ? ORDER BY seq LIMIT ?', (broker, self.batchSize)).fetchall()
+
+  def _remove(self, broker:str, untilSeq:int):
+    with self.connection:
+      removedCount:int = self.connection.execute('DELETE FROM outbox WHERE broker = ? AND seq <= ?', (broker, untilSeq)).rowcount
+      self.counts[broker] = max(0, self.counts.get(broker, 0) - removedCount)
+
+  async def append(self, broker:str, samples:list[VehicleValues]):
+    if len(samples) > 0:
+      await self._run(self._append, broker, samples)
+
+  async def peek(self, broker:str) -> list[tuple]:
+    return await self._run(self._peek, broker)
+
+  async def remove(self, broker:str, untilSeq:int):
+    await self._run(self._remove, broker, untilSeq)
+
+  async def getCount(self, broker:str) -> int:
+    if self.counts is None:
+      await self._run(self._open)
+    return self.counts.get(broker, 0)
+
+  async def close(self):
+    if self.executor is None:
+      return
+    if self.connection is not None:
+      await self._run(self.connection.close)
+      self.connection = None
+    self.executor.shutdown(wait=True)
+    self.executor = None
+
+
+class MqttHelperConnection:
+  # the shared mqtt helpers own the client and the topics and payloads : a call returns once the broker acknowledged
+  def __init__(self, mqtt:MqttSettings, timeout_s:float=10):
+    self.mqtt:MqttSettings = mqtt
+    self.timeout_s:float = timeout_s
+
+  def getDeclareMessages(self, vehicle:Vehicle, deviceSettings:DeviceSettings, declareValues:[DeclareValue]) -> list[tuple]:
+    return [( declareValues2Mqtt, ( deviceSettings, self.mqtt, declareValues ) )]
+
+  def getStateMessages(self, values:VehicleValues, deviceSettings:DeviceSettings) -> list[tuple]:
+    return [( sendValues2Mqtt, ( values, deviceSettings, self.mqtt ) )]
+
+  def publish(self, messages:list[tuple]) -> bool:
+    # blocking, on the broker thread : ( helper, args ) messages, in order, stopped by the first one not acknowledged
+    for helper, args in messages:
+      if not helper(*args):
+        return False
+    return True
+
+  def close(self):
+    pass
+
+
+class MqttConnection:
+  # qos 1 : a publish succeeded once the broker acknowledged every one of its messages
+  def __init__(self, mqtt:MqttSettings, timeout_s:float=10):
+    self.mqtt:MqttSettings = mqtt
+    self.timeout_s:float = timeout_s
+
+    # kept connected across publishes, paho's own thread doing the network and the reconnects
+    self.client = None
+    self.connected:threading.Event = threading.Event()
+
+  def getDeclareMessages(self, vehicle:Vehicle, deviceSettings:DeviceSettings, declareValues:[DeclareValue]) -> list[tuple]:
+    return vehicle2DeclareMessages(vehicle, deviceSettings, self.mqtt, declareValues)
+
+  def getStateMessages(self, values:VehicleValues, deviceSettings:DeviceSettings) -> list[tuple]:
+    return values2MqttMessages(values, deviceSettings, self.mqtt)
+
+  def _createClient(self):
+    import paho.mqtt.client as mqttClient
+    client = None
+    if hasattr(mqttClient, 'CallbackAPIVersion'):
+      client = mqttClient.Client(mqttClient.CallbackAPIVersion.VERSION2, client_id=self.mqtt.clientId if not isStringEmpty(self.mqtt.clientId) else '')
+    else:
+      client = mqttClient.Client(client_id=self.mqtt.clientId if not isStringEmpty(self.mqtt.clientId) else '')
+    if not isStringEmpty(self.mqtt.username):
+      client.username_pw_set(self.mqtt.username, self.mqtt.password)
+    client.connect_timeout = self.timeout_s
+    return client
+
+  def _onConnect(self, client, userdata, flags, reasonCode, *args):
+    if reasonCode == 0:
+      self.connected.set()
+
+  def _onDisconnect(self, client, *args):
+    self.connected.clear()
+
+  def _connect(self, deadline:float) -> bool:
+    if self.client is None:
+      # the connect itself happens on paho's thread, bounded by the socket timeout
+      self.client = self._createClient()
+      self.client.on_connect = self._onConnect
+      self.client.on_disconnect = self._onDisconnect
+      self.client.connect_async(self.mqtt.hostname, int(self.mqtt.port), 60)
+      self.client.loop_start()
+    return self.connected.wait(max(0, deadline - time.monotonic()))
+
+  def publish(self, messages:list[tuple]) -> bool:
+    # blocking, on the broker thread, never past the timeout : ( topic, payload, retain ) messages, each waited on until acknowledged
+    if len(messages) <= 0:
+      return True
+    deadline:float = time.monotonic() + self.timeout_s
+    if not self._connect(deadline):
+      print('mqtt {0}:{1} : not connected after {2}s'.format(self.mqtt.hostname, self.mqtt.port, self.timeout_s))
+      return False
+    try:
+      infos:list = [self.client.publish(topic, payload, qos=1, retain=retain) for topic, payload, retain in messages]
+      for info in infos:
+        info.wait_for_publish(max(0, deadline - time.monotonic()))
+        if not info.is_published():
+          print('mqtt {0}:{1} : no acknowledgement after {2}s'.format(self.mqtt.hostname, self.mqtt.port, self.timeout_s))
+          # given up : a fresh connection next time, nothing left in flight on a hung one
+          self.close()
+          return False
+    except ( ValueError, RuntimeError ) as excp:
+      # disconnected meanwhile
+      print('mqtt {0}:{1} : publish failed : {2}'.format(self.mqtt.hostname, self.mqtt.port, str(excp)))
+      return False
+    return True
+
+  def close(self):
+    client = self.client
+    self.client = None
+    self.connected.clear()
+    if client is not None:
+      client.disconnect()
+      client.loop_stop()
+
+
+class MqttPublisher:
+  # 'helpers' : topics and payloads of the shared mqtt helpers, as always published
+  # 'vtrack' : vtrack's own persistent client and layout, see MQTT_DISCOVERY_PREFIX
+  FORMAT_HELPERS:str = 'helpers'
+  FORMAT_VTRACK:str = 'vtrack'
+  FORMATS:[str] = [ FORMAT_HELPERS, FORMAT_VTRACK ]
+
+  def __init__(self, mqtt:MqttSettings, queueSize:int=1000, timeout_s:float=10, minRetryDelay_s:float=10, maxRetryDelay_s:float=600, outbox:MqttOutbox=None,
+               format:str=FORMAT_HELPERS):
+    self.mqtt:MqttSettings = mqtt
+    self.key:str = '{0}:{1}'.format(mqtt.hostname, mqtt.port)
+    self.queueSize:int = queueSize
+    self.timeout_s:float = timeout_s
+    self.outbox:MqttOutbox = outbox
+    self.format:str = format
+    self.connection:MqttHelperConnection|MqttConnection = MqttConnection(mqtt, timeout_s) if format == MqttPublisher.FORMAT_VTRACK else MqttHelperConnection(mqtt, timeout_s)
+    # as configured, for a reload to tell whether it changed
+    self.settingsDict:dict = None
+
+    # reconnect backoff : nothing is tried before retryTick once the broker failed
+    self.minRetryDelay_s:float = minRetryDelay_s
+    self.maxRetryDelay_s:float = maxRetryDelay_s
+    self.retryDelay_s:float = None
+    self.retryTick:float = None
+
+    self.loop:asyncio.AbstractEventLoop = None
+    self.queue:asyncio.Queue = None
+    self.worker:asyncio.Task = None
+    # one thread per broker : a hung broker only ever stalls its own queue
+    self.executor:concurrent.futures.ThreadPoolExecutor = None
+
+    self.enqueuedCount:int = 0
+    self.droppedCount:int = 0
+    self.sentCount:int = 0
+    self.failedCount:int = 0
+    self.deferredCount:int = 0
+    self.maxQueueLength:int = 0
+
+  def _isBound(self) -> bool:
+    return self.loop is asyncio.get_running_loop() and self.worker is not None and not self.worker.done()
+
+  def _bind(self):
+    self.loop = asyncio.get_running_loop()
+    self.queue = asyncio.Queue(self.queueSize)
+    if self.executor is None:
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='mqtt-' + str(self.mqtt.hostname))
+    self.worker = self.loop.create_task(self._work())
+
+  def publish(self, messagesFunc, *args) -> asyncio.Future:
+    # messagesFunc(*args) : the messages to publish, built on the loop
+    if not self._isBound():
+      self._bind()
+    future:asyncio.Future = self.loop.create_future()
+    try:
+      self.queue.put_nowait((future, messagesFunc, args))
+      self.enqueuedCount += 1
+      self.maxQueueLength = max(self.maxQueueLength, self.queue.qsize())
+    except asyncio.QueueFull:
+      # backpressure : whatever is dropped stays unsent and is retried next cycle
+      self.droppedCount += 1
+      metrics.inc('vtrack_mqtt_dropped_total', { 'broker': self.key })
+      future.set_result(False)
+    return future
+
+  def isAvailable(self, curTick:float=None) -> bool:
+    return self.retryTick is None or self.retryTick <= ( curTick if curTick is not None else time.time() )
+
+  def _setFailed(self):
+    self.retryDelay_s = min(self.retryDelay_s * 2, self.maxRetryDelay_s) if self.retryDelay_s is not None else self.minRetryDelay_s
+    self.retryTick = time.time() + self.retryDelay_s
+    print('mqtt {0} : next try in {1:.0f}s'.format(self.key, self.retryDelay_s))
+
+  def _setSucceeded(self):
+    self.retryDelay_s = None
+    self.retryTick = None
+
+  async def _work(self):
+    while True:
+      future, messagesFunc, args = await self.queue.get()
+      try:
+        if not self.isAvailable():
+          # broker down : the ones queued behind the failure wait for the backoff
+          self.deferredCount += 1
+          result:bool = False
         else:
-          print(f"Vehicles: {await account.get_vehicles()}") # List available vehicles, make a note of vehicle VIN
+          result:bool = await self._publish(messagesFunc(*args))
+          if result:
+            self.sentCount += 1
+            self._setSucceeded()
+          else:
+            self.failedCount += 1
+            self._setFailed()
+        if not future.done():
+          future.set_result(result)
+      finally:
+        self.queue.task_done()
+
+  async def _publish(self, messages:list[tuple]) -> bool:
+    startTime:float = time.monotonic()
+    result:bool = False
+    try:
+      # bounded by the connection itself, a little slack here for it to tell first
+      result = await asyncio.wait_for(self.loop.run_in_executor(self.executor, self.connection.publish, messages), self.timeout_s + 1)
+    except asyncio.TimeoutError:
+      print('mqtt {0} : no acknowledgement after {1}s'.format(self.key, self.timeout_s))
+    except Exception as excp:
+      print('mqtt {0} : publish failed : {1}'.format(self.key, str(excp)))
+    metrics.observe('vtrack_mqtt_publish_seconds', time.monotonic() - startTime, { 'broker': self.key })
+    if not result:
+      metrics.inc('vtrack_mqtt_errors_total', { 'broker': self.key })
+    return result
+
+  async def replay(self, resolveVehicle) -> bool:
+    # one batch of the backlog per cycle, in order through the broker queue : the rest waits for the next cycles
+    if not self.isAvailable() or await self.outbox.getCount(self.key) <= 0:
+      return self.isAvailable() and self.getBacklog() <= 0
+
+    rows:list[tuple] = await self.outbox.peek(self.key)
+    samples:list[tuple] = []
+    futures:list[asyncio.Future] = []
+    vehicle:Vehicle = None
+    values:VehicleValues = None
+    for seq, vin, tick, valuesJson in rows:
+      vehicle = resolveVehicle(vin)
+      if vehicle is None:
+        samples.append(( seq, None, None ))
+        continue
+      values = VehicleValues.fromDict(json.loads(valuesJson))
+      values._updateTick = tick
+      values._device = vehicle
+      samples.append(( seq, vehicle, values ))
+      futures.append(self.publish(self.connection.getStateMessages, values, vehicle2DeviceSettings(vehicle)))
+
+    results:list[bool] = iter(await asyncio.gather(*futures))
+    sentSeq:int = None
+    sentCount:int = 0
+    curTick:int = int(time.time())
+    publishedValues:VehicleValues = None
+    for seq, vehicle, values in samples:
+      if vehicle is not None:
+        # stopped by the first failure, the queue failing fast behind it
+        if not next(results):
+          break
+        sentCount += 1
+        publishedValues = vehicle.publishedValues.get(self.key)
+        if publishedValues is None or publishedValues._updateTick is None or publishedValues._updateTick <= values._updateTick:
+          vehicle.setPublishedValues(self.key, values, curTick)
+      sentSeq = seq
+    # removed from the last row sent on, whatever stayed in it after a failure
+    await self.outbox.remove(self.key, sentSeq if sentSeq is not None else -1)
+    metrics.inc('vtrack_outbox_replayed_total', { 'broker': self.key }, sentCount)
+    return self.isAvailable() and self.getBacklog() <= 0
+
+  def getQueueLength(self) -> int:
+    return self.queue.qsize() if self.queue is not None else 0
+
+  def getBacklog(self) -> int:
+    return self.outbox.counts.get(self.key, 0) if self.outbox is not None and self.outbox.counts is not None else 0
+
+  def getSentPct(self) -> float:
+    attemptCount:int = self.sentCount + self.failedCount + self.droppedCount
+    return self.sentCount * 100 / attemptCount if attemptCount > 0 else 100
+
+  def getStats(self) -> dict:
+    return {
+      'queueLength': self.getQueueLength(),
+      'maxQueueLength': self.maxQueueLength,
+      'enqueued': self.enqueuedCount,
+      'dropped': self.droppedCount,
+      'sent': self.sentCount,
+      'failed': self.failedCount,
+      'deferred': self.deferredCount,
+      'backlog': self.getBacklog(),
+      'retryDelay': self.retryDelay_s,
+      'sentPct': self.getSentPct()
+    }
+
+  async def close(self):
+    if self.worker is not None and self.loop is asyncio.get_running_loop():
+      self.worker.cancel()
+    self.worker = None
+    if self.executor is not None:
+      # after whatever publish is running, itself bounded by the timeout
+      try:
+        await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(self.executor, self.connection.close), self.timeout_s + 1)
+      except Exception as excp:
+        pass
+      self.executor.shutdown(wait=False)
+      self.executor = None
+
+
+class HistoryStore:
+  RESOLUTION_RAW:int = 0
+  RESOLUTION_5MIN:int = 300
+  RESOLUTION_HOUR:int = 3600
+
+  def __init__(self, settingsDict:dict=None):
+    self.path:str = None
+    self.rawRetention_s:int = 7 * 86400
+    self.fiveMinRetention_s:int = 90 * 86400
+    self.hourRetention_s:int = 0
+    self.maintenanceDelay_s:int = 3600
+
+    if settingsDict is not None:
+      if 'path' in settingsDict:
+        self.path = settingsDict['path']
+      if 'rawRetention' in settingsDict:
+        self.rawRetention_s = int(settingsDict['rawRetention'])
+      if 'fiveMinRetention' in settingsDict:
+        self.fiveMinRetention_s = int(settingsDict['fiveMinRetention'])
+      if 'hourRetention' in settingsDict:
+        self.hourRetention_s = int(settingsDict['hourRetention'])
+      if 'maintenanceDelay' in settingsDict:
+        self.maintenanceDelay_s = max(60, int(settingsDict['maintenanceDelay']))
+
+    self.lock:threading.Lock = threading.Lock()
+    self.pending:list[tuple] = []
+    self.storedTicks:dict[str, int] = {}
+    self.maintenanceTick:float = None
+    # per vin : earliest tick flushed since the last maintenance, for late samples to be downsampled again
+    self.flushedTicks:dict[str, int] = {}
+
+    # the writer only ever runs on this thread, readers are pooled across the request threads
+    self.executor:concurrent.futures.ThreadPoolExecutor = None
+    self.writer:sqlite3.Connection = None
+    self.readers:list[sqlite3.Connection] = []
+    self.created:bool = False
+
+  def isSet(self) -> bool:
+    return not isStringEmpty(self.path)
+
+  def _connect(self, reader:bool=False) -> sqlite3.Connection:
+    connection:sqlite3.Connection = sqlite3.connect(self.path, timeout=30, check_same_thread=not reader)
+    # the journal mode sticks to the file and the tables are there once created
+    if reader and self.created:
+      return connection
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS samples (vin TEXT NOT NULL, resolution INTEGER NOT NULL, tick INTEGER NOT NULL, count INTEGER NOT NULL, ' + \
+                       ', '.join('{0} REAL'.format(tag) for tag in VehicleValues.TAGS) + \
+                       ', PRIMARY KEY (vin, resolution, tick)) WITHOUT ROWID')
+    connection.execute('CREATE TABLE IF NOT EXISTS downsampled (resolution INTEGER PRIMARY KEY, tick INTEGER NOT NULL)')
+    connection.commit()
+    self.created = True
+    return connection
+
+  @contextlib.contextmanager
+  def _reader(self):
+    # as many connections as concurrent queries, not one per request thread
+    reader:sqlite3.Connection = None
+    with self.lock:
+      if len(self.readers) > 0:
+        reader = self.readers.pop()
+    if reader is None:
+      reader = self._connect(True)
+    try:
+      yield reader
+    finally:
+      with self.lock:
+        self.readers.append(reader)
+
+  def append(self, values:VehicleValues):
+    vehicle:Vehicle = values._device
+    if vehicle is None or isStringEmpty(vehicle.vin) or values._updateTick is None:
+      return
+    with self.lock:
+      if self.storedTicks.get(vehicle.vin, -1) >= values._updateTick:
+        return
+      self.storedTicks[vehicle.vin] = values._updateTick
+      self.pending.append(( vehicle.vin, HistoryStore.RESOLUTION_RAW, values._updateTick, 1 ) + \
+                          tuple(HistoryStore._toColumn(getattr(values, tag)) for tag in VehicleValues.TAGS))
+
+  @staticmethod
+  def _toColumn(value) -> float:
+    if isinstance(value, bool):
+      return 1 if value else 0
+    return value
+
+  def flush(self):
+    with self.lock:
+      rows:list[tuple] = self.pending
+      self.pending = []
+
+    if self.writer is None:
+      self.writer = self._connect()
+
+    if len(rows) > 0:
+      with self.writer:
+        self.writer.executemany('INSERT OR REPLACE INTO samples VALUES ({0})'.format(', '.join('?' * len(rows[0]))), rows)
+      for row in rows:
+        if row[2] < self.flushedTicks.get(row[0], row[2] + 1):
+          self.flushedTicks[row[0]] = row[2]
+
+    curTick:float = time.time()
+    if self.maintenanceTick is None or self.maintenanceTick <= curTick:
+      self.maintenanceTick = curTick + self.maintenanceDelay_s
+      self._maintain(int(curTick))
+
+  async def flushAsync(self):
+    if self.executor is None:
+      self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+    await asyncio.get_running_loop().run_in_executor(self.executor, self.flush)
+
+  def _maintain(self, curTick:int):
+    with self.writer:
+      self._downsample(HistoryStore.RESOLUTION_RAW, HistoryStore.RESOLUTION_5MIN, curTick, self.rawRetention_s)
+      self._downsample(HistoryStore.RESOLUTION_5MIN, HistoryStore.RESOLUTION_HOUR, curTick, self.fiveMinRetention_s)
+      for resolution, retention_s in ( ( HistoryStore.RESOLUTION_RAW, self.rawRetention_s ),
+                                       ( HistoryStore.RESOLUTION_5MIN, self.fiveMinRetention_s ),
+                                       ( HistoryStore.RESOLUTION_HOUR, self.hourRetention_s ) ):
+        if retention_s > 0:
+          self.writer.execute('DELETE FROM samples WHERE resolution = ? AND tick < ?', (resolution, curTick - retention_s))
+    self.flushedTicks = {}
+
+  def _downsample(self, fromResolution:int, toResolution:int, curTick:int, fromRetention_s:int):
+    # only buckets complete by now, once, unless late samples came into them since
+    untilTick:int = ( curTick // toResolution ) * toResolution
+    row:tuple = self.writer.execute('SELECT tick FROM downsampled WHERE resolution = ?', (toResolution,)).fetchone()
+    sinceTick:int = row[0] if row is not None else 0
+    # buckets partly gone with the retention are left as they were
+    keptTick:int = -( -( curTick - fromRetention_s ) // toResolution ) * toResolution if fromRetention_s > 0 else 0
+
+    selectSql:str = self._getDownsampleSql()
+    lateTick:int = None
+    for vin, flushedTick in self.flushedTicks.items():
+      lateTick = max(( flushedTick // toResolution ) * toResolution, keptTick)
+      if lateTick < min(sinceTick, untilTick):
+        self.writer.execute(selectSql + ' AND vin = ? GROUP BY vin, tick / ?',
+                            (toResolution, toResolution, toResolution, fromResolution, lateTick, min(sinceTick, untilTick), vin, toResolution))
+
+    if untilTick <= sinceTick:
+      return
+    self.writer.execute(selectSql + ' GROUP BY vin, tick / ?',
+                        (toResolution, toResolution, toResolution, fromResolution, sinceTick, untilTick, toResolution))
+    self.writer.execute('INSERT OR REPLACE INTO downsampled VALUES (?, ?)', (toResolution, untilTick))
+
+  @staticmethod
+  def _getDownsampleSql() -> str:
+    columns:[str] = []
+    # count weighted averages (booleans become the share of time) unless the field says otherwise
+    for field in VehicleValues.FIELDS:
+      if field.aggregate == 'MAX':
+        columns.append('MAX({0})'.format(field.tag))
       else:
-        print(f"RenaultPerson: {await client.get_person()}") # List available accounts, make a note of kamereon account id
+        columns.append('SUM({0} * count) / SUM(CASE WHEN {0} IS NULL THEN 0 ELSE count END)'.format(field.tag))
+    return 'INSERT OR REPLACE INTO samples SELECT vin, ?, ( tick / ? ) * ?, SUM(count), ' + ', '.join(columns) + \
+           ' FROM samples WHERE resolution = ? AND tick >= ? AND tick < ?'
+
+  def getResolution(self, startTick:int, endTick:int) -> int:
+    if ( endTick - startTick ) <= 2 * 86400:
+      return HistoryStore.RESOLUTION_RAW
+    if ( endTick - startTick ) <= 60 * 86400:
+      return HistoryStore.RESOLUTION_5MIN
+    return HistoryStore.RESOLUTION_HOUR
+
+  def query(self, vin:str, startTick:int, endTick:int, resolution:int=None) -> list[dict]:
+    if resolution is None:
+      resolution = self.getResolution(startTick, endTick)
+
+    rows:list[tuple] = None
+    with self._reader() as reader:
+      rows = reader.execute('SELECT tick, count, ' + ', '.join(VehicleValues.TAGS) + \
+                            ' FROM samples WHERE vin = ? AND resolution = ? AND tick >= ? AND tick < ? ORDER BY tick',
+                            (vin, resolution, startTick, endTick)).fetchall()
+    samples:list[dict] = []
+    sample:dict = None
+    for row in rows:
+      sample = { 'tick': row[0], 'count': row[1] }
+      for tag, value in zip(VehicleValues.TAGS, row[2:]):
+        if value is None:
+          continue
+        if resolution == HistoryStore.RESOLUTION_RAW and VehicleValues.FIELDS_BY_TAG[tag].valueType is bool:
+          value = ( value != 0 )
+        sample[tag] = value
+      samples.append(sample)
+    return samples
+
+  async def close(self):
+    await self.flushAsync()
+    self.executor.shutdown(wait=True)
+    self.executor = None
+    with self.lock:
+      readers:list[sqlite3.Connection] = self.readers
+      self.readers = []
+    for reader in readers:
+      reader.close()
+
+
+class StateStore:
+  VERSION:int = 1
+
+  def __init__(self, settingsDict:dict=None):
+    self.path:str = None
+    # one save at a time : they share the temporary file, and the last one started is the last one written
+    self.saveLock:asyncio.Lock = None
+
+    if settingsDict is not None:
+      if 'path' in settingsDict:
+        self.path = settingsDict['path']
 
-      self.setLastValues(lastValues)
+  def isSet(self) -> bool:
+    return not isStringEmpty(self.path)
+
+  def load(self, settings:'Settings') -> int:
+    if not os.path.exists(self.path):
+      return 0
+    try:
+      with open(self.path, 'r') as file:
+        stateDict:dict = json.load(file)
+    except Exception as excp:
+      print('Failed reading state file : ' + str(excp))
+      return 0
+    if stateDict.get('version') != StateStore.VERSION:
+      return 0
+
+    vehiclesDict:dict = stateDict.get('vehicles', {})
+    # published to other brokers than the current ones : publish again in full, declared masks are kept per broker
+    sameBrokers:bool = sorted(stateDict.get('brokers', [])) == sorted(publisher.key for publisher in settings.mqttPublishers)
+    loadedCount:int = 0
+    for vehicle in settings.vehicles:
+      if not isStringEmpty(vehicle.vin) and vehicle.vin in vehiclesDict:
+        vehicle.fromStateDict(vehiclesDict[vehicle.vin])
+        if not sameBrokers:
+          vehicle.publishedValues = {}
+          vehicle.publishedTicks = {}
+          if vehicle.lastValues is not None:
+            vehicle.lastValues._sentTicks = {}
+        loadedCount += 1
+    settings.updateRegistrations(settings.vehicles)
+    return loadedCount
+
+  def toDict(self, settings:'Settings') -> dict:
+    return {
+      'version': StateStore.VERSION,
+      'savedTick': int(time.time()),
+      'brokers': [publisher.key for publisher in settings.mqttPublishers],
+      'vehicles': {vehicle.vin: vehicle.toStateDict() for vehicle in settings.vehicles if not isStringEmpty(vehicle.vin)}
+    }
+
+  def write(self, stateDict:dict):
+    # never leaves a half written file behind
+    tmpPath:str = self.path + '.tmp'
+    try:
+      with open(tmpPath, 'w') as file:
+        json.dump(stateDict, file, separators=(',', ':'))
+        file.flush()
+        os.fsync(file.fileno())
+      os.replace(tmpPath, self.path)
     except Exception as excp:
+      print('Failed writing state file : ' + str(excp))
+
+  async def saveAsync(self, settings:'Settings'):
+    if self.saveLock is None:
+      self.saveLock = asyncio.Lock()
+    async with self.saveLock:
+      # taken once the previous save is done : never older than what is already on disk
+      await asyncio.to_thread(self.write, self.toDict(settings))
+
+
+class ValuesCache:
+  MIN_COMPRESS_SIZE:int = 512
+
+  def __init__(self, settings:'Settings'):
+    self.settings:'Settings' = settings
+    self.lock:threading.Lock = threading.Lock()
+
+    self.version:int = None
+    self.body:bytes = None
+    self.etag:str = None
+    self.lastModified:datetime.datetime = None
+    # encoding -> compressed body, built on first demand for the current version
+    self.encodedBodies:dict[str, bytes] = {}
+
+    self.hitCount:int = 0
+    self.missCount:int = 0
+
+  def _refresh(self):
+    version:int = Vehicle.valuesVersion
+    if self.version == version:
+      self.hitCount += 1
+      metrics.inc('vtrack_values_cache_total', { 'result': 'hit' })
+      return
+    self.missCount += 1
+    metrics.inc('vtrack_values_cache_total', { 'result': 'miss' })
+    body:bytes = json.dumps(getValuesDict(self.settings), separators=(',', ':')).encode('utf-8')
+    etag:str = hashlib.blake2b(body, digest_size=12).hexdigest()
+    if etag != self.etag:
+      self.body = body
+      self.etag = etag
+      self.lastModified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+      self.encodedBodies = {}
+    self.version = version
+
+  def get(self, acceptEncodings:list[str]=None) -> tuple:
+    with self.lock:
+      self._refresh()
+      if acceptEncodings is not None and len(self.body) >= ValuesCache.MIN_COMPRESS_SIZE:
+        for encoding in acceptEncodings:
+          if not encoding in self.encodedBodies:
+            if encoding == 'br' and brotli is not None:
+              self.encodedBodies[encoding] = brotli.compress(self.body)
+            elif encoding == 'gzip':
+              self.encodedBodies[encoding] = gzip.compress(self.body, 6)
+            else:
+              continue
+          # each representation has its own strong validator
+          return self.encodedBodies[encoding], encoding, '{0}-{1}'.format(self.etag, encoding), self.lastModified
+      return self.body, None, self.etag, self.lastModified
+
+  @staticmethod
+  def isNotModified(ifNoneMatch, ifModifiedSince:datetime.datetime, etag:str, lastModified:datetime.datetime) -> bool:
+    # If-None-Match (werkzeug ETags) wins over If-Modified-Since, naive dates being utc ones
+    if ifNoneMatch:
+      return ifNoneMatch.contains(etag)
+    if ifModifiedSince is not None and ifModifiedSince.tzinfo is None:
+      ifModifiedSince = ifModifiedSince.replace(tzinfo=datetime.timezone.utc)
+    return ifModifiedSince is not None and ifModifiedSince >= lastModified
+
+
+# stacks of the http server threads, most of them waiting in ChangeFeed.wait
+HTTP_THREAD_STACK_SIZE:int = 512 * 1024
+
+class ChangeFeed:
+  def __init__(self, maxLength:int=4096, maxWaiters:int=2000):
+    self.condition:threading.Condition = threading.Condition()
+    self.version:int = 0
+    # ( version, vin, changes ), oldest first
+    self.changes:collections.deque = collections.deque(maxlen=maxLength)
+
+    # every waiting client holds a server thread : past that many, turned away (see Settings.changesMaxWaiters)
+    self.maxWaiters:int = maxWaiters
+    self.waiterCount:int = 0
+
+  def onValues(self, vehicle:Vehicle, values:VehicleValues):
+    if isStringEmpty(vehicle.vin) or values._changedTags is None or len(values._changedTags) <= 0:
+      return
+    changes:dict = { tag: getattr(values, tag) for tag in values._changedTags }
+    with self.condition:
+      self.version += 1
+      self.changes.append(( self.version, vehicle.vin, changes ))
+      self.condition.notify_all()
+
+  def getChanges(self, since:int) -> tuple:
+    # changes merged per vehicle, or None when since cannot be replayed : too old, or from before a restart
+    with self.condition:
+      version:int = self.version
+      if since > version:
+        return version, None
+      if since == version:
+        return version, {}
+      if len(self.changes) <= 0 or self.changes[0][0] > since + 1:
+        return version, None
+      merged:dict[str, dict] = {}
+      for changeVersion, vin, changes in reversed(self.changes):
+        if changeVersion <= since:
+          break
+        vinChanges:dict = merged.setdefault(vin, {})
+        for tag, value in changes.items():
+          if not tag in vinChanges:
+            vinChanges[tag] = value
+      return version, merged
+
+  def onRemoved(self, vehicle:Vehicle):
+    with self.condition:
+      self.changes = collections.deque(( change for change in self.changes if change[1] != vehicle.vin ), maxlen=self.changes.maxlen)
+
+  def wait(self, since:int, timeout_s:float) -> int:
+    # right away for a since ahead of the version : nothing to wait for, it needs a reset
+    with self.condition:
+      self.condition.wait_for(lambda: self.version != since, timeout_s)
+      return self.version
+
+  def enter(self) -> bool:
+    with self.condition:
+      if self.waiterCount >= self.maxWaiters:
+        return False
+      self.waiterCount += 1
+      return True
+
+  def leave(self):
+    with self.condition:
+      self.waiterCount -= 1
+
+
+class VehicleSessions:
+  EARTH_RADIUS_KM:float = 6371
+
+  def __init__(self, maxSessions:int):
+    self.lastTick:int = None
+    self.lastOdoKm:float = None
+    self.lastLocation:dict = None
+    self.lastPowerW:int = None
+
+    # ongoing ones, None when parked or not charging
+    self.trip:dict = None
+    self.charge:dict = None
+    self.trips:collections.deque = collections.deque(maxlen=maxSessions)
+    self.charges:collections.deque = collections.deque(maxlen=maxSessions)
+
+  @staticmethod
+  def getDistanceKm(fromLocation:dict, toLocation:dict) -> float:
+    if fromLocation is None or toLocation is None:
+      return None
+    fromLat:float = math.radians(fromLocation['latitude'])
+    toLat:float = math.radians(toLocation['latitude'])
+    h:float = math.sin(( toLat - fromLat ) / 2) ** 2 + \
+              math.cos(fromLat) * math.cos(toLat) * math.sin(math.radians(toLocation['longitude'] - fromLocation['longitude']) / 2) ** 2
+    return 2 * VehicleSessions.EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(h)))
+
+  def append(self, values:VehicleValues):
+    # one sample at a time, in order : constant work and memory whatever the history
+    tick:int = values._updateTick
+    if tick is None or ( self.lastTick is not None and tick <= self.lastTick ):
+      return
+
+    self._trackTrip(values, tick)
+    self._trackCharge(values, tick)
+
+    self.lastTick = tick
+    if values.cockpitOdoKm is not None:
+      self.lastOdoKm = values.cockpitOdoKm
+    if values.location is not None:
+      self.lastLocation = values.location
+    if values.chargingPowerW is not None:
+      self.lastPowerW = values.chargingPowerW
+
+  def _trackTrip(self, values:VehicleValues, tick:int):
+    odoKm:float = values.cockpitOdoKm
+    if odoKm is None or self.lastOdoKm is None:
+      return
+    if odoKm > self.lastOdoKm:
+      if self.trip is None:
+        # started somewhere since the previous sample, from where that one was
+        self.trip = { 'startTick': self.lastTick, 'startOdoKm': self.lastOdoKm, 'startLocation': self.lastLocation }
+      self.trip['endTick'] = tick
+      self.trip['endOdoKm'] = odoKm
+      if values.location is not None:
+        self.trip['endLocation'] = values.location
+    elif self.trip is not None:
+      # not moving anymore : parked where this sample is
+      if values.location is not None:
+        self.trip['endLocation'] = values.location
+      self._endTrip()
+
+  def _endTrip(self):
+    trip:dict = self.trip
+    self.trip = None
+    trip['distanceKm'] = trip['endOdoKm'] - trip['startOdoKm']
+    trip['duration_s'] = trip['endTick'] - trip['startTick']
+    trip['displacementKm'] = VehicleSessions.getDistanceKm(trip['startLocation'], trip.get('endLocation'))
+    trip['avgSpeedKmh'] = trip['distanceKm'] * 3600 / trip['duration_s'] if trip['duration_s'] > 0 else None
+    self.trips.append(trip)
+
+  def _trackCharge(self, values:VehicleValues, tick:int):
+    if values.charging is None:
+      return
+    if values.charging:
+      if self.charge is None:
+        self.charge = { 'startTick': tick, 'startLevelPct': values.batteryLevelPct, 'startNrgKwh': values.batteryAvailNrgKwh, 'energyKwh': 0.0, 'maxPowerW': 0 }
+      else:
+        self._integrate(values, tick)
+      self.charge['endTick'] = tick
+      if values.chargingPowerW is not None:
+        self.charge['maxPowerW'] = max(self.charge['maxPowerW'], values.chargingPowerW)
+      self._setChargeEnd(values)
+    elif self.charge is not None:
+      # stopped since the previous sample : power fading to what this one says
+      self._integrate(values, tick)
+      self.charge['endTick'] = tick
+      self._setChargeEnd(values)
+      self._endCharge()
+
+  def _integrate(self, values:VehicleValues, tick:int):
+    # trapezoids between samples, for when the battery energy is not reported
+    powerW:int = values.chargingPowerW if values.chargingPowerW is not None else ( 0 if not values.charging else self.lastPowerW )
+    if powerW is not None and self.lastPowerW is not None:
+      self.charge['energyKwh'] += ( self.lastPowerW + powerW ) / 2 * ( tick - self.lastTick ) / 3600000
+
+  def _setChargeEnd(self, values:VehicleValues):
+    if values.batteryLevelPct is not None:
+      self.charge['endLevelPct'] = values.batteryLevelPct
+    if values.batteryAvailNrgKwh is not None:
+      self.charge['endNrgKwh'] = values.batteryAvailNrgKwh
+
+  def _endCharge(self):
+    charge:dict = self.charge
+    self.charge = None
+    charge['duration_s'] = charge['endTick'] - charge['startTick']
+    if charge.get('startNrgKwh') is not None and charge.get('endNrgKwh') is not None:
+      charge['addedKwh'] = charge['endNrgKwh'] - charge['startNrgKwh']
+    else:
+      charge['addedKwh'] = charge['energyKwh']
+    if charge.get('startLevelPct') is not None and charge.get('endLevelPct') is not None:
+      charge['addedPct'] = charge['endLevelPct'] - charge['startLevelPct']
+    charge['avgPowerW'] = charge['addedKwh'] * 3600000 / charge['duration_s'] if charge['duration_s'] > 0 else None
+    self.charges.append(charge)
+
+  def toDict(self) -> dict:
+    return {
+      'trip': dict(self.trip) if self.trip is not None else None,
+      'charge': dict(self.charge) if self.charge is not None else None,
+      'trips': list(self.trips),
+      'charges': list(self.charges)
+    }
+
+
+class SessionTracker:
+  def __init__(self, maxSessions:int=20):
+    self.maxSessions:int = maxSessions
+    self.lock:threading.Lock = threading.Lock()
+    self.vehicles:dict[str, VehicleSessions] = {}
+
+  def onValues(self, vehicle:Vehicle, values:VehicleValues):
+    if isStringEmpty(vehicle.vin) or type(values) != VehicleValues:
+      return
+    with self.lock:
+      sessions:VehicleSessions = self.vehicles.get(vehicle.vin)
+      if sessions is None:
+        sessions = VehicleSessions(self.maxSessions)
+        self.vehicles[vehicle.vin] = sessions
+      sessions.append(values)
+
+  def onRemoved(self, vehicle:Vehicle):
+    with self.lock:
+      self.vehicles.pop(vehicle.vin, None)
+
+  def getSessionsDict(self, vin:str) -> dict:
+    with self.lock:
+      sessions:VehicleSessions = self.vehicles.get(vin)
+      return sessions.toDict() if sessions is not None else None
+
+
+class ValuesExport:
+  FORMATS:[str] = [ 'ndjson', 'csv' ]
+  COLUMNS:[str] = [ 'vin', 'registration', 'group', 'manufacturer', 'model', 'energy', 'updateTick' ]
+  FIELDS:[str] = VehicleValues.TAGS + [ VehicleValues.TAG_LOCATION ]
+
+  def __init__(self, file, format:str='ndjson', fields:[str]=None):
+    self.file = file
+    self.format:str = format
+    self.fields:[str] = fields if fields is not None and len(fields) > 0 else ValuesExport.FIELDS
+    self.csvWriter = None
+    self.count:int = 0
+    if self.format == 'csv':
+      # header up front : there even when no vehicle answered
+      self.csvWriter = csv.writer(self.file, lineterminator='\n')
+      self.csvWriter.writerow(ValuesExport.COLUMNS + [field for field in self.fields if field != VehicleValues.TAG_LOCATION] +
+                              ( [ 'latitude', 'longitude', VehicleValues.TAG_LOCATION_TSTAMP ] if VehicleValues.TAG_LOCATION in self.fields else [] ))
+      self.file.flush()
+
+  def write(self, vehicle:Vehicle, values:VehicleValues):
+    # one line per vehicle, written out right away : nothing kept once written
+    valuesDict:dict = values.toDict() if values is not None else {}
+    if self.format == 'csv':
+      itemDict:dict = vehicle2ValuesDict(vehicle, valuesDict)
+      row:list = [itemDict[column] for column in ValuesExport.COLUMNS]
+      row += [valuesDict.get(field) for field in self.fields if field != VehicleValues.TAG_LOCATION]
+      if VehicleValues.TAG_LOCATION in self.fields:
+        location:dict = valuesDict.get(VehicleValues.TAG_LOCATION) or {}
+        row += [location.get('latitude'), location.get('longitude'), valuesDict.get(VehicleValues.TAG_LOCATION_TSTAMP)]
+      self.csvWriter.writerow(row)
+    else:
+      if self.fields is not ValuesExport.FIELDS:
+        valuesDict = {field: valuesDict[field] for field in self.fields if field in valuesDict}
+      self.file.write(json.dumps(vehicle2ValuesDict(vehicle, valuesDict), separators=(',', ':')) + '\n')
+    self.file.flush()
+    self.count += 1
+
+
+class ShardPool:
+  # on top of the poll timeouts inside the worker, before its batch counts as failed
+  REPLY_MARGIN_s:int = 30
+  READ_SIZE:int = 65536
+
+  def __init__(self, shardCount:int, shardBy:str='account'):
+    self.shardCount:int = shardCount
+    # 'account' keeps logins and per account limits within one worker
+    self.shardBy:str = shardBy
+
+    self.settings:'Settings' = None
+    # what the workers build their own settings from, the latest reloaded one included
+    self.settingsDict:dict = None
+    self.context:multiprocessing.context.BaseContext = None
+    self.processes:list[multiprocessing.Process] = []
+    # coordinator ends : commands written to, results read from
+    self.commandConnections:list = []
+    self.resultConnections:list = []
+    # bytes read but not a whole message yet
+    self.buffers:list[bytearray] = []
+    self.alive:list[bool] = []
+
+    self.loop:asyncio.AbstractEventLoop = None
+    self.requestSeq:int = 0
+    # request id -> ( future, shard index )
+    self.pending:dict[int, tuple] = {}
+
+  def getShardIndex(self, vehicle:Vehicle) -> int:
+    key:str = vehicle.getAccountKey() if self.shardBy == 'account' else None
+    if key is None:
+      key = vehicle.vin
+    return zlib.crc32(key.encode('utf-8')) % self.shardCount
+
+  def isStarted(self) -> bool:
+    return len(self.processes) > 0
+
+  def start(self, settings:'Settings'):
+    # workers are forked by a fork server, itself started here before any thread exists : a worker started
+    # later on never inherits a lock some coordinator thread held, only the settings dict and its pipe ends
+    self.settings = settings
+    self.settingsDict = settings.settingsDict
+    self.context = multiprocessing.get_context('forkserver')
+    for shardIndex in range(self.shardCount):
+      self.processes.append(None)
+      self.commandConnections.append(None)
+      self.resultConnections.append(None)
+      self.buffers.append(bytearray())
+      self.alive.append(False)
+      self._spawn(shardIndex)
+
+  def _spawn(self, shardIndex:int):
+    commandReader, commandWriter = self.context.Pipe(duplex=False)
+    resultReader, resultWriter = self.context.Pipe(duplex=False)
+    process:multiprocessing.Process = self.context.Process(target=runShard, name='vtrack-shard-{0}'.format(shardIndex), daemon=True,
+                                                           args=(self.settingsDict, commandReader, resultWriter))
+    process.start()
+    commandReader.close()
+    resultWriter.close()
+    # results are read as they come, whole messages only : the event loop never waits on a worker
+    os.set_blocking(resultReader.fileno(), False)
+    self.processes[shardIndex] = process
+    self.commandConnections[shardIndex] = commandWriter
+    self.resultConnections[shardIndex] = resultReader
+    self.buffers[shardIndex] = bytearray()
+    self.alive[shardIndex] = True
+    if self.loop is not None:
+      self.loop.add_reader(resultReader.fileno(), self._onReadable, shardIndex)
+
+  def _respawn(self):
+    # a worker that exited is started again off the current settings, logins start over
+    for shardIndex, process in enumerate(self.processes):
+      if self.alive[shardIndex] and process.is_alive():
+        continue
+      if self.alive[shardIndex]:
+        self._setGone(shardIndex)
+      process.join(0)
+      print('Shard {0} : worker exited with {1}, started again'.format(shardIndex, process.exitcode))
+      self._spawn(shardIndex)
+
+  def _bind(self):
+    self.loop = asyncio.get_running_loop()
+    for shardIndex, connection in enumerate(self.resultConnections):
+      if self.alive[shardIndex]:
+        self.loop.add_reader(connection.fileno(), self._onReadable, shardIndex)
+
+  def _setGone(self, shardIndex:int):
+    if self.loop is not None:
+      self.loop.remove_reader(self.resultConnections[shardIndex].fileno())
+    self.alive[shardIndex] = False
+    for connection in ( self.commandConnections[shardIndex], self.resultConnections[shardIndex] ):
+      try:
+        connection.close()
+      except OSError:
+        pass
+    for requestId, ( future, index ) in list(self.pending.items()):
+      if index == shardIndex:
+        del self.pending[requestId]
+        if not future.done():
+          future.set_result({})
+
+  def _onReadable(self, shardIndex:int):
+    buffer:bytearray = self.buffers[shardIndex]
+    chunk:bytes = None
+    try:
+      while True:
+        chunk = os.read(self.resultConnections[shardIndex].fileno(), ShardPool.READ_SIZE)
+        if len(chunk) <= 0:
+          raise EOFError()
+        buffer += chunk
+    except BlockingIOError:
       pass
-    finally:
+    except ( EOFError, OSError ):
+      print('Shard {0} : worker gone, started again on the next poll'.format(shardIndex))
+      self._setGone(shardIndex)
+      return
+
+    message:tuple = None
+    for message in ShardPool.readMessages(buffer):
+      future, index = self.pending.pop(message[1], ( None, None ))
+      if future is not None and not future.done():
+        future.set_result(message[2])
+
+  @staticmethod
+  def readMessages(buffer:bytearray) -> list:
+    # the framing Connection.send writes : a signed length, -1 when a 64 bits one follows
+    messages:list = []
+    size:int = None
+    offset:int = None
+    while len(buffer) >= 4:
+      size, = struct.unpack('!i', buffer[:4])
+      offset = 4
+      if size == -1:
+        if len(buffer) < 12:
+          break
+        size, = struct.unpack('!Q', buffer[4:12])
+        offset = 12
+      if len(buffer) < offset + size:
+        break
+      messages.append(pickle.loads(buffer[offset:offset + size]))
+      del buffer[:offset + size]
+    return messages
+
+  async def poll(self, vehicles:[Vehicle]):
+    if self.loop is not asyncio.get_running_loop():
+      self._bind()
+    self._respawn()
+
+    batches:dict[int, list[Vehicle]] = {}
+    for vehicle in vehicles:
+      batches.setdefault(self.getShardIndex(vehicle), []).append(vehicle)
+
+    waits:list = []
+    future:asyncio.Future = None
+    for shardIndex, batch in batches.items():
+      future = self.loop.create_future()
+      self.requestSeq += 1
+      waits.append(self._wait(self.requestSeq, future, self.getReplyTimeout(len(batch))))
+      if not self.alive[shardIndex]:
+        future.set_result({})
+        continue
+      self.pending[self.requestSeq] = ( future, shardIndex )
       try:
-        await websession.close()
-      except Exception as excp:
+        self.commandConnections[shardIndex].send(( 'poll', self.requestSeq, [vehicle.vin for vehicle in batch] ))
+      except OSError:
+        del self.pending[self.requestSeq]
+        future.set_result({})
+
+    pollDict:dict = None
+    for batch, pollDicts in zip(batches.values(), await asyncio.gather(*waits)):
+      for vehicle in batch:
+        pollDict = pollDicts.get(vehicle.vin)
+        if pollDict is None:
+          vehicle.setPollFailed()
+        else:
+          vehicle.fromPollDict(pollDict)
+
+  def getReplyTimeout(self, vehicleCount:int) -> float:
+    # the worker polls its batch in waves of pollConcurrency, each bounded by pollTimeout
+    if self.settings.pollTimeout_s <= 0:
+      return None
+    return math.ceil(vehicleCount / max(1, self.settings.pollConcurrency)) * self.settings.pollTimeout_s + ShardPool.REPLY_MARGIN_s
+
+  async def _wait(self, requestId:int, future:asyncio.Future, timeout_s:float) -> dict:
+    try:
+      return await asyncio.wait_for(future, timeout_s)
+    except asyncio.TimeoutError:
+      # the whole batch failed, a late answer finds no one waiting
+      print('Shard poll #{0} : no answer after {1}s'.format(requestId, timeout_s))
+      self.pending.pop(requestId, None)
+      return {}
+
+  def reload(self, settingsDict:dict):
+    # every worker merges the new settings on its own, logins kept, and the ones started later begin with them
+    self.settingsDict = settingsDict
+    for shardIndex, connection in enumerate(self.commandConnections):
+      if not self.alive[shardIndex]:
+        continue
+      try:
+        connection.send(( 'reload', settingsDict ))
+      except OSError:
         pass
 
-    return self.lastValues
+  def stop(self, timeout_s:int=10):
+    for shardIndex, connection in enumerate(self.commandConnections):
+      if not self.alive[shardIndex]:
+        continue
+      try:
+        connection.send(( 'stop', ))
+        connection.close()
+      except OSError:
+        pass
+    for process in self.processes:
+      process.join(timeout_s)
+      if process.is_alive():
+        process.terminate()
+    for connection in self.resultConnections:
+      connection.close()
+    self.processes = []
+    self.commandConnections = []
+    self.resultConnections = []
+
 
 class Settings:
+  # taken over as they are by a reload
+  RELOADED:[str] = [ 'pollConcurrency', 'pollConcurrencyPerAccount', 'pollTimeout_s', 'pollChargingDelay_s', 'pollPluggedDelay_s', 'pollIdleDelay_s',
+                     'pollErrorDelay_s', 'pollMaxErrorDelay_s', 'publishTimeout_s', 'publishRetryDelay_s', 'publishMaxRetryDelay_s',
+                     'declareDelay_s', 'deadbands', 'keepAlive_s', 'refreshMinDelay_s', 'metrics' ]
+  LIMITS:[str] = [ 'accountRate', 'accountBurst', 'globalRate', 'globalBurst', 'breakerThreshold', 'breakerCooldown_s' ]
+  # settings keys a reload cannot apply
+  RESTART_KEYS:[str] = [ 'outbox', 'history', 'state', 'shards', 'shardBy', 'sessionsKept', 'changesMaxWaiters', 'publishQueueSize' ]
+
   def __init__(self, settingsDict:dict=None):
+    self.settingsDict:dict = settingsDict if settingsDict is not None else {}
     self.group:str = None
     self.vehicles:[Vehicle] = []
     self.mqtts:list[MqttSettings] = []
+    self.mqttPublishers:list[MqttPublisher] = []
+    self.outbox:MqttOutbox = None
     self.httpApi:[HttpApi] = None
+    self.history:HistoryStore = None
+    self.state:StateStore = None
+    self.shards:ShardPool = None
+
+    self.vehiclesByVin:dict[str, Vehicle] = {}
+    self.vehiclesByGroup:dict[str, list[Vehicle]] = {}
+    self.vehiclesByRegistration:dict[str, Vehicle] = {}
+    self.sortedVins:[str] = []
 
     self.loop = True
 
+    self.pollConcurrency:int = 8
+    self.pollConcurrencyPerAccount:int = 2
+    self.pollTimeout_s:int = 60
+
+    self.pollChargingDelay_s:int = 300
+    self.pollPluggedDelay_s:int = 900
+    self.pollIdleDelay_s:int = 1800
+    self.pollErrorDelay_s:int = 60
+    self.pollMaxErrorDelay_s:int = 3600
+
+    self.publishTimeout_s:float = 10
+    self.publishRetryDelay_s:int = 10
+    self.publishMaxRetryDelay_s:int = 600
+    self.publishQueueSize:int = 1000
+    self.declareDelay_s:float = 1
+
+    self.deadbands:dict[str, float] = dict(VehicleValues.DEADBANDS)
+    self.keepAlive_s:int = 3600
+
+    self.refreshMinDelay_s:int = 30
+    # long polls and streams open at once : each holds a server thread until it answers or the client leaves,
+    # past that many a 503 and a Retry-After. 2000 waiting threads take about 1GB of address space and a few MB of memory,
+    # thousands of idle clients beyond that belong behind a proxy fanning one stream out
+    self.changesMaxWaiters:int = 2000
+
+    self.metrics:bool = False
+
+    self.sessionsKept:int = 20
+
+    # Renault API protection, shared by every vehicle of an account and by all accounts
+    self.accountRate:float = 2
+    self.accountBurst:int = 10
+    self.globalRate:float = 10
+    self.globalBurst:int = 20
+    self.breakerThreshold:int = 5
+    self.breakerCooldown_s:float = 300
+
+    self.shardCount:int = 1
+    self.shardBy:str = 'account'
+
+    # seconds between checks of the settings file for changes, 0 for SIGHUP only
+    self.settingsWatch_s:float = 0
+
     if settingsDict is not None:
       if 'group' in settingsDict:
         self.group = settingsDict['group'] 
       if 'loop' in settingsDict:
         self.loop = settingsDict['loop']
+      if 'pollConcurrency' in settingsDict:
+        self.pollConcurrency = max(1, int(settingsDict['pollConcurrency']))
+      if 'pollConcurrencyPerAccount' in settingsDict:
+        self.pollConcurrencyPerAccount = max(1, int(settingsDict['pollConcurrencyPerAccount']))
+      if 'pollTimeout' in settingsDict:
+        self.pollTimeout_s = int(settingsDict['pollTimeout'])
+      if 'pollChargingDelay' in settingsDict:
+        self.pollChargingDelay_s = max(1, int(settingsDict['pollChargingDelay']))
+      if 'pollPluggedDelay' in settingsDict:
+        self.pollPluggedDelay_s = max(1, int(settingsDict['pollPluggedDelay']))
+      if 'pollIdleDelay' in settingsDict:
+        self.pollIdleDelay_s = max(1, int(settingsDict['pollIdleDelay']))
+      if 'pollErrorDelay' in settingsDict:
+        self.pollErrorDelay_s = max(1, int(settingsDict['pollErrorDelay']))
+      if 'pollMaxErrorDelay' in settingsDict:
+        self.pollMaxErrorDelay_s = max(1, int(settingsDict['pollMaxErrorDelay']))
+      if 'publishTimeout' in settingsDict:
+        self.publishTimeout_s = float(settingsDict['publishTimeout'])
+      if 'publishRetryDelay' in settingsDict:
+        self.publishRetryDelay_s = max(1, int(settingsDict['publishRetryDelay']))
+      if 'publishMaxRetryDelay' in settingsDict:
+        self.publishMaxRetryDelay_s = max(1, int(settingsDict['publishMaxRetryDelay']))
+      if 'publishQueueSize' in settingsDict:
+        self.publishQueueSize = max(1, int(settingsDict['publishQueueSize']))
+      if 'declareDelay' in settingsDict:
+        self.declareDelay_s = float(settingsDict['declareDelay'])
+      if 'deadbands' in settingsDict:
+        for tag, deadband in settingsDict['deadbands'].items():
+          if deadband is None:
+            self.deadbands.pop(tag, None)
+          else:
+            self.deadbands[tag] = float(deadband)
+      if 'keepAlive' in settingsDict:
+        self.keepAlive_s = int(settingsDict['keepAlive'])
+      if 'refreshMinDelay' in settingsDict:
+        self.refreshMinDelay_s = int(settingsDict['refreshMinDelay'])
+      if 'changesMaxWaiters' in settingsDict:
+        self.changesMaxWaiters = max(1, int(settingsDict['changesMaxWaiters']))
+      if 'metrics' in settingsDict:
+        self.metrics = settingsDict['metrics'] == True
+      if 'sessionsKept' in settingsDict:
+        self.sessionsKept = max(1, int(settingsDict['sessionsKept']))
+      if 'accountRate' in settingsDict:
+        self.accountRate = max(0, float(settingsDict['accountRate']))
+      if 'accountBurst' in settingsDict:
+        self.accountBurst = max(1, int(settingsDict['accountBurst']))
+      if 'globalRate' in settingsDict:
+        self.globalRate = max(0, float(settingsDict['globalRate']))
+      if 'globalBurst' in settingsDict:
+        self.globalBurst = max(1, int(settingsDict['globalBurst']))
+      if 'breakerThreshold' in settingsDict:
+        self.breakerThreshold = max(0, int(settingsDict['breakerThreshold']))
+      if 'breakerCooldown' in settingsDict:
+        self.breakerCooldown_s = max(1, float(settingsDict['breakerCooldown']))
+      if 'shards' in settingsDict:
+        self.shardCount = max(1, int(settingsDict['shards']))
+      if 'shardBy' in settingsDict and settingsDict['shardBy'] in ( 'account', 'vin' ):
+        self.shardBy = settingsDict['shardBy']
+      if 'settingsWatch' in settingsDict:
+        self.settingsWatch_s = max(0, float(settingsDict['settingsWatch']))
+      for key, moduleName in SINK_MODULES.items():
+        if key in settingsDict:
+          importLazily(moduleName)
       if 'vehicles' in settingsDict:
+        vehicleClass:type = None
         for vehicleDict in settingsDict['vehicles']:
           if not 'type' in vehicleDict:
             continue
           if not 'group' in vehicleDict and not isStringEmpty(self.group):
             vehicleDict['group'] = self.group
-          if vehicleDict['type'] == 'renault':
-            self.vehicles.append(Renault(vehicleDict))
+          if not 'endpointTimeout' in vehicleDict and 'endpointTimeout' in settingsDict:
+            vehicleDict['endpointTimeout'] = settingsDict['endpointTimeout']
+          vehicleClass = getVehicleClass(vehicleDict)
+          if vehicleClass is None:
+            print('settings : unknown vehicle type {0}'.format(vehicleDict['type']))
+            continue
+          self.vehicles.append(vehicleClass(vehicleDict))
+      if 'outbox' in settingsDict:
+        self.outbox = MqttOutbox(settingsDict['outbox'])
+      if self.shardCount > 1:
+        self.shards = ShardPool(self.shardCount, self.shardBy)
       if 'mqtts' in settingsDict:
         for mqttDict in settingsDict['mqtts']:
+          if not mqttDict.get('format', MqttPublisher.FORMAT_HELPERS) in MqttPublisher.FORMATS:
+            print('settings : unknown mqtt format {0}'.format(mqttDict['format']))
+            continue
           self.mqtts.append(MqttSettings(mqttDict))
+          self.mqttPublishers.append(MqttPublisher(self.mqtts[-1], self.publishQueueSize, self.publishTimeout_s,
+                                                   self.publishRetryDelay_s, self.publishMaxRetryDelay_s, self.outbox,
+                                                   mqttDict.get('format', MqttPublisher.FORMAT_HELPERS)))
+          self.mqttPublishers[-1].settingsDict = mqttDict
       if 'httpApi' in settingsDict:
         self.httpApi = HttpApiSettings(settingsDict['httpApi'])
       elif 'httpapi' in settingsDict:
         self.httpApi = HttpApiSettings(settingsDict['httpapi'])
+      if 'history' in settingsDict:
+        self.history = HistoryStore(settingsDict['history'])
+      if 'state' in settingsDict:
+        self.state = StateStore(settingsDict['state'])
+
+    self.indexVehicles()
+
+  def applyLimits(self, shardCount:int=1):
+    # a shard gets its share of the global rate, and of the account ones when accounts span shards
+    accountShare:int = shardCount if self.shardBy == 'vin' else 1
+    Renault.connections.setLimits(self.accountRate / accountShare, self.accountBurst, self.globalRate / shardCount, self.globalBurst,
+                                  self.breakerThreshold, self.breakerCooldown_s)
+
+  def indexVehicles(self):
+    # vehicles ordered by vin everywhere, for cursors to work across filters
+    # built aside and swapped in : http threads never see a partial index
+    vehiclesByVin:dict[str, Vehicle] = {}
+    vehiclesByGroup:dict[str, list[Vehicle]] = {}
+    vehiclesByRegistration:dict[str, Vehicle] = {}
+    for vehicle in sorted(self.vehicles, key=lambda vehicle: vehicle.vin if vehicle.vin is not None else ''):
+      if isStringEmpty(vehicle.vin):
+        continue
+      vehiclesByVin[vehicle.vin] = vehicle
+      vehiclesByGroup.setdefault(vehicle.group, []).append(vehicle)
+      if not isStringEmpty(vehicle.registration):
+        vehiclesByRegistration[vehicle.registration] = vehicle
+    self.vehiclesByVin = vehiclesByVin
+    self.vehiclesByGroup = vehiclesByGroup
+    self.vehiclesByRegistration = vehiclesByRegistration
+    self.sortedVins = list(vehiclesByVin.keys())
+
+  def updateRegistrations(self, vehicles:[Vehicle]):
+    # registrations discovered since : o(vehicles given), the index only copied when one is new
+    newVehicles:[Vehicle] = [vehicle for vehicle in vehicles if not isStringEmpty(vehicle.registration) and self.vehiclesByRegistration.get(vehicle.registration) is not vehicle]
+    if len(newVehicles) <= 0:
+      return
+    vehiclesByRegistration:dict[str, Vehicle] = dict(self.vehiclesByRegistration)
+    for vehicle in newVehicles:
+      vehiclesByRegistration[vehicle.registration] = vehicle
+    self.vehiclesByRegistration = vehiclesByRegistration
+
+  def mergeVehicles(self, vehicles:[Vehicle]) -> tuple:
+    # unchanged ones stay as they are, the changed ones are replaced keeping their state
+    oldVehicles:dict[tuple, Vehicle] = {vehicle.getSettingsKey(): vehicle for vehicle in self.vehicles}
+    mergedVehicles:[Vehicle] = []
+    addedVehicles:[Vehicle] = []
+    updatedVehicles:list[tuple] = []
+    oldVehicle:Vehicle = None
+    for vehicle in vehicles:
+      oldVehicle = oldVehicles.pop(vehicle.getSettingsKey(), None)
+      if oldVehicle is None:
+        addedVehicles.append(vehicle)
+      elif oldVehicle.settingsDict == vehicle.settingsDict:
+        vehicle = oldVehicle
+      else:
+        vehicle.takeOver(oldVehicle)
+        updatedVehicles.append(( oldVehicle, vehicle ))
+      mergedVehicles.append(vehicle)
+
+    self.vehicles = mergedVehicles
+    self.indexVehicles()
+    Vehicle.valuesVersion += 1
+    return addedVehicles, updatedVehicles, list(oldVehicles.values())
+
+  def mergePublishers(self, settings:'Settings') -> tuple:
+    # a broker is kept, queue and backoff and all, as long as its settings did not change
+    oldPublishers:dict[str, MqttPublisher] = {json.dumps(publisher.settingsDict, sort_keys=True): publisher for publisher in self.mqttPublishers}
+    mergedPublishers:list[MqttPublisher] = []
+    addedPublishers:list[MqttPublisher] = []
+    oldPublisher:MqttPublisher = None
+    for publisher in settings.mqttPublishers:
+      oldPublisher = oldPublishers.pop(json.dumps(publisher.settingsDict, sort_keys=True), None)
+      if oldPublisher is None:
+        publisher.outbox = self.outbox
+        addedPublishers.append(publisher)
+      else:
+        publisher = oldPublisher
+      publisher.timeout_s = settings.publishTimeout_s
+      publisher.connection.timeout_s = settings.publishTimeout_s
+      publisher.minRetryDelay_s = settings.publishRetryDelay_s
+      publisher.maxRetryDelay_s = settings.publishMaxRetryDelay_s
+      mergedPublishers.append(publisher)
+
+    self.mqttPublishers = mergedPublishers
+    self.mqtts = [publisher.mqtt for publisher in mergedPublishers]
+    return addedPublishers, list(oldPublishers.values())
+
+  def mergeValues(self, settings:'Settings', shardCount:int=1) -> [str]:
+    for name in Settings.RELOADED:
+      setattr(self, name, getattr(settings, name))
+    self.group = settings.group
+    self.settingsWatch_s = settings.settingsWatch_s
+
+    # limiters follow their new rates, breakers their new thresholds
+    if any(getattr(self, name) != getattr(settings, name) for name in Settings.LIMITS):
+      for name in Settings.LIMITS:
+        setattr(self, name, getattr(settings, name))
+      self.applyLimits(shardCount)
+
+    # against the settings started with : told again on every reload until restarted
+    restartKeys:[str] = [key for key in Settings.RESTART_KEYS if self.settingsDict.get(key) != settings.settingsDict.get(key)]
+    if ( self.httpApi is None ) != ( settings.httpApi is None ):
+      restartKeys.append('httpApi')
+    elif self.httpApi is not None:
+      # users are checked on every request : swapped in place, the server keeps running
+      self.httpApi.users = settings.httpApi.users
+      if getHttpApiDict(self.settingsDict) != getHttpApiDict(settings.settingsDict):
+        restartKeys.append('httpApi')
+    return restartKeys
+
+  def getVehicleByRegistration(self, registration:str) -> Vehicle:
+    # kept up to date by the polls : a miss is just a miss
+    vehicle:Vehicle = self.vehiclesByRegistration.get(registration)
+    if vehicle is None or vehicle.registration != registration:
+      return None
+    return vehicle
 
   def isSet(self) -> bool:
     # device is mandatory
@@ -390,6 +2554,21 @@ class Settings:
           print('settings : mqtt not set')
           return False
 
+    # history is optional
+    if self.history is not None and not self.history.isSet():
+      print('settings : history not set')
+      return False
+
+    # state is optional
+    if self.state is not None and not self.state.isSet():
+      print('settings : state not set')
+      return False
+
+    # outbox is optional
+    if self.outbox is not None and not self.outbox.isSet():
+      print('settings : outbox not set')
+      return False
+
     return True
 
 
@@ -408,6 +2587,13 @@ def readSettings(filePath:str) -> Settings:
     print('Failed reading settings file : ' + str(excp))
     return None
 
+def getHttpApiDict(settingsDict:dict) -> dict:
+  # but the users
+  httpApiDict:dict = settingsDict.get('httpApi', settingsDict.get('httpapi'))
+  if httpApiDict is None:
+    return None
+  return {key: value for key, value in httpApiDict.items() if key != 'users'}
+
 def dispSettings(settings:Settings):
   if settings.vehicles is not None:
     print('  vehicles')
@@ -417,7 +2603,7 @@ def dispSettings(settings:Settings):
 
   if settings.mqtts is not None:
     print('  mqtts')
-    for mqtt in settings.mqtts:
+    for mqtt, publisher in zip(settings.mqtts, settings.mqttPublishers):
       print('    mqtt')
       print('      hostname={0}'.format(mqtt.hostname))
       print('      port={0}'.format(mqtt.port))
@@ -425,12 +2611,41 @@ def dispSettings(settings:Settings):
       print('      username={0}'.format(mqtt.username))
       print('      password={0}'.format('***' if mqtt.password is not None and len(mqtt.password.strip()) > 0 else ''))
       print('      isHA={0}'.format(mqtt.isHA))
+      print('      format={0}'.format(publisher.format))
 
   if settings.httpApi is not None:
     print('  httpApi')
     dispHttpApiSettings(settings.httpApi, '    ')
 
+  if settings.history is not None:
+    print('  history')
+    print('    path={0}'.format(settings.history.path))
+    print('    rawRetention={0}'.format(settings.history.rawRetention_s))
+    print('    fiveMinRetention={0}'.format(settings.history.fiveMinRetention_s))
+    print('    hourRetention={0}'.format(settings.history.hourRetention_s))
+
+  if settings.state is not None:
+    print('  state')
+    print('    path={0}'.format(settings.state.path))
+
+  if settings.settingsWatch_s > 0:
+    print('  settingsWatch={0}'.format(settings.settingsWatch_s))
+
+  if settings.shards is not None:
+    print('  shards={0}'.format(settings.shards.shardCount))
+    print('  shardBy={0}'.format(settings.shards.shardBy))
+
+  if settings.outbox is not None:
+    print('  outbox')
+    print('    path={0}'.format(settings.outbox.path))
+    print('    maxSamples={0}'.format(settings.outbox.maxSamples))
+    print('    batchSize={0}'.format(settings.outbox.batchSize))
+
 def vehicle2DeviceSettings(vehicle:Vehicle) -> DeviceSettings:
+  deviceKey:tuple = vehicle.getDeviceKey()
+  if vehicle.deviceSettings is not None and vehicle.deviceKey == deviceKey:
+    return vehicle.deviceSettings
+
   deviceSettings:DeviceSettings = DeviceSettings()
   deviceSettings.group = vehicle.group
   if isStringEmpty(deviceSettings.group):
@@ -440,221 +2655,1152 @@ def vehicle2DeviceSettings(vehicle:Vehicle) -> DeviceSettings:
   deviceSettings.model = vehicle.model
   deviceSettings.name = vehicle.registration
   deviceSettings.version = vehicle.energy
+
+  # the device is part of every discovery message : declare again to every broker under the new metadata
+  if vehicle.deviceSettings is not None:
+    vehicle.declaredMasks = {}
+
+  vehicle.deviceKey = deviceKey
+  vehicle.deviceSettings = deviceSettings
   return deviceSettings
 
 def vehicle2DeclareValues(vehicle:Vehicle) -> [DeclareValue]:
-  if not vehicle.areNewKnownValues():
-    return None
+  if vehicle.declareValues is not None and vehicle.declareMask == vehicle.knownMask:
+    return vehicle.declareValues
 
   declareValues:[DeclareValue] = []
 
-  for knownValue in vehicle.knownValues:
-    if knownValue == VehicleValues.TAG_COCKPIT_ODO_KM:
-      declareValues.append(DeclareValue(name='cockpit odometer', unit='km', tag=knownValue, icon='mdi:counter', withAttrs=True))
-    elif knownValue == VehicleValues.TAG_COCKPIT_TEMP_C:
-      declareValues.append(DeclareValue(name='cockpit temperature', unit='°C', tag=knownValue))
-    elif knownValue == VehicleValues.TAG_BATTERY_TEMP_C:
-      declareValues.append(DeclareValue(name='battery temperature', unit='°C', tag=knownValue))
-    elif knownValue == VehicleValues.TAG_BATTERY_LEVEL_PCT:
-      declareValues.append(DeclareValue(name='battery level', unit='%', tag=knownValue, icon='mdi:battery'))
-    elif knownValue == VehicleValues.TAG_PLUGGED:
-      declareValues.append(DeclareValue(name='plugged', unit='', tag=knownValue, type='binary_sensor', icon='mdi:ev-plug-type2'))
-    elif knownValue == VehicleValues.TAG_CHARGING:
-      declareValues.append(DeclareValue(name='charging', unit='', tag=knownValue, type='binary_sensor', icon='mdi:battery-charging'))
-    elif knownValue == VehicleValues.TAG_CHARGING_POWER_W:
-      declareValues.append(DeclareValue(name='charging power', unit='W', tag=knownValue))
-    '''
-    elif knownValue == VehicleValues.TAG_LOCATION_TSTAMP:
-      pass
-    elif knownValue == VehicleValues.TAG_LOCATION:
-      declareValues.append(DeclareValue(name='location', unit='', tag=knownValue, type='device_tracker'))
-    '''
+  for field in VehicleValues.FIELDS:
+    if vehicle.knownMask & field.bit and field.declare is not None:
+      declareValues.append(DeclareValue(tag=field.tag, **field.declare))
 
+  vehicle.declareMask = vehicle.knownMask
+  vehicle.declareValues = declareValues
   return declareValues
 
-async def readValues(settings:Settings) -> dict[str, Values]:
-  if settings.vehicles is None or len(settings.vehicles) <= 0:
+# layout of brokers set to "format": "vtrack", the default "helpers" one being whatever the shared mqtt helpers publish :
+#   <group>/<vin>/state                                 retained json of every known value, plus updateTick
+#   homeassistant/<component>/<vin>/<tag>/config        retained discovery of each known value, when isHA
+#                                                       unique_id <vin>_<tag>, device identified by the vin
+# switching a broker over declares new entities : the ones the helpers declared are to be removed from home assistant,
+# and subscribers moved to the new state topic
+MQTT_DISCOVERY_PREFIX:str = 'homeassistant'
+
+def getMqttStateTopic(deviceSettings:DeviceSettings) -> str:
+  return '{0}/{1}/state'.format(deviceSettings.group, deviceSettings.serial)
+
+def values2MqttMessages(values:VehicleValues, deviceSettings:DeviceSettings, mqtt:MqttSettings) -> list[tuple]:
+  # one retained json state per vehicle, every declared entity picking its value out of it
+  if values._statePayload is None:
+    stateDict:dict = {}
+    value = None
+    for tag in VehicleValues.TAGS:
+      value = getattr(values, tag)
+      if value is not None:
+        stateDict[tag] = value
+    stateDict['updateTick'] = values._updateTick
+    values._statePayload = json.dumps(stateDict, separators=(',', ':'))
+  return [( getMqttStateTopic(deviceSettings), values._statePayload, True )]
+
+def vehicle2DeclareMessages(vehicle:Vehicle, deviceSettings:DeviceSettings, mqtt:MqttSettings, declareValues:[DeclareValue]) -> list[tuple]:
+  # superseded while queued : rendered as asked, not cached
+  if deviceSettings is not vehicle.deviceSettings or declareValues is not vehicle.declareValues:
+    return declareValues2MqttMessages(deviceSettings, mqtt, declareValues)
+
+  declareMessagesKey:tuple = ( vehicle.deviceKey, vehicle.declareMask, mqtt.isHA )
+  if vehicle.declareMessagesKey != declareMessagesKey:
+    vehicle.declareMessages = declareValues2MqttMessages(deviceSettings, mqtt, declareValues)
+    vehicle.declareMessagesKey = declareMessagesKey
+  return vehicle.declareMessages
+
+def declareValues2MqttMessages(deviceSettings:DeviceSettings, mqtt:MqttSettings, declareValues:[DeclareValue]) -> list[tuple]:
+  # home assistant discovery, one retained config per entity
+  if not mqtt.isHA:
+    return []
+  stateTopic:str = getMqttStateTopic(deviceSettings)
+  deviceDict:dict = {
+    'identifiers': [ deviceSettings.serial ],
+    'manufacturer': deviceSettings.manufacturer,
+    'model': deviceSettings.model,
+    'name': deviceSettings.name if not isStringEmpty(deviceSettings.name) else deviceSettings.serial,
+    'sw_version': deviceSettings.version
+  }
+  messages:list[tuple] = []
+  declare:dict = None
+  component:str = None
+  for declareValue in declareValues:
+    declare = VehicleValues.FIELDS_BY_TAG[declareValue.tag].declare or {}
+    component = declare.get('type', 'sensor')
+    configDict:dict = {
+      'name': declare.get('name', declareValue.tag),
+      'unique_id': '{0}_{1}'.format(deviceSettings.serial, declareValue.tag),
+      'state_topic': stateTopic,
+      'value_template': "{{{{ 'ON' if value_json.{0} else 'OFF' }}}}".format(declareValue.tag) if component == 'binary_sensor' else '{{{{ value_json.{0} }}}}'.format(declareValue.tag),
+      'device': deviceDict
+    }
+    if not isStringEmpty(declare.get('unit')):
+      configDict['unit_of_measurement'] = declare['unit']
+    if not isStringEmpty(declare.get('icon')):
+      configDict['icon'] = declare['icon']
+    if declare.get('withAttrs'):
+      configDict['json_attributes_topic'] = stateTopic
+    messages.append(( '{0}/{1}/{2}/{3}/config'.format(MQTT_DISCOVERY_PREFIX, component, deviceSettings.serial, declareValue.tag),
+                      json.dumps(configDict, separators=(',', ':')), True ))
+  return messages
+
+async def retrieveVehicleValues(vehicle:Vehicle, globalSemaphore:asyncio.Semaphore, accountSemaphore:asyncio.Semaphore, timeout_s:int) -> VehicleValues:
+  # account slot first, so that a busy account does not hold a global slot while waiting
+  async with accountSemaphore:
+    async with globalSemaphore:
+      try:
+        return await asyncio.wait_for(vehicle.retrieveValues(), timeout_s if timeout_s > 0 else None)
+      except asyncio.TimeoutError:
+        # cancelled inside, where nothing marked it failed : backs off like any other failure
+        vehicle.setPollFailed()
+        raise
+
+async def readValues(settings:Settings, vehicles:[Vehicle]=None) -> dict[str, Values]:
+  if vehicles is None:
+    vehicles = settings.vehicles
+  if vehicles is None or len(vehicles) <= 0:
     return None
 
-  vehicleKey:str = None
+  if settings.shards is not None and settings.shards.isStarted():
+    # polled by the shard workers, merged back into the vehicles here
+    vehicles = [vehicle for vehicle in vehicles if not isStringEmpty(vehicle.vin)]
+    await settings.shards.poll(vehicles)
+    settings.updateRegistrations(vehicles)
+    return {vehicle.vin: vehicle.lastValues for vehicle in vehicles if vehicle.lastValues is not None}
+
+  globalSemaphore:asyncio.Semaphore = asyncio.Semaphore(settings.pollConcurrency)
+  accountSemaphores:dict[str, asyncio.Semaphore] = dict()
+
+  pollVehicles:[Vehicle] = []
+  pollTasks:list = []
+  for vehicle in vehicles:
+    if isStringEmpty(vehicle.vin):
+      continue
+    accountKey:str = vehicle.getAccountKey()
+    if accountKey is None:
+      accountKey = vehicle.vin
+    if not accountKey in accountSemaphores:
+      accountSemaphores[accountKey] = asyncio.Semaphore(settings.pollConcurrencyPerAccount)
+    pollVehicles.append(vehicle)
+    pollTasks.append(retrieveVehicleValues(vehicle, globalSemaphore, accountSemaphores[accountKey], settings.pollTimeout_s))
+
+  results:list = await asyncio.gather(*pollTasks, return_exceptions=True)
+
   vehiclesValues:dict = dict()
   vehicleValues:VehicleValues = None
-  for vehicle in settings.vehicles:
-    if not isStringEmpty(vehicle.vin):
-      vehicleKey = vehicle.vin
+  for vehicle, result in zip(pollVehicles, results):
+    if isinstance(result, BaseException):
+      if isinstance(result, asyncio.TimeoutError):
+        print('Vehicle {0} : no values after {1}s'.format(vehicle.vin, settings.pollTimeout_s))
+      else:
+        print('Vehicle {0} : failed retrieving values : {1}'.format(vehicle.vin, str(result)))
+      # partial results : keep serving what we had for this one
+      vehicleValues = vehicle.lastValues
     else:
-      vehicleKey = None
-    if not isStringEmpty(vehicleKey):
-      vehicleValues = await vehicle.retrieveValues()
-      if vehicleValues is not None:
-        vehiclesValues[vehicle.vin] = vehicleValues
+      vehicleValues = result
+    if vehicleValues is not None:
+      vehiclesValues[vehicle.vin] = vehicleValues
 
+  settings.updateRegistrations(pollVehicles)
   return vehiclesValues
 
-def dispValues(values:Values):
-  pass
+async def iterValues(settings:Settings, vehicles:[Vehicle]=None, window:int=None):
+  # polled like readValues, yielded ( vehicle, values or exception ) as they come : only the window in flight, whatever the fleet size
+  if vehicles is None:
+    vehicles = settings.vehicles
+  if window is None:
+    # a few more than the concurrency : vehicles of a busy account do not hold up the others
+    window = settings.pollConcurrency * 4
+
+  globalSemaphore:asyncio.Semaphore = asyncio.Semaphore(settings.pollConcurrency)
+  accountSemaphores:dict[str, asyncio.Semaphore] = dict()
+
+  pending:dict[asyncio.Task, Vehicle] = {}
+  vehicleIter = iter(vehicles)
+  accountKey:str = None
+  try:
+    while True:
+      for vehicle in vehicleIter:
+        if isStringEmpty(vehicle.vin):
+          continue
+        accountKey = vehicle.getAccountKey()
+        if accountKey is None:
+          accountKey = vehicle.vin
+        if not accountKey in accountSemaphores:
+          accountSemaphores[accountKey] = asyncio.Semaphore(settings.pollConcurrencyPerAccount)
+        pending[asyncio.create_task(retrieveVehicleValues(vehicle, globalSemaphore, accountSemaphores[accountKey], settings.pollTimeout_s))] = vehicle
+        if len(pending) >= window:
+          break
+      if len(pending) <= 0:
+        return
+
+      done, notDone = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        yield pending.pop(task), task.exception() if task.exception() is not None else task.result()
+  finally:
+    for task in pending:
+      task.cancel()
+
+def runShard(settingsDict:dict, commands, results):
+  # a fresh process off the fork server : its own settings, no listeners, no coordinator state
+  settings:Settings = Settings(settingsDict)
+  settings.shards = None
+  settings.applyLimits(settings.shardCount)
+  try:
+    asyncio.run(serveShard(settings, commands, results))
+  except KeyboardInterrupt:
+    pass
+
+async def serveShard(settings:Settings, commands, results):
+  loop:asyncio.AbstractEventLoop = asyncio.get_running_loop()
+  tasks:set[asyncio.Task] = set()
+  try:
+    while True:
+      message:tuple = await loop.run_in_executor(None, commands.recv)
+      if message[0] == 'stop':
+        break
+      if message[0] == 'poll':
+        task:asyncio.Task = loop.create_task(pollShard(settings, results, message[1], message[2]))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+      elif message[0] == 'reload':
+        reloadShard(settings, message[1])
+  except EOFError:
+    # coordinator gone
+    pass
+  finally:
+    for task in tasks:
+      task.cancel()
+    await Renault.connections.release()
+
+def reloadShard(settings:Settings, settingsDict:dict):
+  try:
+    newSettings:Settings = Settings(settingsDict)
+    settings.mergeVehicles(newSettings.vehicles)
+    settings.mergeValues(newSettings, settings.shardCount)
+  except Exception as excp:
+    print('Shard reload failed : {0}'.format(str(excp)))
+
+async def pollShard(settings:Settings, results, requestId:int, vins:[str]):
+  vehicles:[Vehicle] = [settings.vehiclesByVin[vin] for vin in vins if vin in settings.vehiclesByVin]
+  try:
+    await readValues(settings, vehicles)
+  except Exception as excp:
+    print('Shard poll #{0} failed : {1}'.format(requestId, str(excp)))
+  results.send(( 'polled', requestId, {vehicle.vin: vehicle.toPollDict() for vehicle in vehicles} ))
+
+def dispValues(values:Values, export:ValuesExport):
+  export.write(values._device, values)
 
-def declareValues(settings:Settings) -> bool:
+async def declareValues(settings:Settings) -> bool:
   if settings.vehicles is None or len(settings.vehicles) <= 0:
     return False
 
   sentCount:int = 0
 
-  if settings.mqtts is not None and len(settings.mqtts) > 0:
+  if settings.mqttPublishers is not None and len(settings.mqttPublishers) > 0:
     declareValues:[DeclareValue]
+    deviceSettings:DeviceSettings
+    publishers:[MqttPublisher]
+    declares:[tuple] = []
+    futures:list = []
 
-    for mqtt in settings.mqtts:
-      for vehicle in settings.vehicles:
-        declareValues = vehicle2DeclareValues(vehicle)
-        if declareValues is not None and len(declareValues) > 0:
-          if declareValues2Mqtt(vehicle2DeviceSettings(vehicle), mqtt, declareValues):
-            vehicle.resetNewKnownValues()
-            sentCount += 1
-
-  if sentCount > 0:
-    time.sleep(5)
+    for vehicle in settings.vehicles:
+      # first : a metadata change means declaring again
+      deviceSettings = vehicle2DeviceSettings(vehicle)
+      publishers = [publisher for publisher in settings.mqttPublishers if vehicle.isDeclareNeeded(publisher)]
+      if len(publishers) <= 0:
+        continue
+      declareValues = vehicle2DeclareValues(vehicle)
+      if len(declareValues) <= 0:
+        continue
+      for publisher in publishers:
+        declares.append(( vehicle, publisher, vehicle.knownMask ))
+        futures.append(publisher.publish(publisher.connection.getDeclareMessages, vehicle, deviceSettings, declareValues))
+
+    sentVins:set = set()
+    for ( vehicle, publisher, knownMask ), result in zip(declares, await asyncio.gather(*futures)):
+      # declared again next cycle to the brokers that did not get it only
+      if result:
+        vehicle.declaredMasks[publisher.key] = knownMask
+        sentVins.add(vehicle.vin)
+    sentCount = len(sentVins)
+
+  # only when something new got declared : lets subscribers pick the new entities up before their states
+  if sentCount > 0 and settings.declareDelay_s > 0:
+    await asyncio.sleep(settings.declareDelay_s)
 
   return True
 
-def sendValues(values:dict[str, Values], settings:Settings) -> int:
-  sentCount:int = 0
-  if settings.mqtts and len(settings.mqtts) > 0:
-    sendCount:int = 0
-
-    for mqtt in settings.mqtts:
-      for key in values:
-        deviceValues = values[key]
-        if deviceValues is not None and \
-           deviceValues._device is not None and \
-           deviceValues._updateTick is not None:
-          if deviceValues._sentTick is None or deviceValues._updateTick > deviceValues._sentTick:
-            sendCount += 1
-            if type(deviceValues) == VehicleValues:
-              if sendValues2Mqtt(deviceValues, vehicle2DeviceSettings(deviceValues._device), mqtt):
-                deviceValues._sentTick = int(time.time())
-                sentCount += 1
-
-    if sentCount > 0:
-      time.sleep(5)
-    sentCount = sentCount * 100 / sendCount if sendCount > 0 else 100
-  else:
-    sentCount = 100
-  return sentCount
+async def sendValues(values:dict[str, Values], settings:Settings) -> dict[str, float]:
+  sentPcts:dict[str, float] = {}
+  if settings.mqttPublishers and len(settings.mqttPublishers) > 0:
+    futures:list = []
+    publishers:[MqttPublisher] = []
+    publishedValues:[Values] = []
+    sentValues:[Values] = []
+    curTick:int = int(time.time())
 
-async def readAndSendValues(settings:Settings):
-  global inProgress
+    sendCounts:dict[str, int] = {}
+    sentCounts:dict[str, int] = {}
+
+    # a broker back from an outage gets its backlog before anything newer, a down one gets nothing
+    queuedValues:dict[str, list[Values]] = {}
+    replayPublishers:[MqttPublisher] = [publisher for publisher in settings.mqttPublishers if publisher.outbox is not None]
+    for publisher, replayed in zip(replayPublishers, await asyncio.gather(*[publisher.replay(settings.vehiclesByVin.get) for publisher in replayPublishers])):
+      if not replayed:
+        queuedValues[publisher.key] = []
+
+    for key in values:
+      deviceValues = values[key]
+      if deviceValues is not None and \
+         deviceValues._device is not None and \
+         deviceValues._updateTick is not None and \
+         type(deviceValues) == VehicleValues:
+        deviceSettings:DeviceSettings = vehicle2DeviceSettings(deviceValues._device)
+        for publisher in settings.mqttPublishers:
+          sentTick:int = deviceValues._sentTicks.get(publisher.key)
+          if sentTick is not None and deviceValues._updateTick <= sentTick and \
+             ( publisher.key in queuedValues or not deviceValues._device.isKeepAliveDue(publisher.key, settings.keepAlive_s, curTick) ):
+            # no keep alive into a backlog : already waiting there
+            continue
+          if not deviceValues._device.isPublishNeeded(publisher.key, deviceValues, settings.deadbands, settings.keepAlive_s, curTick):
+            # nothing beyond deadbands since the last publish to this broker
+            deviceValues._sentTicks[publisher.key] = curTick
+            continue
+          if publisher.key in queuedValues:
+            queuedValues[publisher.key].append(deviceValues)
+            sendCounts[publisher.key] = sendCounts.get(publisher.key, 0) + 1
+            sentValues.append(deviceValues)
+            continue
+          futures.append(publisher.publish(publisher.connection.getStateMessages, deviceValues, deviceSettings))
+          publishers.append(publisher)
+          publishedValues.append(deviceValues)
+          sentValues.append(deviceValues)
+
+    for publisher, deviceValues, result in zip(publishers, publishedValues, await asyncio.gather(*futures)):
+      sendCounts[publisher.key] = sendCounts.get(publisher.key, 0) + 1
+      if result:
+        deviceValues._sentTicks[publisher.key] = curTick
+        deviceValues._device.setPublishedValues(publisher.key, deviceValues, curTick)
+        sentCounts[publisher.key] = sentCounts.get(publisher.key, 0) + 1
+      elif publisher.outbox is not None:
+        queuedValues.setdefault(publisher.key, []).append(deviceValues)
+
+    # kept on disk until the broker is back : not sent again, but not published either until replayed
+    for publisher in settings.mqttPublishers:
+      queued:list[Values] = queuedValues.get(publisher.key, [])
+      if len(queued) <= 0:
+        continue
+      try:
+        await publisher.outbox.append(publisher.key, queued)
+      except Exception as excp:
+        print('mqtt {0} : outbox append failed : {1}'.format(publisher.key, str(excp)))
+        continue
+      for deviceValues in queued:
+        deviceValues._sentTicks[publisher.key] = curTick
+
+    for publisher in settings.mqttPublishers:
+      sendCount:int = sendCounts.get(publisher.key, 0)
+      sentPcts[publisher.key] = sentCounts.get(publisher.key, 0) * 100 / sendCount if sendCount > 0 else 100
+
+    for deviceValues in sentValues:
+      if all(publisher.key in deviceValues._sentTicks for publisher in settings.mqttPublishers):
+        deviceValues._sentTick = min(deviceValues._sentTicks.values())
+  return sentPcts
+
+def getValuesDict(settings:Settings) -> dict[str, dict]:
+  lastValues:VehicleValues = None
+  allLastValues:dict[str, dict] = {}
+  for vehicle in settings.vehicles:
+    if not isStringEmpty(vehicle.registration):
+      lastValues = vehicle.lastValues
+      if lastValues is not None:
+        allLastValues[vehicle.registration] = lastValues.toDict()
+  return allLastValues
+
+QUERY_ARGS:[str] = [ 'vin', 'group', 'registration', 'energy', 'state', 'fields', 'limit', 'cursor' ]
+QUERY_STATES:dict = {
+  'charging': lambda values: values is not None and values.charging == True,
+  'plugged': lambda values: values is not None and values.plugged == True,
+  'unplugged': lambda values: values is not None and values.plugged == False,
+  'idle': lambda values: values is not None and values.plugged != True and values.charging != True
+}
+
+def selectVehicles(settings:Settings, args:dict) -> [Vehicle]:
+  vehicles:[Vehicle] = []
+  if 'vin' in args:
+    vehicles += [settings.vehiclesByVin[vin] for vin in args['vin'].split(',') if vin in settings.vehiclesByVin]
+  if 'registration' in args:
+    vehicle:Vehicle = settings.getVehicleByRegistration(args['registration'])
+    if vehicle is not None:
+      vehicles.append(vehicle)
+  if 'group' in args:
+    vehicles += settings.vehiclesByGroup.get(args['group'], [])
+  if not 'vin' in args and not 'registration' in args and not 'group' in args:
+    vehicles = list(settings.vehiclesByVin.values())
+  return list({ id(vehicle): vehicle for vehicle in vehicles }.values())
+
+def isValuesQuery(args:dict) -> bool:
+  return any(arg in args for arg in QUERY_ARGS)
+
+def queryValues(settings:Settings, args:dict) -> dict:
+  candidates:[Vehicle] = None
+  if 'vin' in args:
+    candidates = [settings.vehiclesByVin[vin] for vin in sorted(set(args['vin'].split(','))) if vin in settings.vehiclesByVin]
+  elif 'registration' in args:
+    vehicle:Vehicle = settings.getVehicleByRegistration(args['registration'])
+    candidates = [vehicle] if vehicle is not None else []
+  elif 'group' in args:
+    candidates = settings.vehiclesByGroup.get(args['group'], [])
+  else:
+    candidates = None
 
-  if inProgress:
-    return
+  state:str = args.get('state')
+  if state is not None and not state in QUERY_STATES:
+    return None
+  fields:[str] = args['fields'].split(',') if 'fields' in args else None
+  if fields is not None and any(not field in VehicleValues.TAGS for field in fields):
+    return None
+  try:
+    limit:int = min(max(1, int(args.get('limit', 100))), 1000)
+  except ValueError:
+    return None
+  cursor:str = args.get('cursor')
+
+  # start right after the cursor, o(log n) over the whole fleet
+  # one snapshot of the index : a reload may swap it meanwhile
+  vehiclesByVin:dict[str, Vehicle] = settings.vehiclesByVin
+  vins:[str] = [vehicle.vin for vehicle in candidates] if candidates is not None else settings.sortedVins
+  index:int = bisect.bisect_right(vins, cursor) if not isStringEmpty(cursor) else 0
+
+  items:list[dict] = []
+  nextCursor:str = None
+  vehicle:Vehicle = None
+  valuesDict:dict = None
+  while index < len(vins):
+    vehicle = candidates[index] if candidates is not None else vehiclesByVin.get(vins[index])
+    index += 1
+    if vehicle is None:
+      continue
+    if 'group' in args and vehicle.group != args['group']:
+      continue
+    if 'energy' in args and vehicle.energy != args['energy']:
+      continue
+    if state is not None and not QUERY_STATES[state](vehicle.lastValues):
+      continue
+    if len(items) >= limit:
+      nextCursor = items[-1]['vin']
+      break
+    valuesDict = vehicle.lastValues.toDict() if vehicle.lastValues is not None else {}
+    if fields is not None:
+      valuesDict = { field: valuesDict[field] for field in fields if field in valuesDict }
+    items.append(vehicle2ValuesDict(vehicle, valuesDict))
+
+  return { 'vehicles': items, 'next': nextCursor }
+
+def vehicle2ValuesDict(vehicle:Vehicle, valuesDict:dict) -> dict:
+  return {
+    'vin': vehicle.vin,
+    'registration': vehicle.registration,
+    'group': vehicle.group,
+    'manufacturer': vehicle.manufacturer,
+    'model': vehicle.model,
+    'energy': vehicle.energy,
+    'updateTick': vehicle.lastValues._updateTick if vehicle.lastValues is not None else None,
+    'values': valuesDict
+  }
+
+def getChangesDict(settings:Settings, changeFeed:ChangeFeed, since:int) -> dict:
+  version, changes = changeFeed.getChanges(since)
+  if changes is None:
+    # too far behind : everything, keyed the same way
+    changes = { vehicle.vin: vehicle.lastValues.toDict() for vehicle in settings.vehicles if not isStringEmpty(vehicle.vin) and vehicle.lastValues is not None }
+    return { 'version': version, 'reset': True, 'changes': changes }
+  return { 'version': version, 'changes': changes }
+
+def collectMetrics(settings:Settings):
+  # gauges read from the current state, right before rendering
+  curTick:float = time.time()
+  for vehicle in settings.vehicles:
+    if isStringEmpty(vehicle.vin):
+      continue
+    if vehicle.lastValues is not None and vehicle.lastValues._updateTick is not None:
+      metrics.set('vtrack_vehicle_data_age_seconds', curTick - vehicle.lastValues._updateTick, { 'vin': vehicle.vin })
+    metrics.set('vtrack_vehicle_poll_errors', vehicle.pollErrorCount, { 'vin': vehicle.vin })
+  openCounts:dict[str, int] = {}
+  for connection in Renault.connections.connections.values():
+    for key, breaker in connection.breakers.items():
+      endpoint:str = key[1] if isinstance(key, tuple) else key
+      openCounts[endpoint] = openCounts.get(endpoint, 0) + ( 1 if breaker.state != CircuitBreaker.STATE_CLOSED else 0 )
+  for endpoint, openCount in openCounts.items():
+    metrics.set('vtrack_renault_open_circuits', openCount, { 'endpoint': endpoint })
+  for publisher in settings.mqttPublishers:
+    metrics.set('vtrack_mqtt_queue_length', publisher.getQueueLength(), { 'broker': publisher.key })
+    metrics.set('vtrack_mqtt_sent_ratio', publisher.getSentPct() / 100, { 'broker': publisher.key })
+    metrics.set('vtrack_mqtt_backlog', publisher.getBacklog(), { 'broker': publisher.key })
+
+def getLastValues(settings:Settings) -> dict[str, Values]:
+  vehiclesValues:dict = dict()
+  for vehicle in settings.vehicles:
+    if not isStringEmpty(vehicle.vin) and vehicle.lastValues is not None:
+      vehiclesValues[vehicle.vin] = vehicle.lastValues
+  return vehiclesValues
 
+async def readAndSendValues(settings:Settings, vehicles:[Vehicle]=None) -> dict[str, float]:
+  sentPcts:dict[str, float] = {}
+  if vehicles is None or len(vehicles) > 0:
+    await readValues(settings, vehicles)
+  # every vehicle, for the ones left unsent or due a keep alive
+  values:dict[str, Values] = getLastValues(settings)
+  if settings.history is not None:
+    for key in values:
+      settings.history.append(values[key])
+    await settings.history.flushAsync()
+  if await declareValues(settings):
+    sentPcts = await sendValues(values, settings)
+    for publisher in settings.mqttPublishers:
+      if sentPcts.get(publisher.key, 100) < 100:
+        print('mqtt {0} : values sent {1:.0f}% ({2})'.format(publisher.key, sentPcts[publisher.key], publisher.getStats()))
+  else:
+      print('Values not declared correclty')
+  return sentPcts
+
+async def readAndDisplayValues(settings:Settings, export:ValuesExport) -> int:
+  failedCount:int = 0
+  async for vehicle, result in iterValues(settings):
+    if isinstance(result, BaseException):
+      if isinstance(result, asyncio.TimeoutError):
+        print('Vehicle {0} : no values after {1}s'.format(vehicle.vin, settings.pollTimeout_s))
+      else:
+        print('Vehicle {0} : failed retrieving values : {1}'.format(vehicle.vin, str(result)))
+      failedCount += 1
+      continue
+    if result is None:
+      print('Vehicle {0} : no values'.format(vehicle.vin))
+      failedCount += 1
+      continue
+    dispValues(result, export)
+    # written : not kept around, memory stays flat over the fleet
+    vehicle.resetLastValues()
+  return failedCount
+
+async def readAndDisplayValuesOnce(settings:Settings, export:ValuesExport) -> int:
   try:
-    inProgress = True
-    values:dict[str, Values] = await readValues(settings)
-    if declareValues(settings):
-      sentPct:int = sendValues(values, settings)
-      if sentPct < 100:
-        print('Values sent to only {0}% of destination(s)'.format(sentPct))
-    else:
-        print('Values not declared correclty')
-  except Exception as excp:
-    pass
+    startTime:float = time.monotonic()
+    failedCount:int = await readAndDisplayValues(settings, export)
+    print('Exported {0} vehicle(s) in {1:.1f}s, {2} failed'.format(export.count, time.monotonic() - startTime, failedCount))
+    return failedCount
   finally:
-    inProgress = False
+    await Renault.connections.release()
 
-def readAndSendValuesBlocking():
+def readAndDisplayValuesBlocking(format:str='ndjson', outputPath:str=None, fields:[str]=None) -> int:
   global settings
-  asyncio.run(readAndSendValues(settings))
+  file = open(outputPath, 'w', newline='') if not isStringEmpty(outputPath) else sys.stdout
+  try:
+    # the output gets the export alone, anything else printed meanwhile goes to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+      return asyncio.run(readAndDisplayValuesOnce(settings, ValuesExport(file, format, fields)))
+  finally:
+    if file is not sys.stdout:
+      file.close()
+
+
+class RefreshJob:
+  def __init__(self, vehicles:[Vehicle]):
+    self.id:str = uuid.uuid4().hex
+    self.vins:[str] = [vehicle.vin for vehicle in vehicles]
+    self.createTick:float = time.time()
+    self.doneTick:float = None
+    self.coalescedCount:int = 0
+    # vin -> { status, updateTick }
+    self.results:dict[str, dict] = {}
+    self.pendingCount:int = 0
+    self.doneEvent:threading.Event = threading.Event()
+
+  def setResult(self, vehicle:Vehicle, status:str):
+    self.results[vehicle.vin] = {
+      'status': status,
+      'updateTick': vehicle.lastValues._updateTick if vehicle.lastValues is not None else None
+    }
+
+  def track(self, waiters:list[tuple]):
+    # each vehicle reported as soon as its own poll ended, whatever the order
+    self.pendingCount = len(waiters)
+    for vehicle, waiter in waiters:
+      waiter.add_done_callback(lambda waiter, vehicle=vehicle: self._onWaiterDone(vehicle, waiter))
+    if self.pendingCount <= 0:
+      self._setDone()
+
+  def _onWaiterDone(self, vehicle:Vehicle, waiter:asyncio.Future):
+    self.setResult(vehicle, 'updated' if not waiter.cancelled() and waiter.result() else 'failed')
+    self.pendingCount -= 1
+    if self.pendingCount <= 0:
+      self._setDone()
+
+  def _setDone(self):
+    self.doneTick = time.time()
+    self.doneEvent.set()
+
+  def isDone(self) -> bool:
+    return self.doneEvent.is_set()
+
+  def toDict(self) -> dict:
+    return {
+      'id': self.id,
+      'done': self.isDone(),
+      'createTick': self.createTick,
+      'doneTick': self.doneTick,
+      'coalesced': self.coalescedCount,
+      'vehicles': { vin: self.results.get(vin, { 'status': 'pending' }) for vin in self.vins }
+    }
+
+
+class Service:
+  MAX_REFRESH_JOBS:int = 1000
+
+  def __init__(self, settings:Settings, settingsPath:str=None):
+    self.settings:Settings = settings
+
+    # read again on SIGHUP, or once changed when watched
+    self.settingsPath:str = settingsPath
+    self.settingsTick:float = None
+    self.watchTask:asyncio.Task = None
+    if settingsPath is not None:
+      try:
+        self.settingsTick = os.stat(settingsPath).st_mtime
+      except OSError:
+        pass
 
-async def readAndDisplayValues(settings:Settings):
-  global inProgress
+    self.loop:asyncio.AbstractEventLoop = None
+    self.thread:threading.Thread = None
+
+    # heap of ( poll tick, sequence, vehicle ), stale once vehicle.nextPollTick moved
+    self.pollQueue:list = []
+    self.pollSeq:int = 0
+    self.publishTick:float = None
+    self.wakeEvent:asyncio.Event = None
+
+    self.cycleTask:asyncio.Task = None
+    self.cyclePending:bool = False
+    self.pendingVehicles:dict[int, Vehicle] = {}
+    self.cycleCount:int = 0
+    self.coalescedCount:int = 0
+
+    # refreshes : one waiter per vehicle however many jobs wait on it
+    self.pollingVehicles:set[int] = set()
+    self.pollWaiters:dict[int, asyncio.Future] = {}
+    self.refreshJobs:collections.OrderedDict[str, RefreshJob] = collections.OrderedDict()
+
+  def start(self):
+    self.loop = asyncio.new_event_loop()
+    self.thread = threading.Thread(target=self._run, name='vtrack-loop', daemon=True)
+    self.thread.start()
+
+  def stop(self, timeout_s:int=10):
+    if self.loop is None or not self.loop.is_running():
+      return
+    try:
+      self.submit(self._close()).result(timeout_s)
+    except Exception as excp:
+      pass
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join(timeout_s)
+    if self.settings.shards is not None:
+      self.settings.shards.stop(timeout_s)
+
+  def join(self):
+    self.thread.join()
+
+  async def _close(self):
+    for publisher in self.settings.mqttPublishers:
+      await publisher.close()
+    if self.settings.outbox is not None:
+      await self.settings.outbox.close()
+    if self.settings.history is not None:
+      await self.settings.history.close()
+    if self.settings.state is not None:
+      await self.settings.state.saveAsync(self.settings)
+    await Renault.connections.release()
+
+  def submit(self, coro) -> concurrent.futures.Future:
+    # for other threads (http api, signals) to run something on the loop
+    return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+  def _run(self):
+    asyncio.set_event_loop(self.loop)
+    self.loop.create_task(self._schedule())
+    self._startWatch()
+    try:
+      self.loop.run_forever()
+    finally:
+      self.loop.close()
 
-  if inProgress:
-    return
+  def _startWatch(self):
+    if self.settingsPath is not None and self.settings.settingsWatch_s > 0 and ( self.watchTask is None or self.watchTask.done() ):
+      self.watchTask = self.loop.create_task(self._watch())
 
-  try:
-    inProgress = True
-    values:Values = await readValues(settings)
-    dispValues(values)
-  except:
-    pass
-  finally:
-    inProgress = False
+  async def _watch(self):
+    tick:float = None
+    while self.settings.settingsWatch_s > 0:
+      await asyncio.sleep(self.settings.settingsWatch_s)
+      try:
+        tick = os.stat(self.settingsPath).st_mtime
+      except OSError:
+        continue
+      if tick != self.settingsTick:
+        await self.reloadFile()
+
+  async def reloadFile(self) -> bool:
+    if self.settingsPath is None:
+      return False
+    try:
+      self.settingsTick = os.stat(self.settingsPath).st_mtime
+    except OSError:
+      pass
+    try:
+      return await self.reload(readSettings(self.settingsPath))
+    except Exception as excp:
+      print('Reload failed : {0}'.format(str(excp)))
+      return False
 
-def readAndDisplayValuesBlocking():
-  global settings
-  asyncio.run(readAndDisplayValues(settings))
+  async def reload(self, settings:Settings) -> bool:
+    # only what changed : warm values, logins and broker queues stay for everything else
+    if settings is None or not settings.isSet():
+      print('Reload : bad settings, current ones kept')
+      return False
+
+    curTick:float = time.time()
+    addedVehicles, updatedVehicles, removedVehicles = self.settings.mergeVehicles(settings.vehicles)
+    waiter:asyncio.Future = None
+    for vehicle in removedVehicles:
+      # its heap entries go stale, its refreshes end, nothing of it is kept around
+      vehicle.nextPollTick = None
+      self.pendingVehicles.pop(id(vehicle), None)
+      waiter = self.pollWaiters.pop(id(vehicle), None)
+      if waiter is not None and not waiter.done():
+        waiter.set_result(False)
+      if not isStringEmpty(vehicle.vin):
+        metrics.removeLabels({ 'vin': vehicle.vin })
+      for listener in Vehicle.removedListeners:
+        listener(vehicle)
+    for oldVehicle, vehicle in updatedVehicles:
+      oldVehicle.nextPollTick = None
+      # one being polled is handed over once its poll is done
+      if id(oldVehicle) in self.pollingVehicles or isStringEmpty(vehicle.vin):
+        continue
+      if self.pendingVehicles.pop(id(oldVehicle), None) is not None:
+        self.pendingVehicles[id(vehicle)] = vehicle
+      waiter = self.pollWaiters.pop(id(oldVehicle), None)
+      if waiter is not None:
+        self.pollWaiters[id(vehicle)] = waiter
+      self.schedulePoll(vehicle, max(curTick, vehicle.nextPollTick) if vehicle.nextPollTick is not None else curTick)
+    for vehicle in addedVehicles:
+      if not isStringEmpty(vehicle.vin):
+        self.schedulePoll(vehicle, curTick)
+
+    addedPublishers, removedPublishers = self.settings.mergePublishers(settings)
+    for publisher in removedPublishers:
+      await publisher.close()
+      for vehicle in self.settings.vehicles:
+        vehicle.publishedValues.pop(publisher.key, None)
+        vehicle.publishedTicks.pop(publisher.key, None)
+        vehicle.declaredMasks.pop(publisher.key, None)
+    if len(addedPublishers) > 0:
+      # new brokers declared nothing yet : they get the discovery and the values right away
+      self._schedulePublish(curTick)
+
+    restartKeys:[str] = self.settings.mergeValues(settings)
+    metrics.enabled = self.settings.metrics
+    if self.settings.shards is not None and self.settings.shards.isStarted():
+      self.settings.shards.reload(settings.settingsDict)
+    self._startWatch()
+    # none yet when the reload came before the scheduler started : it picks every vehicle up anyway
+    if self.wakeEvent is not None:
+      self.wakeEvent.set()
+
+    print('Reload : vehicles {0} added {1} updated {2} removed, brokers {3} added {4} removed'.format(
+          len(addedVehicles), len(updatedVehicles), len(removedVehicles), len(addedPublishers), len(removedPublishers)))
+    if len(restartKeys) > 0:
+      print('Reload : {0} only applied on restart'.format(', '.join(restartKeys)))
+
+    if self.settings.state is not None:
+      await self.settings.state.saveAsync(self.settings)
+    return True
+
+  def schedulePoll(self, vehicle:Vehicle, tick:float):
+    vehicle.nextPollTick = tick
+    self.pollSeq += 1
+    heapq.heappush(self.pollQueue, (tick, self.pollSeq, vehicle))
+    if self.wakeEvent is not None:
+      self.wakeEvent.set()
+
+  def _schedulePublish(self, tick:float):
+    if self.publishTick is None or tick < self.publishTick:
+      self.publishTick = tick
+
+  async def _schedule(self):
+    self.wakeEvent = asyncio.Event()
+
+    curTick:float = time.time()
+    for vehicle in self.settings.vehicles:
+      if not isStringEmpty(vehicle.vin):
+        # warm started ones keep their pending deadline
+        self.schedulePoll(vehicle, max(curTick, vehicle.nextPollTick) if vehicle.nextPollTick is not None else curTick)
+
+    while True:
+      self.wakeEvent.clear()
+      curTick = time.time()
+
+      dueVehicles:[Vehicle] = []
+      while len(self.pollQueue) > 0 and self.pollQueue[0][0] <= curTick:
+        tick, seq, vehicle = heapq.heappop(self.pollQueue)
+        if vehicle.nextPollTick == tick:
+          vehicle.nextPollTick = None
+          dueVehicles.append(vehicle)
+
+      if len(dueVehicles) > 0 or ( self.publishTick is not None and self.publishTick <= curTick ):
+        self.publishTick = None
+        self.triggerCycle(dueVehicles)
+
+      nextTick:float = self.pollQueue[0][0] if len(self.pollQueue) > 0 else None
+      if self.publishTick is not None and ( nextTick is None or self.publishTick < nextTick ):
+        nextTick = self.publishTick
+      try:
+        await asyncio.wait_for(self.wakeEvent.wait(), max(0, nextTick - time.time()) if nextTick is not None else None)
+      except asyncio.TimeoutError:
+        pass
+
+  def triggerCycle(self, vehicles:[Vehicle]):
+    if self.cycleTask is not None and not self.cycleTask.done():
+      # merged into a single cycle right after the running one
+      for vehicle in vehicles:
+        self.pendingVehicles[id(vehicle)] = vehicle
+      self.cyclePending = True
+      self.coalescedCount += 1
+      metrics.inc('vtrack_cycles_coalesced_total')
+      print('Cycle #{0} still running, next one coalesced ({1} so far)'.format(self.cycleCount, self.coalescedCount))
+      return
+    self.cycleTask = self.loop.create_task(self._runCycles(vehicles))
+
+  async def refresh(self, vehicles:[Vehicle]) -> RefreshJob:
+    job:RefreshJob = RefreshJob(vehicles)
+    curTick:float = time.time()
+    waiters:list[tuple] = []
+    waiter:asyncio.Future = None
+    for vehicle in vehicles:
+      waiter = self.pollWaiters.get(id(vehicle))
+      if waiter is not None:
+        job.coalescedCount += 1
+      elif not id(vehicle) in self.pollingVehicles and \
+           vehicle.lastPollTick is not None and ( vehicle.lastPollTick + self.settings.refreshMinDelay_s ) > curTick:
+        # values are fresh enough, kept as they are
+        job.setResult(vehicle, 'recent')
+        continue
+      else:
+        waiter = self.loop.create_future()
+        self.pollWaiters[id(vehicle)] = waiter
+        # one being polled right now answers with that poll
+        if not id(vehicle) in self.pollingVehicles:
+          self.schedulePoll(vehicle, curTick)
+      waiters.append(( vehicle, waiter ))
+
+    job.track(waiters)
+    self.refreshJobs[job.id] = job
+    while len(self.refreshJobs) > Service.MAX_REFRESH_JOBS:
+      self.refreshJobs.popitem(last=False)
+    return job
+
+  def getRefreshJob(self, jobId:str) -> RefreshJob:
+    return self.refreshJobs.get(jobId)
+
+  async def _runCycles(self, vehicles:[Vehicle]):
+    while True:
+      self.cyclePending = False
+      self.cycleCount += 1
+      self.pollingVehicles.update(id(vehicle) for vehicle in vehicles)
+      sentPcts:dict[str, float] = {}
+      startTime:float = time.monotonic()
+      try:
+        sentPcts = await readAndSendValues(self.settings, vehicles)
+      except Exception as excp:
+        print('Cycle #{0} failed : {1}'.format(self.cycleCount, str(excp)))
+        metrics.inc('vtrack_cycle_errors_total')
+      metrics.observe('vtrack_cycle_seconds', time.monotonic() - startTime)
+
+      curTick:float = time.time()
+      waiter:asyncio.Future = None
+      currentVehicle:Vehicle = None
+      for vehicle in vehicles:
+        self.pollingVehicles.discard(id(vehicle))
+        vehicle.lastPollTick = curTick
+        waiter = self.pollWaiters.pop(id(vehicle), None)
+        if waiter is not None and not waiter.done():
+          waiter.set_result(vehicle.pollErrorCount == 0)
+        currentVehicle = self.settings.vehiclesByVin.get(vehicle.vin)
+        if currentVehicle is not vehicle:
+          # removed by a reload meanwhile, or reconfigured : the new one carries on from this poll
+          if currentVehicle is None or currentVehicle.getSettingsKey() != vehicle.getSettingsKey():
+            continue
+          currentVehicle.takeOver(vehicle)
+        self.schedulePoll(currentVehicle, curTick + currentVehicle.getPollDelay(self.settings))
+      retryTick:float = None
+      publishedTick:int = None
+      for publisher in self.settings.mqttPublishers:
+        # no sooner than the broker backoff allows, overdue keep alives included
+        retryTick = max(curTick + self.settings.publishRetryDelay_s, publisher.retryTick if publisher.retryTick is not None else 0)
+        if sentPcts.get(publisher.key, 100) < 100 or publisher.getBacklog() > 0:
+          # keep alives wait along with the backlog
+          self._schedulePublish(retryTick)
+          continue
+        if self.settings.keepAlive_s > 0:
+          for vehicle in self.settings.vehicles:
+            publishedTick = vehicle.publishedTicks.get(publisher.key)
+            if publishedTick is not None:
+              self._schedulePublish(max(publishedTick + self.settings.keepAlive_s, retryTick))
+      self.wakeEvent.set()
+
+      if self.settings.state is not None:
+        await self.settings.state.saveAsync(self.settings)
+
+      if not self.cyclePending:
+        return
+      vehicles = list(self.pendingVehicles.values())
+      self.pendingVehicles = {}
 
 
 #
-# Main (sort of)
+# Http api
 #
 
-argParser = argparse.ArgumentParser(prog='vtrack', description='Vehicle Tracker')
-argParser.add_argument('-s', '--set', default='vtrack.conf', help='settings file path')
-argParser.add_argument('-v', '--vehicle', default='', help='vehicle type')
-argParser.add_argument('-u', '--username', default='', help='username')
-argParser.add_argument('-p', '--password', default='', help='password')
-argParser.add_argument('-aid', '--accountId', default='', help='accountId')
-argParser.add_argument('-ghaph', '--genHttpApiPasswordHash', default='', help='')
-args = argParser.parse_args()
-
-if not isStringEmpty(args.genHttpApiPasswordHash):
-  print(generatePasswordHash(args.genHttpApiPasswordHash))
-  exit()
+def addHttpRoutes(flask, flaskAuth, settings:Settings, service:Service, sessionTracker:SessionTracker):
+  # the api routes, on whatever flask app and auth the http api helpers (or a benchmark) built
+  from flask import request, Response
+
+  valuesCache:ValuesCache = ValuesCache(settings)
+  changeFeed:ChangeFeed = ChangeFeed(maxWaiters=settings.changesMaxWaiters)
+  Vehicle.valuesListeners.append(changeFeed.onValues)
+  Vehicle.removedListeners.append(changeFeed.onRemoved)
+
+  @flask.route("/api/values", methods = ['GET'])
+  @flaskAuth.login_required
+  def values():
+    if isValuesQuery(request.args):
+      queryDict:dict = queryValues(settings, request.args)
+      if queryDict is None:
+        return "", 400
+      return queryDict, 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+    acceptEncodings:list[str] = [encoding for encoding in ( 'br', 'gzip' ) if request.accept_encodings[encoding] > 0]
+    body, encoding, etag, lastModified = valuesCache.get(acceptEncodings)
+    headers:dict = {
+      'ETag': '"{0}"'.format(etag),
+      'Last-Modified': lastModified.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+      'Cache-Control': 'no-cache',
+      'Vary': 'Accept-Encoding'
+    }
+    if ValuesCache.isNotModified(request.if_none_match, request.if_modified_since, etag, lastModified):
+      return Response(status=304, headers=headers)
+    if encoding is not None:
+      headers['Content-Encoding'] = encoding
+    return Response(body, status=200, headers=headers, content_type='application/json; charset=utf-8')
+
+  @flask.route("/api/refresh", methods = ['POST'])
+  @flaskAuth.login_required
+  def apiRefresh():
+    # old values stay served until the new ones arrive
+    vehicles:[Vehicle] = selectVehicles(settings, request.args)
+    if len(vehicles) <= 0:
+      return "", 404
+    job:RefreshJob = service.submit(service.refresh(vehicles)).result(10)
+    return refreshJobResponse(job)
+
+  @flask.route("/api/refresh/<jobId>", methods = ['GET'])
+  @flaskAuth.login_required
+  def apiRefreshJob(jobId:str):
+    job:RefreshJob = service.getRefreshJob(jobId)
+    if job is None:
+      return "", 404
+    return refreshJobResponse(job)
+
+  def refreshJobResponse(job:RefreshJob):
+    try:
+      wait_s:float = min(float(request.args.get('wait', 0)), 300)
+    except ValueError:
+      return "", 400
+    if wait_s > 0:
+      job.doneEvent.wait(wait_s)
+    return job.toDict(), 200 if job.isDone() else 202, {'Content-Type': 'application/json; charset=utf-8', 'Location': '/api/refresh/' + job.id}
+
+  @flask.route("/api/changes", methods = ['GET'])
+  @flaskAuth.login_required
+  def apiChanges():
+    # long poll : answers as soon as something changed after version since
+    try:
+      since:int = int(request.args.get('since', 0))
+      timeout_s:float = min(float(request.args.get('timeout', 30)), 300)
+    except ValueError:
+      return "", 400
+    if not changeFeed.enter():
+      return "", 503, {'Retry-After': '5'}
+    try:
+      changeFeed.wait(since, timeout_s)
+    finally:
+      changeFeed.leave()
+    return getChangesDict(settings, changeFeed, since), 200, {'Content-Type': 'application/json; charset=utf-8'}
 
-inProgress:bool = False
-settings:Settings = None
-  
-if not isStringEmpty(args.vehicle) and not isStringEmpty(args.username) and not isStringEmpty(args.password):
-    vehicleSettingsDict:dict = { 'type':args.vehicle, 'username':args.username, 'password':args.password }
-    if not isStringEmpty(args.accountId):
-      vehicleSettingsDict['accountId'] = args.accountId
-    settingsDict:dict = { 'vehicles': [ vehicleSettingsDict ] }
-    settings = Settings(settingsDict)
+  @flask.route("/api/stream", methods = ['GET'])
+  @flaskAuth.login_required
+  def apiStream():
+    try:
+      since:int = int(request.headers.get('Last-Event-ID', request.args.get('since', changeFeed.version)))
+    except ValueError:
+      return "", 400
 
-if settings is None:
-  settings = readSettings(args.set if not isStringEmpty(args.set) else 'vtrack.conf')
+    def events(since:int):
+      try:
+        yield 'retry: 5000\n\n'
+        while True:
+          if changeFeed.wait(since, 15) == since:
+            yield ': keepalive\n\n'
+            continue
+          changesDict:dict = getChangesDict(settings, changeFeed, since)
+          since = changesDict['version']
+          yield 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(since, 'reset' if 'reset' in changesDict else 'changes', json.dumps(changesDict['changes'], separators=(',', ':')))
+      finally:
+        # client gone
+        changeFeed.leave()
+
+    if not changeFeed.enter():
+      return "", 503, {'Retry-After': '5'}
+    return Response(events(since), status=200, headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}, content_type='text/event-stream')
+
+  # always there : metrics is reloaded, turned on or off without a restart
+  @flask.route("/metrics", methods = ['GET'])
+  @flaskAuth.login_required
+  def apiMetrics():
+    if not settings.metrics:
+      return "", 404
+    collectMetrics(settings)
+    return Response(metrics.render(), status=200, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+  @flask.route("/api/history", methods = ['GET'])
+  @flaskAuth.login_required
+  def apiHistory():
+    if settings.history is None:
+      return "", 404
+    vin:str = request.args.get('vin', '')
+    if isStringEmpty(vin):
+      return "", 400
+    try:
+      endTick:int = int(request.args.get('to', time.time()))
+      startTick:int = int(request.args.get('from', endTick - 86400))
+      resolution:int = int(request.args['resolution']) if 'resolution' in request.args else None
+    except ValueError:
+      return "", 400
+    if resolution is not None and not resolution in ( HistoryStore.RESOLUTION_RAW, HistoryStore.RESOLUTION_5MIN, HistoryStore.RESOLUTION_HOUR ):
+      return "", 400
+    return { 'vin': vin, 'samples': settings.history.query(vin, startTick, endTick, resolution) }, 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+  @flask.route("/api/sessions", methods = ['GET'])
+  @flaskAuth.login_required
+  def apiSessions():
+    vehicles:[Vehicle] = selectVehicles(settings, request.args)
+    if len(vehicles) <= 0:
+      return "", 404
+    return { vehicle.vin: sessionTracker.getSessionsDict(vehicle.vin) for vehicle in vehicles }, 200, {'Content-Type': 'application/json; charset=utf-8'}
 
-if settings is not None and settings.isSet():
-  print('Loop with settings')
-  dispSettings(settings)
 
-  sched:BackgroundScheduler = BackgroundScheduler(daemon=True)
-  sched.add_job(readAndSendValuesBlocking,'interval',seconds=10)
-  sched.start()
+#
+# Main (sort of)
+#
 
-  if settings.httpApi is not None:
-    apiRefreshTstamp:int = None
-    flask, flaskAuth = buildHttpApi(__name__, settings.httpApi)
-
-    @flask.route("/api/values", methods = ['GET'])
-    @flaskAuth.login_required
-    def values():
-      lastValues:VehicleValues = None
-      allLastValues:dict[str, VehicleValues] = {}
-      for vehicle in settings.vehicles:
-        if not isStringEmpty(vehicle.registration):
-          lastValues = vehicle.lastValues
-          if lastValues is not None:
-            allLastValues[vehicle.registration] = lastValues.toDict()
-      return allLastValues, 200, {'Content-Type': 'application/json; charset=utf-8'}
-
-    @flask.route("/api/refresh", methods = ['POST'])
-    @flaskAuth.login_required
-    def apiRefresh():
-      global apiRefreshTstamp
-      if apiRefreshTstamp is not None and ( time.time() - apiRefreshTstamp ) < 30:
-        return "", 409
-      apiRefreshTstamp = time.time()
-      for vehicle in settings.vehicles:
-        vehicle.resetLastValues()
-      return ""
-
-    runHttpApi(flask, settings.httpApi)
+settings:Settings = None
+settingsPath:str = None
+
+# imported (benchmarks, tools) : classes and functions only
+if __name__ == '__main__':
+  argParser = argparse.ArgumentParser(prog='vtrack', description='Vehicle Tracker')
+  argParser.add_argument('-s', '--set', default='vtrack.conf', help='settings file path')
+  argParser.add_argument('-v', '--vehicle', default='', help='vehicle type')
+  argParser.add_argument('-u', '--username', default='', help='username')
+  argParser.add_argument('-p', '--password', default='', help='password')
+  argParser.add_argument('-aid', '--accountId', default='', help='accountId')
+  argParser.add_argument('-ghaph', '--genHttpApiPasswordHash', default='', help='')
+  argParser.add_argument('-x', '--export', default='', choices=[''] + ValuesExport.FORMATS, help='poll once, export values and exit')
+  argParser.add_argument('-o', '--output', default='', help='export file path, stdout when empty')
+  argParser.add_argument('-f', '--fields', default='', help='exported values, comma separated, all when empty')
+  args = argParser.parse_args()
+
+  if not isStringEmpty(args.genHttpApiPasswordHash):
+    importLazily('httpapi')
+    print(generatePasswordHash(args.genHttpApiPasswordHash))
+    exit()
+
+  if not isStringEmpty(args.vehicle) and not isStringEmpty(args.username) and not isStringEmpty(args.password):
+      vehicleSettingsDict:dict = { 'type':args.vehicle, 'username':args.username, 'password':args.password }
+      if not isStringEmpty(args.accountId):
+        vehicleSettingsDict['accountId'] = args.accountId
+      settingsDict:dict = { 'vehicles': [ vehicleSettingsDict ] }
+      settings = Settings(settingsDict)
+
+  if settings is None:
+    settingsPath = args.set if not isStringEmpty(args.set) else 'vtrack.conf'
+    settings = readSettings(settingsPath)
+
+  if settings is not None and settings.isSet() and not isStringEmpty(args.export):
+    exportFields:[str] = [field for field in args.fields.split(',') if not isStringEmpty(field)]
+    if any(not field in ValuesExport.FIELDS for field in exportFields):
+      print('Unknown export field(s), from {0}'.format(','.join(ValuesExport.FIELDS)), file=sys.stderr)
+      exit(2)
+    settings.applyLimits()
+    exit(1 if readAndDisplayValuesBlocking(args.export, args.output, exportFields) > 0 else 0)
+  elif settings is not None and settings.isSet():
+    print('Loop with settings')
+    dispSettings(settings)
+
+    metrics.enabled = settings.metrics
+    settings.applyLimits()
+
+    if settings.state is not None:
+      print('Warm start for {0} vehicle(s)'.format(settings.state.load(settings)))
+
+    if settings.shards is not None:
+      settings.shards.start(settings)
+      print('Polling over {0} shard worker(s) by {1}'.format(settings.shards.shardCount, settings.shards.shardBy))
+
+    # trips and charges out of every new sample, from now on
+    sessionTracker:SessionTracker = SessionTracker(settings.sessionsKept)
+    Vehicle.valuesListeners.append(sessionTracker.onValues)
+    Vehicle.removedListeners.append(sessionTracker.onRemoved)
+
+    service:Service = Service(settings, settingsPath)
+    service.start()
+
+    if settingsPath is not None and hasattr(signal, 'SIGHUP'):
+      # kill -HUP : settings read again and applied on the loop, nothing restarted
+      signal.signal(signal.SIGHUP, lambda signum, frame: service.submit(service.reloadFile()))
+
+    if settings.httpApi is not None:
+      flask, flaskAuth = buildHttpApi(__name__, settings.httpApi)
+      addHttpRoutes(flask, flaskAuth, settings, service, sessionTracker)
+
+      # the server threads only ever run the routes above : small stacks, for changesMaxWaiters of them to fit
+      threading.stack_size(HTTP_THREAD_STACK_SIZE)
+      try:
+        runHttpApi(flask, settings.httpApi)
+      finally:
+        service.stop()
+    else:
+      try:
+        service.join()
+      finally:
+        service.stop()
+  elif settings is None:
+    print('No settings found')
   else:
-    while True:
-      time.sleep(5)
-elif settings is None:
-  print('No settings found')
-else:
-  print('Bad settings found')
\ No newline at end of file
+    print('Bad settings found')
\ No newline at end of file
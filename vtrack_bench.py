@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# MIT License
+#
+# Copyright 2023 KrzDvt
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the “Software”), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+#
+# Benchmarks the poll, declare and publish path and the values api against local stand-ins
+#
+# python vtrack_bench.py
+# python vtrack_bench.py --sizes 1,100,10000 --latency 0.01 --errorRate 0.01 --json bench.json
+#
+# not measured : the Renault stand-in replaces the connection's login, aiohttp session and vehicle lookups,
+# so the session reuse across polls is not exercised, only the limiters, breakers and poll scheduling around it
+# /api/values over http needs flask (and its werkzeug server), skipped without it
+#
+
+
+import json
+import time
+import threading
+import http.client
+import random
+import argparse
+import resource
+import tracemalloc
+import types
+import datetime
+
+import asyncio
+
+import vtrack
+
+
+#
+# Renault stand-in : same connection, limiter and breaker code, no cloud behind
+#
+
+class FakeApiError(Exception):
+  pass
+
+
+class FakeRenaultApi:
+  def __init__(self, latency_s:float, jitter:float, errorRate:float, seed:int):
+    self.latency_s:float = latency_s
+    self.jitter:float = jitter
+    self.errorRate:float = errorRate
+    self.random:random.Random = random.Random(seed)
+
+    self.callCount:int = 0
+    self.errorCount:int = 0
+
+  async def call(self, name:str):
+    self.callCount += 1
+    if self.latency_s > 0:
+      await asyncio.sleep(self.latency_s * ( 1 + self.jitter * self.random.uniform(-1, 1) ))
+    if self.errorRate > 0 and self.random.random() < self.errorRate:
+      self.errorCount += 1
+      raise FakeApiError(name)
+
+
+class FakeRenaultVehicle:
+  def __init__(self, api:FakeRenaultApi, vin:str, index:int):
+    self.api:FakeRenaultApi = api
+    self.vin:str = vin
+    self.index:int = index
+    self.odoKm:float = 10000 + index
+    self.levelPct:float = 20 + index % 80
+    self.charging:bool = ( index % 3 == 0 )
+
+  async def get_details(self):
+    await self.api.call('details')
+    return types.SimpleNamespace(brand=types.SimpleNamespace(label='RENAULT'), model=types.SimpleNamespace(label='ZOE'),
+                                 energy=types.SimpleNamespace(label='ELECTRIQUE'), registrationNumber='BE-{0:06d}'.format(self.index))
+
+  async def get_cockpit(self):
+    await self.api.call('cockpit')
+    # every other poll moves : half the fleet has something new to publish
+    if self.api.random.random() < 0.5:
+      self.odoKm += self.api.random.uniform(1, 30)
+    return types.SimpleNamespace(totalMileage=round(self.odoKm, 1))
+
+  async def get_battery_status(self):
+    await self.api.call('battery')
+    if self.charging:
+      self.levelPct = min(100, self.levelPct + self.api.random.uniform(0, 3))
+    return types.SimpleNamespace(batteryTemperature=15 + self.index % 10, batteryLevel=round(self.levelPct), batteryAvailableEnergy=None,
+                                 plugStatus=1 if self.charging else 0, chargingStatus=1.0 if self.charging else 0.0,
+                                 chargingInstantaneousPower=7000 if self.charging else 0)
+
+  async def get_location(self):
+    await self.api.call('location')
+    return types.SimpleNamespace(gpsLatitude=48.8 + ( self.index % 1000 ) / 1000, gpsLongitude=2.3 + ( self.index // 1000 ) / 1000,
+                                 lastUpdateTime=datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+
+class FakeRenaultConnection(vtrack.RenaultConnection):
+  def __init__(self, username:str, password:str, pool:'FakeRenaultPool'):
+    super().__init__(username, password, pool)
+    self.api:FakeRenaultApi = pool.api
+    self.fakeVehicles:dict[str, FakeRenaultVehicle] = {}
+
+  def isLoggedIn(self) -> bool:
+    return self.loginTick is not None
+
+  def _isBound(self) -> bool:
+    return self.loop is asyncio.get_running_loop()
+
+  def _bind(self):
+    self.loop = asyncio.get_running_loop()
+    self.lock = asyncio.Lock()
+
+  async def getClient(self):
+    if not self._isBound():
+      self._bind()
+    async with self.lock:
+      if not self.isLoggedIn():
+        await self.request('login', 'login', self.api.call('login'))
+        self.loginTick = int(time.time())
+    return None
+
+  async def getVehicle(self, accountId:str, vin:str) -> FakeRenaultVehicle:
+    await self.getClient()
+    vehicle:FakeRenaultVehicle = self.fakeVehicles.get(vin)
+    if vehicle is None:
+      vehicle = FakeRenaultVehicle(self.api, vin, int(vin[-8:]))
+      self.fakeVehicles[vin] = vehicle
+    return vehicle
+
+  async def close(self):
+    pass
+
+
+class FakeRenaultPool(vtrack.RenaultConnectionPool):
+  def __init__(self, api:FakeRenaultApi):
+    super().__init__()
+    self.api:FakeRenaultApi = api
+
+  def get(self, username:str, password:str) -> FakeRenaultConnection:
+    key:tuple = (username, password)
+    connection:FakeRenaultConnection = self.connections.get(key)
+    if connection is None:
+      connection = FakeRenaultConnection(username, password, self)
+      self.connections[key] = connection
+    return connection
+
+
+#
+# MQTT stand-in : payloads rendered and kept in memory, acknowledged after a delay
+#
+
+class FakeBroker:
+  def __init__(self, publishLatency_s:float):
+    self.publishLatency_s:float = publishLatency_s
+    self.states:dict[str, bytes] = {}
+    self.publishCount:int = 0
+    self.declareCount:int = 0
+
+  def publish(self, messages:list[tuple]) -> bool:
+    # stands for every broker connection : acknowledged after the latency
+    for topic, payload, retain in messages:
+      if topic.endswith('/config'):
+        self.declareCount += 1
+      else:
+        self.states[topic] = payload.encode('utf-8')
+        self.publishCount += 1
+    if self.publishLatency_s > 0 and len(messages) > 0:
+      time.sleep(self.publishLatency_s)
+    return True
+
+
+#
+# Benchmarks
+#
+
+def buildSettings(vehicleCount:int, args) -> vtrack.Settings:
+  vehicleDicts:list[dict] = []
+  for index in range(vehicleCount):
+    accountIndex:int = index // args.vehiclesPerAccount
+    vehicleDicts.append({
+      'type': 'renault',
+      'vin': 'VF1BENCH{0:08d}'.format(index),
+      'username': 'bench{0}@example.com'.format(accountIndex),
+      'password': 'bench',
+      'accountId': 'bench-account-{0}'.format(accountIndex)
+    })
+  settingsDict:dict = {
+    'vehicles': vehicleDicts,
+    # vtrack's own layout : rendered here, the shared helpers would bring their own client along
+    'mqtts': [ { 'hostname': 'bench{0}'.format(index), 'port': 1883, 'format': 'vtrack' } for index in range(args.brokers) ],
+    'pollConcurrency': args.pollConcurrency,
+    'pollConcurrencyPerAccount': args.pollConcurrencyPerAccount,
+    'publishQueueSize': max(1000, vehicleCount),
+    'declareDelay': 0
+  }
+  if not args.rateLimits:
+    settingsDict['accountRate'] = 0
+    settingsDict['globalRate'] = 0
+  settings:vtrack.Settings = vtrack.Settings(settingsDict)
+  settings.applyLimits()
+  return settings
+
+async def measure(results:list[dict], vehicleCount:int, phase:str, coro, itemCount:int=None) -> object:
+  startTime:float = time.perf_counter()
+  result = await coro
+  duration_s:float = time.perf_counter() - startTime
+  itemCount = itemCount if itemCount is not None else vehicleCount
+  results.append({
+    'vehicles': vehicleCount,
+    'phase': phase,
+    'seconds': duration_s,
+    'perSecond': itemCount / duration_s if duration_s > 0 else None
+  })
+  return result
+
+async def timeIt(func, iterationCount:int):
+  for index in range(iterationCount):
+    func()
+
+def startHttpApi(settings:vtrack.Settings):
+  # the real routes on a local werkzeug server, no authentication : ( server, port ), None without flask
+  try:
+    import flask
+    import werkzeug.serving
+  except ImportError:
+    return None
+  app = flask.Flask('vtrack_bench')
+  vtrack.addHttpRoutes(app, types.SimpleNamespace(login_required=lambda func: func), settings, vtrack.Service(settings), vtrack.SessionTracker(settings.sessionsKept))
+  server = werkzeug.serving.make_server('127.0.0.1', 0, app, threaded=True)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, server.server_port
+
+def getValues(port:int, headers:dict, status:int) -> str:
+  # one connection per request, as simple clients do
+  connection:http.client.HTTPConnection = http.client.HTTPConnection('127.0.0.1', port)
+  try:
+    connection.request('GET', '/api/values', headers=headers)
+    response:http.client.HTTPResponse = connection.getresponse()
+    response.read()
+    if response.status != status:
+      raise RuntimeError('/api/values answered {0}, not {1}'.format(response.status, status))
+    return response.getheader('ETag')
+  finally:
+    connection.close()
+
+async def benchSize(vehicleCount:int, args) -> list[dict]:
+  results:list[dict] = []
+  api:FakeRenaultApi = FakeRenaultApi(args.latency, args.jitter, args.errorRate, args.seed)
+  broker:FakeBroker = FakeBroker(args.publishLatency)
+  vtrack.Renault.connections = FakeRenaultPool(api)
+
+  tracemalloc.start()
+  tracemalloc.reset_peak()
+  settings:vtrack.Settings = buildSettings(vehicleCount, args)
+  settingsMb:float = tracemalloc.get_traced_memory()[0] / 1048576
+  tracemalloc.stop()
+  for publisher in settings.mqttPublishers:
+    publisher.connection.publish = broker.publish
+
+  # cold : logins and vehicle details on top of the values
+  await measure(results, vehicleCount, 'readValues cold', vtrack.readValues(settings))
+  await measure(results, vehicleCount, 'readValues', vtrack.readValues(settings))
+
+  values:dict = vtrack.getLastValues(settings)
+  await measure(results, vehicleCount, 'declareValues', vtrack.declareValues(settings))
+  await measure(results, vehicleCount, 'sendValues', vtrack.sendValues(values, settings), vehicleCount * args.brokers)
+  # nothing new since : deadbands and sent ticks skip everything
+  await measure(results, vehicleCount, 'sendValues unchanged', vtrack.sendValues(values, settings), vehicleCount * args.brokers)
+
+  await measure(results, vehicleCount, 'cycle', vtrack.readAndSendValues(settings))
+
+  # /api/values : body built once per values version, then served as is
+  valuesCache:vtrack.ValuesCache = vtrack.ValuesCache(settings)
+  vtrack.Vehicle.valuesVersion += 1
+  await measure(results, vehicleCount, '/api/values build', timeIt(lambda: valuesCache.get(['gzip']), 1))
+  await measure(results, vehicleCount, '/api/values hit', timeIt(lambda: valuesCache.get(['gzip']), args.iterations), args.iterations)
+  await measure(results, vehicleCount, '/api/values query', timeIt(lambda: vtrack.queryValues(settings, { 'state': 'charging', 'limit': '100' }), args.iterations), args.iterations)
+
+  # memory of one more full cycle, apart : tracing slows everything down
+  tracemalloc.start()
+  tracemalloc.reset_peak()
+  await vtrack.readAndSendValues(settings)
+  cyclePeakMb:float = tracemalloc.get_traced_memory()[1] / 1048576
+  tracemalloc.stop()
+
+  for publisher in settings.mqttPublishers:
+    await publisher.close()
+
+  # /api/values again, through an http request : routing, headers and the socket on top of the cache
+  listeners:tuple = ( list(vtrack.Vehicle.valuesListeners), list(vtrack.Vehicle.removedListeners) )
+  httpApi:tuple = startHttpApi(settings)
+  if httpApi is not None:
+    server, port = httpApi
+    try:
+      etag:str = getValues(port, { 'Accept-Encoding': 'gzip' }, 200)
+      await measure(results, vehicleCount, '/api/values http', timeIt(lambda: getValues(port, { 'Accept-Encoding': 'gzip' }, 200), args.iterations), args.iterations)
+      await measure(results, vehicleCount, '/api/values http 304', timeIt(lambda: getValues(port, { 'Accept-Encoding': 'gzip', 'If-None-Match': etag }, 304), args.iterations), args.iterations)
+    finally:
+      server.shutdown()
+      vtrack.Vehicle.valuesListeners, vtrack.Vehicle.removedListeners = listeners
+
+  for result in results:
+    result['settingsMb'] = settingsMb
+    result['cyclePeakMb'] = cyclePeakMb
+    result['apiCalls'] = api.callCount
+    result['apiErrors'] = api.errorCount
+    result['published'] = broker.publishCount
+  return results
+
+def dispResults(results:list[dict]):
+  print('{0:>8}  {1:<22} {2:>10} {3:>12} {4:>10} {5:>10}'.format('vehicles', 'phase', 'seconds', 'per second', 'settingsMb', 'cyclePeakMb'))
+  for result in results:
+    print('{0:>8}  {1:<22} {2:>10.4f} {3:>12} {4:>10.1f} {5:>10.1f}'.format(result['vehicles'], result['phase'], result['seconds'],
+                                                                      '{0:.0f}'.format(result['perSecond']) if result['perSecond'] is not None else '-',
+                                                                      result['settingsMb'], result['cyclePeakMb']))
+
+
+argParser = argparse.ArgumentParser(prog='vtrack_bench', description='Vehicle Tracker benchmarks')
+argParser.add_argument('--sizes', default='1,100,10000', help='simulated fleet sizes, comma separated')
+argParser.add_argument('--latency', type=float, default=0.01, help='Renault request latency in seconds')
+argParser.add_argument('--jitter', type=float, default=0.5, help='latency jitter, as a share of the latency')
+argParser.add_argument('--errorRate', type=float, default=0, help='share of Renault requests failing')
+argParser.add_argument('--vehiclesPerAccount', type=int, default=5, help='vehicles sharing one Renault account')
+argParser.add_argument('--pollConcurrency', type=int, default=64, help='vehicles polled at once')
+argParser.add_argument('--pollConcurrencyPerAccount', type=int, default=4, help='vehicles of one account polled at once')
+argParser.add_argument('--rateLimits', action='store_true', help='keep the default Renault rate limits')
+argParser.add_argument('--brokers', type=int, default=1, help='MQTT brokers')
+argParser.add_argument('--publishLatency', type=float, default=0.0005, help='MQTT acknowledgement latency in seconds')
+argParser.add_argument('--iterations', type=int, default=1000, help='requests per /api/values measure')
+argParser.add_argument('--seed', type=int, default=1, help='random seed, for runs to be comparable')
+argParser.add_argument('--json', default='', help='also write the results to this file')
+
+if __name__ == '__main__':
+  args = argParser.parse_args()
+  print('Benchmarks with {0}'.format(vars(args)))
+
+  allResults:list[dict] = []
+  for vehicleCount in [int(size) for size in args.sizes.split(',')]:
+    allResults += asyncio.run(benchSize(vehicleCount, args))
+  dispResults(allResults)
+  print('max rss {0:.1f}MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+  notes:list[str] = [ 'Renault session reuse not exercised : the stand-in connection replaces logins, sessions and vehicle lookups' ]
+  if not any(result['phase'].startswith('/api/values http') for result in allResults):
+    notes.append('/api/values over http skipped : flask not installed')
+  for note in notes:
+    print('note : ' + note)
+
+  if args.json:
+    with open(args.json, 'w') as file:
+      json.dump({ 'args': vars(args), 'results': allResults, 'notes': notes }, file, indent=2)